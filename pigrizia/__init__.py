@@ -10,4 +10,10 @@ Pigrizia is a tool for system administrators.
 
 import logging
 
+__version__ = '0.0.1'
+
+# The dependencies, read by setup.py and used for the metadata of the
+# wheels of pigrizia.host.bootstrap.
+__requires__ = ['paramiko', 'toml', 'humanfriendly']
+
 
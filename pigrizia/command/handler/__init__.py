@@ -4,6 +4,8 @@
 # license that can be found in the LICENSE file or at
 # https://opensource.org/licenses/MIT.
 
+import shlex
+import threading
 from getpass import getuser
 
 class NoSuchCommand(Exception):
@@ -32,3 +34,77 @@ class Handler:
             # something.
             pass
 
+        # Commands go through persistent shells if session=True. See
+        # pigrizia.command.handler.session.
+        self._use_session = 'session' in kwargs and kwargs['session'] is True
+        self._sessions = {}
+        # Guards _sessions, handlers may be shared between threads (e.g.
+        # pooled handlers used by fleet workers).
+        self._sessions_lock = threading.Lock()
+
+    def batch(self, **kwargs):
+        """
+        Starts a batch of commands. Commands queued on the batch are sent
+        as a single script when the batch is run, which happens
+        automatically at the end of a ``with`` block.
+
+            >>> with handler.batch() as b:
+            ...     r = b.do("test -f /etc/hosts")
+            >>> r.ret
+            0
+
+        :param bool sudo: if True, all commands are run using sudo
+        :rtype: :class:`~pigrizia.command.handler.batch.Batch`
+        """
+        from .batch import Batch
+        return Batch(self, **kwargs)
+
+    def interact(self, script=None, **kwargs):
+        """
+        Gets a persistent shell session on the host. The session is
+        started the first time it is asked for and then reused, until
+        the handler is closed.
+
+            >>> session = handler.interact(sudo=True)
+            >>> session.run("whoami")
+            (0, ['root'], [])
+
+        :param str script: commands to run in the shell itself (see
+            :meth:`~pigrizia.command.handler.session.Session.source`)
+        :param bool sudo: if True, the session is a root shell
+        :rtype: :class:`~pigrizia.command.handler.session.Session`
+        :raises SessionClosed: if the shell could not be started
+        """
+        sudo = 'sudo' in kwargs and kwargs['sudo'] is True
+        with self._sessions_lock:
+            session = self._sessions.get(sudo)
+            if session is None or session.closed:
+                if 'passwd' in kwargs:
+                    passwd = kwargs['passwd']
+                else:
+                    passwd = getattr(self, 'passwd', None)
+                session = self._new_session(sudo, passwd)
+                self._sessions[sudo] = session
+        if script is not None:
+            session.source(script)
+        return session
+
+    def close(self):
+        """
+        Releases any resources held by this handler.
+        """
+        with self._sessions_lock:
+            sessions = list(self._sessions.values())
+            self._sessions = {}
+        for session in sessions:
+            session.close()
+
+    def _new_session(self, sudo, passwd):
+        raise NotImplementedError()
+
+def _staged_command(cmd, staged):
+    # Runs cmd with stdin read from a staged file, and removes the file.
+    # Used when stdin is taken by the sudo password.
+    script = "{} < {}; ret=$?; rm -f {}; exit $ret".format(cmd,
+            shlex.quote(staged), shlex.quote(staged))
+    return "sh -c {}".format(shlex.quote(script))
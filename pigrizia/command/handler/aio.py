@@ -0,0 +1,314 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+Command handlers for asyncio.
+
+The handlers in this module have the same methods as the other command
+handlers, except that :meth:`do`, :meth:`sudo` and :meth:`copy` are
+coroutines. Waiting for a command to finish does not block a thread, so a
+single event loop can talk to a great many hosts at the same time.
+
+    >>> async def uptime(addr):
+    ...     h = AsyncRemoteHandler(addr=addr, passwd=passwd)
+    ...     ret, out, err = await h.do("uptime")
+    ...     h.close()
+    ...     return out[0]
+    >>> asyncio.run(asyncio.gather(*[uptime(a) for a in addrs]))
+
+The remote handler gets its connection from the same pool as
+:class:`~pigrizia.command.handler.remote.RemoteHandler`. Paramiko has no
+asyncio support, so connecting, opening channels and SFTP transfers are
+done in the default executor of the event loop. Reading the output of
+commands is done directly on the event loop, by watching the file
+descriptor Paramiko provides for every channel.
+"""
+
+import asyncio
+import functools
+import secrets
+import shlex
+from . import Handler, NoSuchCommand
+from .pool import pool
+from . import checksum
+
+class _AsyncHandler(Handler):
+    # The shell sessions of the other handlers are blocking, so they are
+    # not offered here.
+
+    def interact(self, script=None, **kwargs):
+        """
+        Not supported: the asyncio handlers have no shell sessions.
+
+        :raises TypeError: always
+        """
+        raise TypeError("{} does not support shell sessions".format(
+            type(self).__name__))
+
+class AsyncRemoteHandler(_AsyncHandler):
+    """
+    A command handler that executes commands on a remote system from
+    asyncio code. The connection is made the first time a command is run.
+    """
+
+    ssh = None
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.addr = kwargs['addr']
+        self._pool = pool
+        # Created by connect, on the event loop that uses the handler.
+        self._connect_lock = None
+
+    async def connect(self):
+        """
+        Connects to the host, unless this handler is already connected.
+        Concurrent calls wait for the same connection.
+        """
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self.ssh is None:
+                loop = asyncio.get_running_loop()
+                acquire = functools.partial(self._pool.acquire, self.addr,
+                        self.user, passwd=getattr(self, 'passwd', None))
+                self.ssh = await loop.run_in_executor(None, acquire)
+
+    async def do(self, cmd, **kwargs):
+        """
+        Invoke a single command as the current user.
+
+        :param str cmd: the command to run, including arguments
+        :return: a tuple consisting of the exit code, output to stdout
+            and output to stderr
+        :rtype: tuple
+        """
+        ret, out, err = await self._run(cmd)
+        if ret == 127:
+            raise NoSuchCommand(shlex.split(cmd)[0])
+        return ret, out, err
+
+    async def sudo(self, cmd, **kwargs):
+        """
+        Invoke a single command as another user (by default root).
+
+        The password is only sent if sudo actually asks for it, so this
+        works whether or not sudo has cached the credentials.
+
+        :param str cmd: the command to run including the arguments
+        :return: a tuple consisting of the exit code, output to stdout
+            and output to stderr
+        :rtype: tuple
+        """
+        prompt = "[pigrizia-sudo-{}]".format(secrets.token_hex(8))
+        if 'user' in kwargs:
+            cmd = "sudo -S -p {} -u {} {}".format(shlex.quote(prompt),
+                    kwargs['user'], cmd)
+        else:
+            cmd = "sudo -S -p {} {}".format(shlex.quote(prompt), cmd)
+
+        if 'passwd' in kwargs:
+            passwd = kwargs['passwd']
+        elif hasattr(self, 'passwd'):
+            passwd = self.passwd
+        else:
+            passwd = None
+
+        return await self._run(cmd, prompt=prompt, passwd=passwd)
+
+    async def copy(self, src, dest, **kwargs):
+        """
+        Copies a local file to the remote host.
+
+        :param str src: the file to copy
+        :param str dest: the location to copy to.
+        :param str hash: the checksum algorithm (see
+            :mod:`~pigrizia.command.handler.checksum`)
+        :return tuple: the exit code (``int``), stdout (``list``) and
+            stderr (``list``)
+        :raises CopyFailed: if the checksums of the source and the copy
+            don't match
+        """
+        from .remote import CopyFailed
+
+        loop = asyncio.get_running_loop()
+        # The setting of the host may have to be read from hosts.conf.
+        select = functools.partial(checksum.select_algorithm, kwargs,
+                self.addr)
+        algorithm = await loop.run_in_executor(None, select)
+        await self.connect()
+        ret, out, err = await self.do("mktemp")
+        tmp = out[0]
+        put = functools.partial(self._put, src, tmp, algorithm)
+        schk = await loop.run_in_executor(None, put)
+
+        cmd = "{} {}".format(checksum.command(algorithm), tmp)
+        if 'sudo' in kwargs and kwargs['sudo'] is True:
+            ret, out, err = await self.sudo(cmd, **kwargs)
+        else:
+            ret, out, err = await self.do(cmd, **kwargs)
+        if ret != 0 or out[0].split()[0] != schk:
+            raise CopyFailed()
+
+        cmd = "cp {} {}".format(tmp, dest)
+        if 'sudo' in kwargs and kwargs['sudo'] is True:
+            return await self.sudo(cmd, **kwargs)
+        else:
+            return await self.do(cmd, **kwargs)
+
+    def close(self):
+        """
+        Gives the connection back to the pool.
+        """
+        if self.ssh is not None:
+            self._pool.release(self.ssh)
+            self.ssh = None
+
+    def _put(self, src, dest, algorithm):
+        # Runs in the executor. Returns the checksum of what was sent.
+        h = checksum.new(algorithm)
+        sftp = self.ssh.open_sftp()
+        try:
+            with open(src, 'rb') as f, sftp.open(dest, 'wb') as r:
+                r.set_pipelined(True)
+                for chunk in iter(lambda: f.read(32768), b''):
+                    h.update(chunk)
+                    r.write(chunk)
+        finally:
+            sftp.close()
+        return h.hexdigest()
+
+    async def _run(self, cmd, prompt=None, passwd=None):
+        await self.connect()
+        loop = asyncio.get_running_loop()
+        chan = await loop.run_in_executor(None, self._open, cmd)
+        try:
+            out, err = await self._communicate(chan, prompt, passwd)
+            ret = await loop.run_in_executor(None, chan.recv_exit_status)
+        finally:
+            chan.close()
+
+        out = [o.strip() for o in out.decode().splitlines()]
+        err = [e.strip() for e in err.decode().splitlines()]
+        return ret, out, err
+
+    def _open(self, cmd):
+        # Opening a channel waits for the server to answer, so this runs
+        # in the executor.
+        chan = self.ssh.get_transport().open_session()
+        chan.exec_command(cmd)
+        return chan
+
+    async def _communicate(self, chan, prompt, passwd):
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        fd = chan.fileno()
+        loop.add_reader(fd, ready.set)
+        out, err = bytearray(), bytearray()
+        prompt = prompt.encode() if prompt is not None else None
+        try:
+            while True:
+                while chan.recv_ready():
+                    out += chan.recv(32768)
+                while chan.recv_stderr_ready():
+                    err += chan.recv_stderr(32768)
+
+                if prompt is not None and prompt in err:
+                    # sudo is asking for the password. If it asks twice,
+                    # the password was wrong and we let sudo give up.
+                    err = err.replace(prompt, b'', 1)
+                    if passwd is not None:
+                        chan.sendall("{}\n".format(passwd).encode())
+                        passwd = None
+                    else:
+                        chan.shutdown_write()
+
+                pending = chan.recv_ready() or chan.recv_stderr_ready()
+                if (chan.eof_received or chan.closed) and not pending:
+                    break
+                ready.clear()
+                if chan.recv_ready() or chan.recv_stderr_ready():
+                    continue
+                if chan.eof_received or chan.closed:
+                    continue
+                await ready.wait()
+        finally:
+            loop.remove_reader(fd)
+        return bytes(out), bytes(err)
+
+class AsyncLocalHandler(_AsyncHandler):
+    """
+    A command handler that executes commands on the local system from
+    asyncio code.
+    """
+
+    async def do(self, cmd, **kwargs):
+        """
+        Run a single command as the current user
+
+        :param str cmd: the command to run, including arguments
+        :return: a tuple of return code, stdout, stderr
+        :rtype: tuple
+        """
+        args = shlex.split(cmd)
+        try:
+            p = await asyncio.create_subprocess_exec(*args,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE)
+        except FileNotFoundError:
+            raise NoSuchCommand(args[0])
+        out, err = await p.communicate()
+        return p.returncode, out.decode().splitlines(), \
+                err.decode().splitlines()
+
+    async def sudo(self, cmd, **kwargs):
+        """
+        Invoke a single command as the specified user (the default is
+        root).
+
+        :param str cmd: the command-line to execute.
+        :return: a tuple consisting of the exit code of the command,
+            stdout and stderr
+        :rtype: tuple
+        """
+        if 'user' in kwargs:
+            cmd = "sudo -S -p '' -u {} {}".format(kwargs['user'], cmd)
+        else:
+            cmd = "sudo -S -p '' {}".format(cmd)
+
+        if 'passwd' in kwargs:
+            passwd = kwargs['passwd']
+        elif hasattr(self, 'passwd'):
+            passwd = self.passwd
+        else:
+            passwd = None
+
+        args = shlex.split(cmd)
+        p = await asyncio.create_subprocess_exec(*args,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+        if passwd is not None:
+            out, err = await p.communicate("{}\n".format(passwd).encode())
+        else:
+            out, err = await p.communicate()
+        return p.returncode, out.decode().splitlines(), \
+                err.decode().splitlines()
+
+    async def copy(self, src, dest, **kwargs):
+        """
+        Copies a file.
+
+        :param str src: the file to copy
+        :param str dest: the location to copy to.
+        :return tuple: the exit code (``int``), stdout (``list``) and
+            stderr (``list``)
+        """
+        cmd = "cp {} {}".format(src, dest)
+        if 'sudo' in kwargs and kwargs['sudo'] == True:
+            return await self.sudo(cmd, **kwargs)
+        else:
+            return await self.do(cmd, **kwargs)
@@ -0,0 +1,302 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+Command batching.
+
+Every call to :meth:`~pigrizia.command.handler.Handler.do` costs one
+round-trip (a new SSH channel or a new process). A batch queues commands
+instead, and sends them all as one shell script when the batch is run.
+The output of the script is then split up again, so that every command
+gets its own exit code, stdout and stderr.
+
+    >>> with handler.batch() as b:
+    ...     hosts = b.do("cat /etc/hosts")
+    ...     tmp = b.do("test -d /tmp")
+    >>> hosts.out
+    ['127.0.0.1 localhost', ...]
+    >>> tmp.ret
+    0
+
+Every queued command is run in a subshell with stdin redirected from
+``/dev/null``, so a command cannot change the directory or environment of
+the commands that follow it.
+"""
+
+import shlex
+import secrets
+from . import NoSuchCommand
+
+class NotRun(Exception):
+    """
+    Raised when the result of a queued command is used before the batch
+    it belongs to has been run.
+    """
+    pass
+
+class Deferred:
+    """
+    The result of a command queued in a batch. The attributes are filled
+    in when the batch is run.
+
+    :ivar str cmd: the command
+    :ivar bool sudo: True if the command is run using sudo
+    :ivar int ret: the exit code of the command
+    :ivar list out: the lines written to stdout
+    :ivar list err: the lines written to stderr
+    """
+
+    def __init__(self, cmd, sudo=False, parse=None, kwargs=None):
+        self.cmd = cmd
+        self.sudo = sudo
+        self.ret = None
+        self.out = []
+        self.err = []
+        self._parse = parse
+        # The keyword arguments for the handler, such as passwd.
+        self._kwargs = kwargs or {}
+
+    @property
+    def done(self):
+        """
+        True once the batch this command belongs to has been run.
+        """
+        return self.ret is not None
+
+    @property
+    def value(self):
+        """
+        Gets the result of the command. If the command was queued with a
+        *parse* function, this is what that function returns when given
+        the exit code, stdout and stderr. Otherwise it is a tuple of those
+        three, just like :meth:`~pigrizia.command.handler.Handler.do`
+        returns.
+
+        :raises NotRun: if the batch has not been run yet
+        :raises NoSuchCommand: if the command could not be found
+        """
+        if not self.done:
+            raise NotRun(self.cmd)
+        if self.ret == 127:
+            raise NoSuchCommand(shlex.split(self.cmd)[0])
+        if self._parse is not None:
+            return self._parse(self.ret, self.out, self.err)
+        return self.ret, self.out, self.err
+
+    def __iter__(self):
+        # Allows: ret, out, err = deferred
+        return iter(self.value)
+
+    def __repr__(self):
+        return "Deferred({!r}, ret={!r})".format(self.cmd, self.ret)
+
+class Batch:
+    """
+    A queue of commands that are sent to a handler in one go. Don't
+    create this directly, use
+    :meth:`~pigrizia.command.handler.Handler.batch`.
+
+    If *sudo* is True, every command in the batch is run using sudo.
+    Otherwise, commands queued with :meth:`sudo` are sent in a second
+    script. Any other keyword arguments (such as *user* and *passwd*) are
+    passed on to the handler. They can also be given when a command is
+    queued; commands with different arguments are sent in different
+    scripts.
+
+    Very large batches are split into several scripts, since the kernel
+    limits the length of a single command-line argument.
+    """
+
+    # Linux doesn't accept single arguments larger than 128 KiB.
+    max_script = 96 * 1024
+
+    def __init__(self, handler, **kwargs):
+        self.handler = handler
+        self._sudo = 'sudo' in kwargs and kwargs.pop('sudo') is True
+        self._kwargs = kwargs
+        self._queue = []
+
+    def do(self, cmd, **kwargs):
+        """
+        Queues a command to run as the current user (unless the whole
+        batch is run using sudo).
+
+        :param str cmd: the command to run, including arguments
+        :rtype: :class:`Deferred`
+        """
+        return self.call(cmd, **kwargs)
+
+    def sudo(self, cmd, **kwargs):
+        """
+        Queues a command to run using sudo.
+
+        :param str cmd: the command to run, including arguments
+        :rtype: :class:`Deferred`
+        """
+        kwargs['sudo'] = True
+        return self.call(cmd, **kwargs)
+
+    def call(self, cmd, parse=None, **kwargs):
+        """
+        Queues a command.
+
+        :param str cmd: the command to run, including arguments
+        :param callable parse: a function that is called with the exit
+            code, stdout and stderr of the command to get its
+            :attr:`Deferred.value`
+        :param bool sudo: if True the command will be run using sudo
+        :rtype: :class:`Deferred`
+
+        Any other keyword arguments are passed on to the handler, on top
+        of the ones of the batch.
+        """
+        sudo = kwargs.pop('sudo', False) is True or self._sudo
+        deferred = Deferred(cmd, sudo, parse, dict(self._kwargs, **kwargs))
+        self._queue.append(deferred)
+        return deferred
+
+    def run(self):
+        """
+        Sends all queued commands to the handler and fills in the
+        results. This is called automatically when a ``with`` block ends
+        without an exception.
+
+        :return: the results, in the order the commands were queued
+        :rtype: list
+        """
+        queue, self._queue = self._queue, []
+        for sudo in (False, True):
+            for kwargs, commands in self._groups(
+                    [d for d in queue if d.sudo == sudo]):
+                for chunk in self._chunks(commands):
+                    self._run_script(chunk, sudo, kwargs)
+        return queue
+
+    def _groups(self, commands):
+        # Groups the commands by the arguments for the handler, in the
+        # order they were first seen. The arguments aren't necessarily
+        # hashable, so they are compared one by one.
+        groups = []
+        for deferred in commands:
+            for kwargs, group in groups:
+                if kwargs == deferred._kwargs:
+                    group.append(deferred)
+                    break
+            else:
+                groups.append((deferred._kwargs, [deferred]))
+        return groups
+
+    def _chunks(self, commands):
+        chunk, size = [], 0
+        for deferred in commands:
+            if chunk and size + len(deferred.cmd) > self.max_script:
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(deferred)
+            size += len(deferred.cmd) + 100
+        if chunk:
+            yield chunk
+
+    def _run_script(self, chunk, sudo, kwargs):
+        token = "--pigrizia-{}--".format(secrets.token_hex(8))
+        script = make_script([d.cmd for d in chunk], token)
+        cmd = "sh -c {}".format(shlex.quote(script))
+        if sudo:
+            ret, out, err = self.handler.sudo(cmd, **kwargs)
+        else:
+            ret, out, err = self.handler.do(cmd, **kwargs)
+
+        results = split_output(out or [], err or [], token)
+        for index, deferred in enumerate(chunk):
+            if index in results:
+                deferred.ret, deferred.out, deferred.err = results[index]
+            else:
+                # The script never got to this command (sudo refused to
+                # run it, for instance).
+                deferred.ret = ret if ret else 1
+                deferred.out = []
+                deferred.err = list(err or [])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.run()
+        return False
+
+def make_script(commands, token):
+    """
+    Builds a shell script that runs the given commands one after the
+    other. After each command, a line consisting of the token, the index
+    of the command and its exit code is written to stdout and a line with
+    the token and the index is written to stderr.
+
+    :param list commands: the commands
+    :param str token: a string that does not appear in any output
+    :rtype: str
+    """
+    lines = []
+    for index, cmd in enumerate(commands):
+        lines.append("( eval {} ) </dev/null".format(shlex.quote(cmd)))
+        lines.append("printf '\\n{0} {1} %d\\n' $?".format(token, index))
+        lines.append("printf '\\n{0} {1}\\n' >&2".format(token, index))
+    return '\n'.join(lines)
+
+def split_output(out, err, token):
+    """
+    Splits the output of a script built by :func:`make_script` into the
+    output of the individual commands.
+
+    :param list out: the lines the script wrote to stdout
+    :param list err: the lines the script wrote to stderr
+    :param str token: the token passed to :func:`make_script`
+    :return: a dictionary of command indexes to tuples of exit code,
+        stdout and stderr
+    :rtype: dict
+    """
+    results = {}
+    for fields, lines in split_marked(out, token):
+        index, ret = int(fields[0]), int(fields[1])
+        results[index] = (ret, lines, [])
+    last = None
+    for fields, lines in split_marked(err, token, leftover=True):
+        index = int(fields[0]) if fields is not None else last
+        if index in results:
+            results[index][2].extend(lines)
+        last = index
+    return results
+
+def split_marked(lines, token, leftover=False):
+    """
+    Splits lines of output at the lines that contain the token.
+
+    Every marker line is preceded by an empty line written by the script,
+    so that the marker always starts on a line of its own. That empty line
+    is not part of the output of the command.
+
+    :param list lines: the lines of output
+    :param str token: the token that marks the end of a section
+    :param bool leftover: if True, any lines after the last marker are
+        yielded with None as the fields
+    :return: yields tuples of the fields following the token (as a list)
+        and the lines of the section
+    """
+    section = []
+    for line in lines:
+        pos = line.find(token)
+        if pos < 0:
+            section.append(line)
+            continue
+        if pos > 0 and line[:pos].strip():
+            # The command didn't end its output with a newline.
+            section.append(line[:pos])
+        elif section and section[-1] == '':
+            section.pop()
+        yield line[pos + len(token):].split(), section
+        section = []
+    if leftover and section:
+        yield None, section
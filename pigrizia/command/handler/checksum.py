@@ -0,0 +1,99 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+Checksums used to verify file transfers.
+
+Every algorithm is available both in :mod:`hashlib`, so local data can be
+hashed in-process, and as a coreutils command, so the same checksum can be
+computed on the remote host.
+
+The algorithm is picked with the *hash* keyword argument of the methods
+that take one. Without it, the ``hash`` key of the host in ``hosts.conf``
+is used, and if that isn't set either, :data:`default_algorithm`.
+
+    [web1]
+    addr = "10.0.0.5"
+    hash = "blake2b"
+"""
+
+import hashlib
+
+# The hashlib constructors and the matching coreutils commands. b2sum
+# computes BLAKE2b-512, which is also the hashlib default.
+algorithms = {
+    'sha512': (hashlib.sha512, 'sha512sum'),
+    'sha256': (hashlib.sha256, 'sha256sum'),
+    'blake2b': (hashlib.blake2b, 'b2sum'),
+}
+
+default_algorithm = 'sha512'
+
+class UnknownAlgorithm(Exception):
+    """
+    Raised when an unsupported checksum algorithm is asked for.
+    """
+    pass
+
+def new(algorithm=default_algorithm):
+    """
+    Creates a hashlib object for the algorithm.
+
+    :param str algorithm: the name of the algorithm
+    :raises UnknownAlgorithm: if the algorithm is not supported
+    """
+    return _lookup(algorithm)[0]()
+
+def command(algorithm=default_algorithm):
+    """
+    Gets the command that computes the checksum on a Linux host.
+
+    :param str algorithm: the name of the algorithm
+    :rtype: str
+    :raises UnknownAlgorithm: if the algorithm is not supported
+    """
+    return _lookup(algorithm)[1]
+
+def file_checksum(path, algorithm=default_algorithm, chunk_size=65536):
+    """
+    Computes the checksum of a local file, reading it in chunks.
+
+    :param str path: the file
+    :param str algorithm: the name of the algorithm
+    :return: the checksum as a hexadecimal string
+    :rtype: str
+    """
+    h = new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def select_algorithm(kwargs, addr=None):
+    """
+    Picks the algorithm for a call: the *hash* keyword argument if given,
+    otherwise the setting for the host with address *addr*, otherwise the
+    default.
+
+    :param dict kwargs: the keyword arguments of the call
+    :param str addr: the address of the host
+    :rtype: str
+    :raises UnknownAlgorithm: if the algorithm is not supported
+    """
+    if 'hash' in kwargs and kwargs['hash'] is not None:
+        algorithm = kwargs['hash']
+    elif addr is not None:
+        from pigrizia.host.config import HostConfig
+        algorithm = HostConfig(addr).get('hash', default_algorithm)
+    else:
+        algorithm = default_algorithm
+    _lookup(algorithm)
+    return algorithm
+
+def _lookup(algorithm):
+    if algorithm not in algorithms:
+        raise UnknownAlgorithm(algorithm)
+    return algorithms[algorithm]
@@ -0,0 +1,237 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+Delta transfers, in the style of rsync.
+
+When a file already exists on the remote host and has only changed a
+little, most of it doesn't need to be sent again:
+
+1. The remote host splits the old file into blocks and sends back a weak
+   (Adler-32) and a strong (BLAKE2b) checksum of every block
+   (:data:`signature_script`).
+2. The weak checksum of every window of the new file is computed with a
+   rolling checksum. Where it matches a block, the strong checksum
+   decides if the block can be reused (:func:`write_delta`).
+3. The delta, a list of blocks to reuse and literal data, is sent to the
+   remote host, which builds the new file from it and the old file
+   (:data:`patch_script`).
+
+The remote side runs with ``python3``. Use it through
+:meth:`~pigrizia.command.handler.remote.RemoteHandler.copy` with
+``delta=True``.
+"""
+
+import struct
+import zlib
+import hashlib
+
+# Adler-32 works modulo this.
+_mod = 65521
+
+# Literal data is sent in pieces of at most this size.
+max_literal = 1024 * 1024
+
+# Prints the size of a file and then the weak and strong checksum of
+# every block. Exits with 2 if the file doesn't exist.
+signature_script = '''
+import sys, zlib, hashlib
+path, size = sys.argv[1], int(sys.argv[2])
+try:
+    f = open(path, 'rb')
+except FileNotFoundError:
+    sys.exit(2)
+with f:
+    f.seek(0, 2)
+    print(f.tell())
+    f.seek(0)
+    for block in iter(lambda: f.read(size), b''):
+        strong = hashlib.blake2b(block, digest_size=16).hexdigest()
+        print(zlib.adler32(block), strong)
+'''
+
+# Builds a new file from an old file and a delta. Usage: old delta new
+# block-size.
+patch_script = '''
+import sys, struct
+old, delta, new, size = sys.argv[1:4] + [int(sys.argv[4])]
+def copy(src, dst, n):
+    while n > 0:
+        chunk = src.read(min(n, 1 << 20))
+        if not chunk:
+            break
+        dst.write(chunk)
+        n -= len(chunk)
+with open(old, 'rb') as o, open(delta, 'rb') as d, open(new, 'wb') as w:
+    while True:
+        op = d.read(1)
+        if not op:
+            break
+        if op == b'C':
+            index, count = struct.unpack('>II', d.read(8))
+            o.seek(index * size)
+            copy(o, w, count * size)
+        elif op == b'L':
+            n, = struct.unpack('>I', d.read(4))
+            copy(d, w, n)
+        else:
+            sys.exit('bad delta')
+'''
+
+def block_size(length):
+    """
+    Picks the block size for a file of the given length. Like rsync, this
+    is roughly the square root of the length, within limits.
+
+    :param int length: the length of the file in bytes
+    :rtype: int
+    """
+    size = int(length ** 0.5) // 8 * 8
+    return max(700, min(size, 128 * 1024))
+
+def strong_checksum(block):
+    """
+    Computes the strong checksum of a block.
+
+    :rtype: str
+    """
+    return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+class Signatures:
+    """
+    The checksums of the blocks of the old file, as printed by
+    :data:`signature_script`.
+
+    :ivar int length: the length of the old file
+    :ivar int size: the block size
+    """
+
+    def __init__(self, lines, size):
+        self.size = size
+        self.length = int(lines[0])
+        self._blocks = {}
+        self._tail = None
+        count = len(lines) - 1
+        tail = self.length - (count - 1) * size if count else 0
+        for index, line in enumerate(lines[1:]):
+            weak, strong = line.split()
+            if index == count - 1 and tail < size:
+                # The last block is shorter, and can only match at the
+                # end of the new file.
+                self._tail = (index, tail, int(weak), strong)
+                continue
+            candidates = self._blocks.setdefault(int(weak), {})
+            candidates.setdefault(strong, index)
+
+    def find(self, weak, data, pos):
+        """
+        Finds a full block. The strong checksum is only computed if the
+        weak checksum matches.
+
+        :param int weak: the Adler-32 checksum of the block
+        :param data: the new file
+        :param int pos: where the block starts in *data*
+        :return: the index of the block in the old file, or None
+        """
+        candidates = self._blocks.get(weak)
+        if candidates is None:
+            return None
+        block = data[pos:pos + self.size]
+        return candidates.get(strong_checksum(block))
+
+    def find_tail(self, block):
+        """
+        Checks if the end of the new file is the same as the (short) last
+        block of the old file.
+
+        :return: the index of the last block, or None
+        """
+        if self._tail is None:
+            return None
+        index, length, weak, strong = self._tail
+        if len(block) != length or zlib.adler32(block) != weak:
+            return None
+        return index if strong_checksum(block) == strong else None
+
+    @property
+    def tail_length(self):
+        return self._tail[1] if self._tail is not None else 0
+
+class _Encoder:
+    # Writes the operations of a delta, merging runs of blocks.
+
+    def __init__(self, write):
+        self._write = write
+        self._run = None
+        self.literal = 0
+
+    def copy(self, index):
+        if self._run is not None and sum(self._run) == index:
+            self._run[1] += 1
+            return
+        self.flush()
+        self._run = [index, 1]
+
+    def data(self, data, start, end):
+        if start >= end:
+            return
+        self.flush()
+        self.literal += end - start
+        for pos in range(start, end, max_literal):
+            piece = data[pos:min(end, pos + max_literal)]
+            self._write(b'L' + struct.pack('>I', len(piece)))
+            self._write(piece)
+
+    def flush(self):
+        if self._run is not None:
+            self._write(b'C' + struct.pack('>II', *self._run))
+            self._run = None
+
+def write_delta(data, signatures, write):
+    """
+    Computes the delta that turns the old file into *data*.
+
+    :param data: the new file (``bytes``, or an ``mmap`` of the file)
+    :param signatures: the checksums of the old file
+    :type signatures: :class:`Signatures`
+    :param callable write: called with every piece of the delta
+    :return: the number of bytes that had to be sent literally
+    :rtype: int
+    """
+    size = signatures.size
+    enc = _Encoder(write)
+    length = len(data)
+    pos = start = 0
+    a = b = None
+    while pos + size <= length:
+        if a is None:
+            weak = zlib.adler32(data[pos:pos + size])
+            a, b = weak & 0xffff, weak >> 16
+        index = signatures.find((b << 16) | a, data, pos)
+        if index is not None:
+            enc.data(data, start, pos)
+            enc.copy(index)
+            pos += size
+            start = pos
+            a = None
+            continue
+        if pos + size < length:
+            # Roll the window one byte forward.
+            out, new = data[pos], data[pos + size]
+            a = (a - out + new) % _mod
+            b = (b - size * out + a - 1) % _mod
+        pos += 1
+
+    tail = signatures.tail_length
+    if tail and length - tail >= start:
+        index = signatures.find_tail(data[length - tail:])
+        if index is not None:
+            enc.data(data, start, length - tail)
+            enc.copy(index)
+            start = length
+    enc.data(data, start, length)
+    enc.flush()
+    return enc.literal
@@ -4,11 +4,17 @@
 # license that can be found in the LICENSE file or at
 # https://opensource.org/licenses/MIT.
 
+import os
 import time
+import shutil
+import secrets
+import tempfile
 from subprocess import Popen, PIPE
 import pexpect
 import shlex
-from . import Handler, NoSuchCommand
+from . import Handler, NoSuchCommand, _staged_command
+from .stream import LocalStream, stream_options
+from .session import LocalSession
 
 class LocalHandler(Handler):
     """
@@ -27,6 +33,12 @@ class LocalHandler(Handler):
         :return: a tuple of return code, stdout, stderr
         :rtype: tuple
         """
+        if self._use_session:
+            ret, out, err = self.interact().run(cmd)
+            if ret == 127:
+                raise NoSuchCommand(shlex.split(cmd)[0])
+            return ret, out, err
+
         args = shlex.split(cmd)
         try:
             with Popen(args, stdout=PIPE, stderr=PIPE) as p:
@@ -51,11 +63,17 @@ class LocalHandler(Handler):
             stdout and stderr
         :rtype: tuple
         """
+        if self._use_session and 'user' not in kwargs:
+            kwargs['sudo'] = True
+            return self.interact(**kwargs).run(cmd)
 
+        # The prompt is taken out of stderr afterwards.
+        prompt = "[pigrizia-sudo-{}]".format(secrets.token_hex(8))
         if 'user' in kwargs:
-            cmd = "sudo -Su {} {}".format(kwargs['user'], cmd)
+            cmd = "sudo -S -p {} -u {} {}".format(shlex.quote(prompt),
+                    kwargs['user'], cmd)
         else:
-            cmd = "sudo -S {}".format(cmd)
+            cmd = "sudo -S -p {} {}".format(shlex.quote(prompt), cmd)
 
         if 'passwd' in kwargs:
             passwd = kwargs['passwd']
@@ -72,10 +90,61 @@ class LocalHandler(Handler):
             else:
                 out, err = p.communicate()
 
+        if err:
+            err = err.replace(prompt.encode(), b'')
         out = out.decode().splitlines() if out else []
         err = err.decode().splitlines() if err else []
         return p.returncode, out, err
 
+    def do_stream(self, cmd, **kwargs):
+        """
+        Run a single command as the current user, streaming its output.
+
+        :param str cmd: the command to run, including arguments
+        :param bool binary: if True, the stream yields chunks of bytes
+            instead of lines
+        :param int chunk_size: the largest chunk read at a time
+        :return: the output of the command
+        :rtype: :class:`~pigrizia.command.handler.stream.Stream`
+        """
+        args = shlex.split(cmd)
+        try:
+            p = Popen(args, stdout=PIPE, stderr=PIPE)
+        except FileNotFoundError as e:
+            raise NoSuchCommand(args[0])
+        return LocalStream(cmd, p, **stream_options(kwargs))
+
+    def sudo_stream(self, cmd, **kwargs):
+        """
+        Invoke a single command as the specified user (the default is
+        root), streaming its output. See :meth:`do_stream`.
+
+        :param str cmd: the command-line to execute.
+        :rtype: :class:`~pigrizia.command.handler.stream.Stream`
+        """
+        # A prompt that can't be mistaken for output, so that the stream
+        # can take it out of stderr.
+        prompt = "[pigrizia-sudo-{}]".format(secrets.token_hex(8))
+        if 'user' in kwargs:
+            cmd = "sudo -S -p {} -u {} {}".format(shlex.quote(prompt),
+                    kwargs['user'], cmd)
+        else:
+            cmd = "sudo -S -p {} {}".format(shlex.quote(prompt), cmd)
+
+        if 'passwd' in kwargs:
+            passwd = kwargs['passwd']
+        elif hasattr(self, 'passwd'):
+            passwd = self.passwd
+        else:
+            passwd = None
+
+        args = shlex.split(cmd)
+        p = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        if passwd is not None:
+            p.stdin.write("{}\n".format(passwd).encode())
+        p.stdin.close()
+        return LocalStream(cmd, p, prompt=prompt, **stream_options(kwargs))
+
     def copy(self, src, dest, **kwargs):
         """
         Copies a file.
@@ -91,5 +160,147 @@ class LocalHandler(Handler):
         else:
             return self.do(cmd, **kwargs)
 
-    def interact(self, script, **kwargs):
-        pass
+    def write(self, dest, data, **kwargs):
+        """
+        Writes a file. The data is written to a temporary file next to
+        the destination, which is then renamed into place. The mode of an
+        existing destination is kept.
+
+        With sudo, the temporary file is created in the temporary
+        directory and put in place with ``cp`` and ``mv`` using sudo.
+
+        :param str dest: the file to write
+        :param bytes data: the content of the file
+        :param bool sudo: if True, the file is put in place using sudo
+        :return tuple: the exit code (``int``), stdout (``list``) and
+            stderr (``list``)
+        """
+        sudo = 'sudo' in kwargs and kwargs['sudo'] is True
+        head, tail = os.path.split(dest)
+        if sudo:
+            fd, tmp = tempfile.mkstemp(prefix='.pigrizia-')
+        else:
+            fd, tmp = tempfile.mkstemp(dir=head or '.',
+                    prefix='.{}.pigrizia-'.format(tail))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+            if sudo:
+                stage = os.path.join(head, os.path.basename(tmp))
+                script = "cp {tmp} {stage} && "
+                script += "{{ chmod --reference={dest} {stage}; "
+                script += "chown --reference={dest} {stage}; }} "
+                script += "2>/dev/null; mv -f {stage} {dest}"
+                script = script.format(tmp=shlex.quote(tmp),
+                        stage=shlex.quote(stage), dest=shlex.quote(dest))
+                return self.sudo("sh -c {}".format(shlex.quote(script)),
+                        **kwargs)
+
+            if os.path.exists(dest):
+                shutil.copymode(dest, tmp)
+            os.replace(tmp, dest)
+            return 0, [], []
+        except OSError as e:
+            return 1, [], [str(e)]
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def pipe(self, cmd, produce, **kwargs):
+        """
+        Run a single command, feeding it data on stdin. *produce* is
+        called with a file object, and everything it writes is passed on
+        to the command.
+
+        With sudo, stdin is needed for the password, so the data is
+        written to a temporary file first and the command reads it from
+        there.
+
+        :param str cmd: the command to run, including arguments
+        :param callable produce: writes the input of the command
+        :param bool sudo: if True, the command is run using sudo
+        :return: a tuple of return code, stdout, stderr
+        :rtype: tuple
+        """
+        if 'sudo' in kwargs and kwargs['sudo'] is True:
+            fd, staged = tempfile.mkstemp(prefix='.pigrizia-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    produce(f)
+                return self.sudo(_staged_command(cmd, staged), **kwargs)
+            finally:
+                if os.path.exists(staged):
+                    os.remove(staged)
+
+        args = shlex.split(cmd)
+        # The output goes to files, so the command can never block on a
+        # full pipe while we are still writing.
+        with tempfile.TemporaryFile() as out, \
+                tempfile.TemporaryFile() as err:
+            try:
+                p = Popen(args, stdin=PIPE, stdout=out, stderr=err)
+            except FileNotFoundError as e:
+                raise NoSuchCommand(args[0])
+            try:
+                produce(p.stdin)
+                p.stdin.close()
+            except BrokenPipeError:
+                pass
+            p.wait()
+            out.seek(0)
+            err.seek(0)
+            return p.returncode, out.read().decode().splitlines(), \
+                    err.read().decode().splitlines()
+
+    def read(self, path, **kwargs):
+        """
+        Reads a whole file.
+
+        :param str path: the file to read
+        :return: the content of the file
+        :rtype: bytes
+        :raises FileNotFoundError: if the file does not exist
+        """
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def read_chunks(self, path, chunk_size=65536, **kwargs):
+        """
+        Reads a file a chunk at a time.
+
+        :param str path: the file to read
+        :param int chunk_size: the largest chunk to return at a time
+        :return: yields the chunks of the file
+        :raises FileNotFoundError: if the file does not exist
+        """
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+
+    def read_into(self, path, buffer, **kwargs):
+        """
+        Reads a file into a buffer, without any intermediate copies.
+        Reading stops at the end of the file or when the buffer is full.
+
+        :param str path: the file to read
+        :param buffer: a writable buffer, such as a ``bytearray`` or a
+            ``memoryview``
+        :return: the number of bytes read
+        :rtype: int
+        :raises FileNotFoundError: if the file does not exist
+        """
+        view = memoryview(buffer).cast('B')
+        pos = 0
+        with open(path, 'rb', buffering=0) as f:
+            while pos < len(view):
+                n = f.readinto(view[pos:])
+                if not n:
+                    break
+                pos += n
+        return pos
+
+    def _new_session(self, sudo, passwd):
+        return LocalSession(sudo=sudo, passwd=passwd)
@@ -0,0 +1,239 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+A process-wide pool of SSH connections.
+
+Setting up an SSH connection (key exchange and authentication) is by far
+the most expensive part of talking to a remote host. Since a single
+Paramiko transport can carry many channels at the same time, there is no
+reason for every :class:`~pigrizia.command.handler.remote.RemoteHandler`
+to have a connection of its own. Instead, handlers borrow connections
+from this pool, which is keyed by address, user and authentication
+method.
+
+    >>> from pigrizia.command.handler.pool import pool
+    >>> ssh = pool.acquire('192.168.0.10', 'lorenzo', passwd=passwd)
+    >>> ssh.exec_command('uptime')
+    >>> pool.release(ssh)
+
+Connections that have been idle for longer than *idle_timeout* seconds
+are closed the next time the pool is used (or when :meth:`evict_idle` is
+called).
+"""
+
+import time
+import hashlib
+import threading
+import paramiko
+
+import logging
+logger = logging.getLogger(__name__)
+
+class PoolExhausted(Exception):
+    """
+    Raised when no connection could be handed out within the timeout.
+    """
+    pass
+
+class _Connection:
+    """
+    Book-keeping for one pooled connection.
+    """
+
+    def __init__(self, key, ssh):
+        self.key = key
+        self.ssh = ssh
+        self.users = 0
+        self.last_used = time.monotonic()
+
+    @property
+    def alive(self):
+        transport = self.ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def close(self):
+        try:
+            self.ssh.close()
+        except Exception:
+            pass
+
+class ConnectionPool:
+    """
+    A thread-safe pool of SSH connections.
+
+    :param int max_per_host: the maximum number of connections opened to
+        the same host with the same credentials
+    :param int max_sessions: the number of handlers that can share one
+        connection before the pool opens another one
+    :param float idle_timeout: the number of seconds an unused connection
+        is kept open
+    :param float timeout: the number of seconds :meth:`acquire` waits for
+        a connection to a host that is at *max_per_host*
+    """
+
+    def __init__(self, max_per_host=4, max_sessions=8, idle_timeout=300,
+            timeout=60):
+        self.max_per_host = max_per_host
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._conns = {}
+        self._by_client = {}
+        self._opening = {}
+        self._cond = threading.Condition()
+
+    def acquire(self, addr, user, **kwargs):
+        """
+        Gets a live connection to a host, opening one if needed.
+
+        :param str addr: the address of the host
+        :param str user: the user to log in as
+        :param str passwd: the password (optional, if key-based SSH is
+            used)
+        :return: a connected client
+        :rtype: paramiko.SSHClient
+        :raises PoolExhausted: if the host is at *max_per_host* and no
+            connection could be shared within the timeout
+        """
+        key = self._key(addr, user, **kwargs)
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            self._evict(time.monotonic())
+            while True:
+                conns = self._conns.setdefault(key, [])
+                self._drop_dead(conns)
+                free = [c for c in conns if c.users < self.max_sessions]
+                if free:
+                    conn = min(free, key=lambda c: c.users)
+                    conn.users += 1
+                    return conn.ssh
+
+                opening = self._opening.get(key, 0)
+                if len(conns) + opening < self.max_per_host:
+                    self._opening[key] = opening + 1
+                    break
+
+                if conns:
+                    # Every connection is as busy as we want it to be, but
+                    # transports multiplex channels, so sharing the least
+                    # busy one beats waiting.
+                    conn = min(conns, key=lambda c: c.users)
+                    conn.users += 1
+                    return conn.ssh
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolExhausted(addr)
+                self._cond.wait(remaining)
+
+        # The handshake is done outside the lock, so that connecting to
+        # one host does not hold up the others.
+        try:
+            ssh = self._connect(addr, user, **kwargs)
+        finally:
+            with self._cond:
+                self._opening[key] -= 1
+                self._cond.notify_all()
+
+        with self._cond:
+            conn = _Connection(key, ssh)
+            conn.users = 1
+            self._conns.setdefault(key, []).append(conn)
+            self._by_client[id(ssh)] = conn
+            return ssh
+
+    def release(self, ssh):
+        """
+        Gives a connection back to the pool. The connection is kept open
+        so that it can be handed out again.
+
+        :param paramiko.SSHClient ssh: a client returned by :meth:`acquire`
+        """
+        with self._cond:
+            conn = self._by_client.get(id(ssh))
+            if conn is None:
+                return
+            conn.users = max(conn.users - 1, 0)
+            conn.last_used = time.monotonic()
+            self._cond.notify_all()
+
+    def discard(self, ssh):
+        """
+        Removes a connection from the pool and closes it. Use this if the
+        connection is known to be broken.
+
+        :param paramiko.SSHClient ssh: a client returned by :meth:`acquire`
+        """
+        with self._cond:
+            conn = self._by_client.pop(id(ssh), None)
+            if conn is not None:
+                self._conns[conn.key].remove(conn)
+                self._cond.notify_all()
+        ssh.close()
+
+    def evict_idle(self):
+        """
+        Closes connections that have not been used for *idle_timeout*
+        seconds.
+        """
+        with self._cond:
+            self._evict(time.monotonic())
+
+    def close_all(self):
+        """
+        Closes every connection in the pool.
+        """
+        with self._cond:
+            conns = [c for cs in self._conns.values() for c in cs]
+            self._conns.clear()
+            self._by_client.clear()
+            self._cond.notify_all()
+        for conn in conns:
+            conn.close()
+
+    def _evict(self, now):
+        for conns in self._conns.values():
+            for conn in list(conns):
+                idle = now - conn.last_used
+                if conn.users == 0 and idle >= self.idle_timeout:
+                    logger.debug("closing idle connection to {}".format(
+                        conn.key[0]))
+                    self._remove(conns, conn)
+
+    def _drop_dead(self, conns):
+        for conn in list(conns):
+            if not conn.alive:
+                logger.info("dropping dead connection to {}".format(
+                    conn.key[0]))
+                self._remove(conns, conn)
+
+    def _remove(self, conns, conn):
+        conns.remove(conn)
+        self._by_client.pop(id(conn.ssh), None)
+        conn.close()
+
+    def _connect(self, addr, user, **kwargs):
+        logger.debug("connecting to {}@{}".format(user, addr))
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        # TODO: check if connection fails
+        if kwargs.get('passwd') is not None:
+            ssh.connect(addr, username=user, password=kwargs['passwd'])
+        else:
+            ssh.connect(addr, username=user)
+        return ssh
+
+    def _key(self, addr, user, **kwargs):
+        # The password itself is never kept in the key, but two handlers
+        # with different passwords must not share a connection.
+        if kwargs.get('passwd') is not None:
+            auth = hashlib.sha256(kwargs['passwd'].encode()).hexdigest()
+        else:
+            auth = None
+        return addr, user, auth
+
+pool = ConnectionPool()
@@ -4,14 +4,21 @@
 # license that can be found in the LICENSE file or at
 # https://opensource.org/licenses/MIT.
 
-import time
+import os
+import mmap
+import logging
 import re
+import secrets
 from getpass import getuser
 import shlex
 import paramiko
-from scp import SCPClient, SCPException
-from pigrizia.host import get_host
-from . import Handler, NoSuchCommand
+from . import Handler, NoSuchCommand, _staged_command
+from .pool import pool, ConnectionPool
+from .stream import RemoteStream, STDOUT, stream_options
+from .session import RemoteSession
+from . import checksum, delta
+
+logger = logging.getLogger(__name__)
 
 class CopyFailed(Exception):
     """
@@ -22,8 +29,16 @@ class RemoteHandler(Handler):
     """
     This is a command handler that executes commands on a remote system
     using Paramiko.
+
+    The SSH connection is borrowed from the process-wide
+    :data:`~pigrizia.command.handler.pool.pool`, so creating several
+    handlers for the same host and user only costs one handshake. Pass
+    ``pool=False`` to get a connection that is not shared.
     """
 
+    ssh = None
+    _sftp = None
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.addr = kwargs['addr']
@@ -33,15 +48,14 @@ class RemoteHandler(Handler):
             # here for now.
             self.passphrase = kwargs['passphrase']
 
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        # TODO: check if connection fails
-        # TODO: quick fix for now. Think of something better.
-        if hasattr(self, 'passwd'):
-            self.ssh.connect(self.addr, username=self.user, 
-                    password=self.passwd)
+        # Connections come from the shared pool, unless the caller
+        # explicitly asks for a private one with pool=False.
+        if 'pool' in kwargs and kwargs['pool'] is False:
+            self._pool = ConnectionPool(idle_timeout=0)
         else:
-            self.ssh.connect(self.addr, username=self.user)
+            self._pool = pool
+        self.ssh = self._pool.acquire(self.addr, self.user,
+                passwd=getattr(self, 'passwd', None))
 
     def do(self, cmd, **kwargs):
         """
@@ -52,6 +66,12 @@ class RemoteHandler(Handler):
             and output to stderr
         :rtype: tuple
         """
+        if self._use_session:
+            ret, out, err = self.interact().run(cmd)
+            if ret == 127:
+                raise NoSuchCommand(shlex.split(cmd)[0])
+            return ret, out, err
+
         stdin, stdout, stderr = self.ssh.exec_command(cmd)
         out = [o.strip() for o in stdout.readlines()]
         err = [e.strip() for e in stderr.readlines()]
@@ -64,15 +84,69 @@ class RemoteHandler(Handler):
         """
         Invoke a singled command as another user (by default root).
 
+        sudo is given a unique prompt, and the password is only sent
+        when that prompt shows up on stderr. If sudo still has the
+        credentials cached, no password is sent and nothing waits for a
+        prompt that never comes.
+
         :param str cmd: the command to run including the arguments
         :return: a tuple consisting of the exit code, output to stdout
             and output to stderr
         :rtype: tuple
         """
+        if self._use_session and 'user' not in kwargs:
+            kwargs['sudo'] = True
+            return self.interact(**kwargs).run(cmd)
+
+        kwargs['binary'] = True
+        stream = self.sudo_stream(cmd, **kwargs)
+        out, err = bytearray(), bytearray()
+        try:
+            for fd, chunk in stream:
+                if fd == STDOUT:
+                    out += chunk
+                else:
+                    err += chunk
+        except NoSuchCommand:
+            # Unlike do, sudo has always just returned the exit code.
+            pass
+
+        out = [o.strip() for o in out.decode().splitlines()]
+        err = [e.strip() for e in err.decode().splitlines()]
+        return stream.ret, out, err
+
+    def do_stream(self, cmd, **kwargs):
+        """
+        Invoke a single command as the current user, streaming its
+        output.
+
+        :param str cmd: the command to run, including arguments
+        :param bool binary: if True, the stream yields chunks of bytes
+            instead of lines
+        :param int chunk_size: the largest chunk read at a time
+        :return: the output of the command
+        :rtype: :class:`~pigrizia.command.handler.stream.Stream`
+        """
+        chan = self.ssh.get_transport().open_session()
+        chan.exec_command(cmd)
+        return RemoteStream(cmd, chan, **stream_options(kwargs))
+
+    def sudo_stream(self, cmd, **kwargs):
+        """
+        Invoke a single command as another user (by default root),
+        streaming its output. See :meth:`do_stream`.
+
+        The password is only sent when sudo asks for it.
+
+        :param str cmd: the command to run including the arguments
+        :rtype: :class:`~pigrizia.command.handler.stream.Stream`
+        """
+        prompt = "[pigrizia-sudo-{}]".format(secrets.token_hex(8))
         if 'user' in kwargs:
-            cmd = "sudo -Su {} {}".format(kwargs['user'], cmd)
+            cmd = "sudo -S -p {} -u {} {}".format(shlex.quote(prompt),
+                    kwargs['user'], cmd)
         else:
-            cmd = "sudo -S {}".format(cmd)
+            cmd = "sudo -S -p {} {}".format(shlex.quote(prompt), cmd)
 
         if 'passwd' in kwargs:
             passwd = kwargs['passwd']
@@ -81,55 +155,332 @@ class RemoteHandler(Handler):
         else:
             passwd = None
 
-        stdin, stdout, stderr = self.ssh.exec_command(cmd)
-        time.sleep(0.1)
-        if passwd is not None:
-            stdin.write("{}\n".format(passwd))
+        chan = self.ssh.get_transport().open_session()
+        chan.exec_command(cmd)
+        return RemoteStream(cmd, chan, prompt=prompt, passwd=passwd,
+                **stream_options(kwargs))
 
-        out = [o.strip() for o in stdout.readlines()]
-        err = [e.strip() for e in stderr.readlines()]
-        if err[0].startswith('[sudo]'):
-            err.pop()
-        ret = stdout.channel.recv_exit_status()
-        return ret, out, err
+    def pipe(self, cmd, produce, **kwargs):
+        """
+        Invoke a single command, feeding it data on stdin. *produce* is
+        called with a file object, and everything it writes is sent to
+        the command as it is written.
+
+        With sudo, stdin is needed for the password, so the data is
+        uploaded to a temporary file first and the command reads it
+        from there.
+
+        :param str cmd: the command to run, including arguments
+        :param callable produce: writes the input of the command
+        :param bool sudo: if True, the command is run using sudo
+        :return: a tuple consisting of the exit code, output to stdout
+            and output to stderr
+        :rtype: tuple
+        """
+        if 'sudo' in kwargs and kwargs['sudo'] is True:
+            staged = "/tmp/.pigrizia-{}".format(secrets.token_hex(8))
+            with self.sftp.open(staged, 'wb') as f:
+                f.set_pipelined(True)
+                f.chmod(0o600)
+                produce(f)
+            return self.sudo(_staged_command(cmd, staged), **kwargs)
+
+        chan = self.ssh.get_transport().open_session()
+        chan.exec_command(cmd)
+        stream = RemoteStream(cmd, chan)
+        try:
+            with chan.makefile('wb') as f:
+                produce(f)
+            chan.shutdown_write()
+        except OSError:
+            # The command ended without reading everything. Its exit
+            # code and stderr tell why.
+            pass
+        out, err = [], []
+        for fd, line in stream:
+            (out if fd == STDOUT else err).append(line.strip())
+        return stream.ret, out, err
 
     def copy(self, src, dest, **kwargs):
         """
-        Copies a file.
+        Copies a local file to the remote host.
+
+        The file is streamed over SFTP and hashed while it is sent, so it
+        is only read once. The copy is verified on the remote host and
+        then renamed into place, like :meth:`write` does.
+
+        With ``delta=True``, only the parts of the file that differ from
+        the existing destination are sent (see
+        :mod:`~pigrizia.command.handler.delta`). If the destination
+        doesn't exist, or ``python3`` isn't available on the remote host,
+        the whole file is sent.
 
         :param str src: the file to copy
         :param str dest: the location to copy to.
+        :param str hash: the checksum algorithm (see
+            :mod:`~pigrizia.command.handler.checksum`)
+        :param bool delta: if True, only send what has changed
+        :param bool sudo: if True, the file is put in place using sudo
         :return tuple: the exit code (``int``), stdout (``list``) and 
             stderr (``list``)
+        :raises CopyFailed: if the checksums of the source and the copy
+            don't match
+        """
+        if 'delta' in kwargs and kwargs['delta'] is True:
+            result = self._copy_delta(src, dest, **kwargs)
+            if result is not None:
+                return result
+        with open(src, 'rb') as f:
+            chunks = iter(lambda: f.read(32768), b'')
+            return self._put(chunks, dest, **kwargs)
+
+    def write(self, dest, data, **kwargs):
+        """
+        Writes a file on the remote host.
+
+        The data is streamed over SFTP into a temporary file next to the
+        destination, while its checksum is computed. A single command
+        then verifies the checksum of the temporary file and renames it
+        into place, so the destination is never seen half-written.
+
+        With sudo, the data is uploaded to a temporary file in ``/tmp``
+        first, and then copied next to the destination and renamed into
+        place using sudo.
+
+        :param str dest: the file to write
+        :param bytes data: the content of the file
+        :param str hash: the checksum algorithm (see
+            :mod:`~pigrizia.command.handler.checksum`)
+        :param str digest: the checksum of *data*, if it is already
+            known
+        :param bool sudo: if True, the file is put in place using sudo
+        :return tuple: the exit code (``int``), stdout (``list``) and
+            stderr (``list``)
+        :raises CopyFailed: if the checksums don't match
         """
-        ret, out, err = self.do("mktemp")
-        tmp = out[0]
-        scp = SCPClient(self.ssh.get_transport())
+        view = memoryview(data)
+        chunks = (view[i:i + 32768] for i in range(0, len(view), 32768))
+        return self._put(chunks, dest, **kwargs)
+
+    def _put(self, chunks, dest, **kwargs):
+        # Uploads the chunks and puts them in place. If the checksum is
+        # already known (digest), the data isn't hashed again.
+        algorithm = checksum.select_algorithm(kwargs, self.addr)
+        digest = kwargs['digest'] if 'digest' in kwargs else None
+        h = checksum.new(algorithm) if digest is None else None
+        sudo = 'sudo' in kwargs and kwargs['sudo'] is True
+        upload = self._upload_name(dest, sudo)
+
+        with self.sftp.open(upload, 'wb') as f:
+            f.set_pipelined(True)
+            if sudo:
+                f.chmod(0o600)
+            for chunk in chunks:
+                if h is not None:
+                    h.update(chunk)
+                f.write(chunk)
+
+        kwargs['hash'] = algorithm
+        kwargs['digest'] = digest or h.hexdigest()
+        return self._install_upload(upload, dest, **kwargs)
+
+    def _upload_name(self, dest, sudo=False):
+        # Where to upload a file that will be renamed to dest. With sudo
+        # the user may not be able to write next to dest.
+        token = secrets.token_hex(8)
+        if sudo:
+            return "/tmp/.pigrizia-{}".format(token)
+        return _staging_name(dest, token)
+
+    def _install_upload(self, upload, dest, **kwargs):
+        # Checks the checksum (digest) of an uploaded file and renames it
+        # to dest.
+        algorithm = checksum.select_algorithm(kwargs, self.addr)
+        stage = None
+        if 'sudo' in kwargs and kwargs['sudo'] is True:
+            stage = _staging_name(dest, secrets.token_hex(8))
+        script = _install_script(upload, dest, kwargs['digest'],
+                checksum.command(algorithm), stage=stage)
+        return self._install(script, dest, **kwargs)
+
+    def _copy_delta(self, src, dest, **kwargs):
+        # See pigrizia.command.handler.delta. Returns None if the delta
+        # can't be made, in which case the whole file should be sent.
+        size = os.path.getsize(src)
+        if size == 0:
+            return None
+        block_size = delta.block_size(size)
+        cmd = "python3 -c {} {} {}".format(
+                shlex.quote(delta.signature_script), shlex.quote(dest),
+                block_size)
         try:
-            scp.put(src, remote_path=tmp)
-        except SCPException as e:
-            return 1, [], [e]
-        finally:
-            scp.close()
-
-        shost = get_host()
-        schk = shost.checksum(src)
-        cmd = "sha512sum {}".format(tmp)
+            if 'sudo' in kwargs and kwargs['sudo'] is True:
+                ret, out, err = self.sudo(cmd, **kwargs)
+            else:
+                ret, out, err = self.do(cmd, **kwargs)
+        except NoSuchCommand:
+            return None
+        if ret != 0 or not out:
+            return None
+        signatures = delta.Signatures(out, block_size)
+
+        algorithm = checksum.select_algorithm(kwargs, self.addr)
+        token = secrets.token_hex(8)
+        upload = "/tmp/.pigrizia-{}.delta".format(token)
+        new = _staging_name(dest, token)
+        h = checksum.new(algorithm)
+        with open(src, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+                self.sftp.open(upload, 'wb') as r:
+            r.set_pipelined(True)
+            r.chmod(0o600)
+            literal = delta.write_delta(data, signatures, r.write)
+            h.update(data)
+        logger.debug("{}: sending {} of {} bytes".format(dest, literal,
+                size))
+
+        patch = "python3 -c {} \"$dest\" {} {} {}".format(
+                shlex.quote(delta.patch_script), shlex.quote(upload),
+                shlex.quote(new), block_size)
+        script = '\n'.join([
+            "dest={}".format(shlex.quote(dest)),
+            "{} || {{ rm -f {} {}; exit 1; }}".format(patch,
+                shlex.quote(upload), shlex.quote(new)),
+            "rm -f {}".format(shlex.quote(upload)),
+            _install_script(new, dest, h.hexdigest(),
+                checksum.command(algorithm)),
+        ])
+        return self._install(script, dest, **kwargs)
+
+    def _install(self, script, dest, **kwargs):
+        cmd = "sh -c {}".format(shlex.quote(script))
         if 'sudo' in kwargs and kwargs['sudo'] is True:
             ret, out, err = self.sudo(cmd, **kwargs)
         else:
             ret, out, err = self.do(cmd, **kwargs)
-        dchk = out[0].split()[0]
-        if schk != dchk:
-            raise CopyFailed()
-    
-        cmd = "cp {} {}".format(tmp, dest)
-        if 'sudo' in kwargs and kwargs['sudo'] is True:
-            self.sudo(cmd, **kwargs)
-        else:
-            self.do(cmd, **kwargs)
-        # TODO: for now
-        return 0, [], []
+        if ret == 3:
+            raise CopyFailed(dest)
+        return ret, out, err
 
-    def interact(self, script, **kwargs):
-        pass
+    @property
+    def sftp(self):
+        """
+        Gets an SFTP client on this handler's connection. The client is
+        opened the first time it is needed and then reused.
+
+        :rtype: paramiko.SFTPClient
+        """
+        if self._sftp is None:
+            self._sftp = self.ssh.open_sftp()
+        return self._sftp
+
+    def read(self, path, **kwargs):
+        """
+        Reads a whole file over SFTP.
+
+        :param str path: the file to read
+        :return: the content of the file
+        :rtype: bytes
+        :raises FileNotFoundError: if the file does not exist
+        """
+        with self.sftp.open(path, 'rb') as f:
+            f.prefetch()
+            return f.read()
+
+    def read_chunks(self, path, chunk_size=65536, **kwargs):
+        """
+        Reads a file over SFTP a chunk at a time.
+
+        :param str path: the file to read
+        :param int chunk_size: the largest chunk to return at a time
+        :return: yields the chunks of the file
+        :raises FileNotFoundError: if the file does not exist
+        """
+        with self.sftp.open(path, 'rb') as f:
+            f.prefetch()
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+
+    def read_into(self, path, buffer, **kwargs):
+        """
+        Reads a file over SFTP into a buffer. Reading stops at the end of
+        the file or when the buffer is full.
+
+        :param str path: the file to read
+        :param buffer: a writable buffer, such as a ``bytearray`` or a
+            ``memoryview``
+        :return: the number of bytes read
+        :rtype: int
+        :raises FileNotFoundError: if the file does not exist
+        """
+        view = memoryview(buffer).cast('B')
+        pos = 0
+        with self.sftp.open(path, 'rb') as f:
+            f.prefetch(len(view))
+            while pos < len(view):
+                n = f.readinto(view[pos:])
+                if n == 0:
+                    break
+                pos += n
+        return pos
+
+    def close(self):
+        """
+        Gives the connection back to the pool. The handler cannot be used
+        after this.
+        """
+        super().close()
+        if self._sftp is not None:
+            self._sftp.close()
+            self._sftp = None
+        if self.ssh is not None:
+            self._pool.release(self.ssh)
+            self._pool.evict_idle()
+            self.ssh = None
+
+    def _new_session(self, sudo, passwd):
+        return RemoteSession(self.ssh, sudo=sudo, passwd=passwd)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+def _staging_name(dest, token):
+    # A temporary name in the same directory as dest, so that the final
+    # rename is atomic.
+    head, tail = os.path.split(dest)
+    return os.path.join(head, ".{}.pigrizia-{}".format(tail, token))
+
+def _install_script(upload, dest, digest, command, stage=None):
+    """
+    Builds a script that checks the checksum of an uploaded file (using
+    *command*, such as ``sha512sum``) and renames it to *dest*. If *stage*
+    is given, the upload is first copied to that name (which should be
+    next to *dest*). The mode and owner of an existing *dest* are kept.
+    The script exits with 3 if the checksums don't match.
+    """
+    lines = [
+        "up={}".format(shlex.quote(upload)),
+        "dest={}".format(shlex.quote(dest)),
+        "sum=$({} < \"$up\") || exit 1".format(command),
+        "if [ \"${{sum%% *}}\" != {} ]; then rm -f \"$up\"; exit 3; fi"
+            .format(digest),
+    ]
+    if stage is not None:
+        lines += [
+            "tmp={}".format(shlex.quote(stage)),
+            "cp \"$up\" \"$tmp\" || { rm -f \"$up\"; exit 1; }",
+            "rm -f \"$up\"",
+        ]
+    else:
+        lines.append("tmp=$up")
+    lines += [
+        "if [ -e \"$dest\" ]; then",
+        "  chmod --reference=\"$dest\" \"$tmp\" 2>/dev/null",
+        "  chown --reference=\"$dest\" \"$tmp\" 2>/dev/null",
+        "fi",
+        "mv -f \"$tmp\" \"$dest\" || { rm -f \"$tmp\"; exit 1; }",
+    ]
+    return '\n'.join(lines)
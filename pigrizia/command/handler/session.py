@@ -0,0 +1,261 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+Persistent shell sessions.
+
+Every call to :meth:`~pigrizia.command.handler.Handler.do` starts a new
+shell (and, on a remote host, opens a new SSH channel). For cheap commands
+such as ``test -d`` that setup is most of the work. A session keeps one
+shell running instead. Commands are written to it one after the other, and
+each one is followed by a line with a unique marker, so that the exit
+code, stdout and stderr of every command can be told apart.
+
+    >>> session = handler.interact()
+    >>> session.run("test -d /etc")
+    (0, [], [])
+
+A root session (``interact(sudo=True)``) runs ``sudo sh`` once, so the
+password is only needed when the session starts.
+
+Like in a batch (see :mod:`~pigrizia.command.handler.batch`), every
+command is run in a subshell with stdin redirected from ``/dev/null``.
+Use :meth:`Session.source` for commands that should change the shell
+itself, such as ``cd`` or setting environment variables.
+
+Handlers created with ``session=True`` send all their commands through
+sessions.
+"""
+
+import os
+import select
+import selectors
+import secrets
+import shlex
+import threading
+from subprocess import Popen, PIPE
+from .batch import make_script
+from .stream import STDOUT, STDERR
+
+class SessionClosed(Exception):
+    """
+    Raised when the shell of a session has ended, or could not be
+    started.
+    """
+    pass
+
+class Session:
+    """
+    A shell that commands are sent to. Don't create this directly, use
+    the *interact* method of the handlers.
+
+    :ivar bool sudo: True if this is a root shell
+    """
+
+    def __init__(self, sudo=False, passwd=None):
+        self.sudo = sudo
+        self.closed = False
+        self._token = "--pigrizia-{}--".format(secrets.token_hex(8))
+        self._count = 0
+        self._lock = threading.Lock()
+        self._buf = {STDOUT: b'', STDERR: b''}
+
+        ready = "{} ready".format(self._token)
+        cmd = "sh -c {}".format(shlex.quote("echo '{}'; exec sh".format(
+                ready)))
+        prompt = None
+        if sudo:
+            prompt = "[pigrizia-sudo-{}]".format(secrets.token_hex(8))
+            cmd = "sudo -S -p {} {}".format(shlex.quote(prompt), cmd)
+        self._start(cmd)
+        self._wait_ready(ready.encode(), prompt, passwd)
+
+    def run(self, cmd):
+        """
+        Runs a command in the session.
+
+        :param str cmd: the command to run, including arguments
+        :return: a tuple consisting of the exit code, output to stdout
+            and output to stderr
+        :rtype: tuple
+        :raises SessionClosed: if the shell has ended
+        """
+        with self._lock:
+            token = self._next_token()
+            return self._exchange(make_script([cmd], token), token)
+
+    def source(self, script):
+        """
+        Runs commands in the shell of the session itself, rather than in
+        a subshell. Changes to the directory or the environment stay in
+        effect for the commands that follow.
+
+        :param str script: the commands
+        :return: a tuple consisting of the exit code of the last command,
+            output to stdout and output to stderr
+        :rtype: tuple
+        :raises SessionClosed: if the shell has ended
+        """
+        with self._lock:
+            token = self._next_token()
+            # make_script runs the command in a subshell, so only the
+            # markers are taken from it.
+            markers = make_script([':'], token).split('\n', 1)[1]
+            return self._exchange("{}\n{}".format(script, markers), token)
+
+    def close(self):
+        """
+        Ends the shell.
+        """
+        self.closed = True
+
+    def _next_token(self):
+        self._count += 1
+        return "{}{}".format(self._token, self._count)
+
+    def _exchange(self, script, token):
+        if self.closed:
+            raise SessionClosed()
+        try:
+            self._write("{}\n".format(script).encode())
+        except OSError:
+            self.close()
+            raise SessionClosed()
+
+        out_marker = "\n{} 0 ".format(token).encode()
+        err_marker = "\n{} 0\n".format(token).encode()
+        while True:
+            pos = self._buf[STDOUT].find(out_marker)
+            end = self._buf[STDOUT].find(b'\n', pos + len(out_marker))
+            if pos >= 0 and end >= 0 and err_marker in self._buf[STDERR]:
+                break
+            self._fill()
+
+        out = self._buf[STDOUT]
+        ret = int(out[pos + len(out_marker):end])
+        self._buf[STDOUT] = out[end + 1:]
+        err, self._buf[STDERR] = self._buf[STDERR].split(err_marker, 1)
+        out = [o.strip() for o in out[:pos].decode().splitlines()]
+        err = [e.strip() for e in err.decode().splitlines()]
+        return ret, out, err
+
+    def _wait_ready(self, ready, prompt, passwd):
+        prompt = prompt.encode() if prompt is not None else None
+        while ready not in self._buf[STDOUT]:
+            if prompt is not None and prompt in self._buf[STDERR]:
+                self._buf[STDERR] = self._buf[STDERR].replace(prompt, b'',
+                        1)
+                if passwd is None:
+                    # No password, or sudo asked again because it was
+                    # wrong.
+                    self.close()
+                    raise SessionClosed("sudo authentication failed")
+                self._write("{}\n".format(passwd).encode())
+                passwd = None
+            self._fill()
+        # Whatever came before (such as sudo's lecture) is dropped.
+        self._buf[STDOUT] = self._buf[STDOUT].split(ready + b'\n', 1)[1]
+        self._buf[STDERR] = b''
+
+    def _fill(self):
+        # Reads whatever is available into the buffers, waiting if there
+        # is nothing.
+        chunks = self._read()
+        if not chunks:
+            self.close()
+            raise SessionClosed()
+        for fd, data in chunks:
+            self._buf[fd] += data
+
+    def _start(self, cmd):
+        raise NotImplementedError()
+
+    def _write(self, data):
+        raise NotImplementedError()
+
+    def _read(self):
+        raise NotImplementedError()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+class LocalSession(Session):
+    """
+    A session with a shell on the local host.
+    """
+
+    def _start(self, cmd):
+        self._proc = Popen(shlex.split(cmd), stdin=PIPE, stdout=PIPE,
+                stderr=PIPE)
+        self._sel = selectors.DefaultSelector()
+        self._sel.register(self._proc.stdout, selectors.EVENT_READ, STDOUT)
+        self._sel.register(self._proc.stderr, selectors.EVENT_READ, STDERR)
+
+    def _write(self, data):
+        self._proc.stdin.write(data)
+        self._proc.stdin.flush()
+
+    def _read(self):
+        chunks = []
+        while not chunks and self._sel.get_map():
+            for key, events in self._sel.select():
+                data = os.read(key.fileobj.fileno(), 65536)
+                if data:
+                    chunks.append((key.data, data))
+                else:
+                    self._sel.unregister(key.fileobj)
+        return chunks
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            self._sel.close()
+            try:
+                self._proc.stdin.close()
+            except OSError:
+                pass
+            self._proc.wait()
+            self._proc.stdout.close()
+            self._proc.stderr.close()
+
+class RemoteSession(Session):
+    """
+    A session with a shell on a remote host, on a single SSH channel.
+    """
+
+    def __init__(self, ssh, **kwargs):
+        self._ssh = ssh
+        super().__init__(**kwargs)
+
+    def _start(self, cmd):
+        self._chan = self._ssh.get_transport().open_session()
+        self._chan.exec_command(cmd)
+
+    def _write(self, data):
+        self._chan.sendall(data)
+
+    def _read(self):
+        chan = self._chan
+        while True:
+            chunks = []
+            if chan.recv_ready():
+                chunks.append((STDOUT, chan.recv(65536)))
+            if chan.recv_stderr_ready():
+                chunks.append((STDERR, chan.recv_stderr(65536)))
+            if chunks:
+                return chunks
+            if chan.eof_received or chan.closed:
+                return []
+            select.select([chan], [], [], 1)
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            self._chan.close()
@@ -0,0 +1,248 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+Streaming command output.
+
+:meth:`~pigrizia.command.handler.Handler.do` keeps everything a command
+writes in memory until the command ends. That is fine for most commands,
+but not for ones that write gigabytes of output. The *do_stream* and
+*sudo_stream* methods of the handlers return a :class:`Stream` instead,
+which hands out the output as it arrives.
+
+    >>> stream = handler.do_stream("journalctl")
+    >>> for fd, line in stream:
+    ...     if fd == STDERR:
+    ...         print("error:", line)
+    >>> stream.ret
+    0
+
+In binary mode (``binary=True``) the stream yields chunks of bytes instead
+of lines. Either way, only a bounded amount of output is held in memory at
+any time.
+"""
+
+import os
+import shlex
+import select
+import selectors
+from . import NoSuchCommand
+
+STDOUT = 1
+STDERR = 2
+
+def stream_options(kwargs):
+    """
+    Picks the keyword arguments that are meant for :class:`Stream` out of
+    the keyword arguments given to a handler.
+    """
+    return {k: kwargs[k] for k in ('binary', 'chunk_size') if k in kwargs}
+
+class Stream:
+    """
+    The output of a running command. Iterating over a stream yields
+    tuples of a file descriptor number (:data:`STDOUT` or :data:`STDERR`)
+    and either a line (without the line ending) or a chunk of bytes.
+
+    Once the stream is exhausted, :attr:`ret` holds the exit code of the
+    command. Don't create this directly, use the *do_stream* and
+    *sudo_stream* methods of the handlers.
+
+    :ivar int ret: the exit code, or None while the command is running
+    """
+
+    # The longest line that is buffered. Longer lines are handed out in
+    # pieces of this size.
+    max_line = 1024 * 1024
+
+    def __init__(self, cmd, binary=False, chunk_size=65536, prompt=None):
+        self.cmd = cmd
+        self.binary = binary
+        self.chunk_size = chunk_size
+        self.ret = None
+        self._partial = {STDOUT: b'', STDERR: b''}
+        # The sudo prompt, which is taken out of stderr, and the end of
+        # stderr that may be the start of it.
+        self._prompt = prompt.encode() if prompt is not None else None
+        self._err = b''
+
+    def __iter__(self):
+        for fd, data in self._chunks():
+            if self.binary:
+                yield fd, data
+            else:
+                yield from self._lines(fd, data)
+        if self._err:
+            # Held back, but it wasn't the prompt after all.
+            data, self._err = self._err, b''
+            if self.binary:
+                yield STDERR, data
+            else:
+                yield from self._lines(STDERR, data)
+        if not self.binary:
+            for fd in (STDOUT, STDERR):
+                if self._partial[fd]:
+                    yield fd, self._decode(self._partial[fd])
+                    self._partial[fd] = b''
+        if self.ret == 127:
+            raise NoSuchCommand(shlex.split(self.cmd)[0])
+
+    def lines(self, fd=STDOUT):
+        """
+        Iterates over the lines written to one of the outputs, dropping
+        the other.
+
+        :param int fd: :data:`STDOUT` or :data:`STDERR`
+        """
+        for which, line in self:
+            if which == fd:
+                yield line
+
+    def close(self):
+        """
+        Stops reading and releases the resources of the stream. This
+        doesn't wait for the command to end.
+        """
+        pass
+
+    def _lines(self, fd, data):
+        buf = self._partial[fd] + data
+        lines = buf.split(b'\n')
+        buf = lines.pop()
+        for line in lines:
+            yield fd, self._decode(line)
+        while len(buf) > self.max_line:
+            yield fd, self._decode(buf[:self.max_line])
+            buf = buf[self.max_line:]
+        self._partial[fd] = buf
+
+    def _decode(self, line):
+        return line.decode(errors='replace')
+
+    def _strip_prompt(self, data):
+        # Takes the sudo prompt out of a chunk of stderr. The prompt may
+        # arrive in pieces, so the end of stderr is held back until it is
+        # clear that it is not the prompt. Returns what can be handed out
+        # and the number of prompts found.
+        if self._prompt is None:
+            return data, 0
+        self._err += data
+        found = self._err.count(self._prompt)
+        self._err = self._err.replace(self._prompt, b'')
+        keep = 0
+        for n in range(min(len(self._prompt) - 1, len(self._err)), 0, -1):
+            if self._err.endswith(self._prompt[:n]):
+                keep = n
+                break
+        cut = len(self._err) - keep
+        data, self._err = self._err[:cut], self._err[cut:]
+        return data, found
+
+    def _chunks(self):
+        raise NotImplementedError()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+class LocalStream(Stream):
+    """
+    A stream of the output of a local process.
+
+    If a *prompt* is given, it is taken out of stderr. The password has
+    already been written to ``sudo -S -p``, so there is nothing to answer.
+    """
+
+    def __init__(self, cmd, proc, **kwargs):
+        super().__init__(cmd, **kwargs)
+        self._proc = proc
+
+    def _chunks(self):
+        p = self._proc
+        sel = selectors.DefaultSelector()
+        sel.register(p.stdout, selectors.EVENT_READ, STDOUT)
+        sel.register(p.stderr, selectors.EVENT_READ, STDERR)
+        try:
+            while sel.get_map():
+                for key, events in sel.select():
+                    data = os.read(key.fileobj.fileno(), self.chunk_size)
+                    if data and key.data == STDERR:
+                        data, found = self._strip_prompt(data)
+                        if data:
+                            yield key.data, data
+                    elif data:
+                        yield key.data, data
+                    else:
+                        sel.unregister(key.fileobj)
+            self.ret = p.wait()
+        finally:
+            sel.close()
+            p.stdout.close()
+            p.stderr.close()
+
+    def close(self):
+        if self.ret is None:
+            self._proc.kill()
+            self._proc.wait()
+            self._proc.stdout.close()
+            self._proc.stderr.close()
+
+class RemoteStream(Stream):
+    """
+    A stream of the output of a command on a Paramiko channel.
+
+    If a *prompt* is given, the stream watches stderr for it and answers
+    with *passwd*. This is how the password is fed to ``sudo -S -p``
+    without sending it to a command that didn't ask for it.
+    """
+
+    def __init__(self, cmd, chan, passwd=None, **kwargs):
+        super().__init__(cmd, **kwargs)
+        self._chan = chan
+        self._passwd = passwd
+
+    def _chunks(self):
+        chan = self._chan
+        try:
+            while True:
+                idle = True
+                if chan.recv_ready():
+                    idle = False
+                    yield STDOUT, chan.recv(self.chunk_size)
+                if chan.recv_stderr_ready():
+                    idle = False
+                    data = self._check_prompt(
+                            chan.recv_stderr(self.chunk_size))
+                    if data:
+                        yield STDERR, data
+                if not idle:
+                    continue
+                if chan.eof_received or chan.closed:
+                    if not chan.recv_ready() and \
+                            not chan.recv_stderr_ready():
+                        break
+                    continue
+                select.select([chan], [], [], 1)
+            self.ret = chan.recv_exit_status()
+        finally:
+            chan.close()
+
+    def _check_prompt(self, data):
+        data, found = self._strip_prompt(data)
+        for i in range(found):
+            if self._passwd is not None:
+                self._chan.sendall("{}\n".format(self._passwd).encode())
+                self._passwd = None
+            else:
+                # Asked twice: the password was wrong.
+                self._chan.shutdown_write()
+        return data
+
+    def close(self):
+        self._chan.close()
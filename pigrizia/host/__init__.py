@@ -16,18 +16,81 @@ class UnknownSystem(Exception):
     """
     pass
 
+# Host classes that get_host() can pick from. See register().
+_systems = []
+
+def register(cls):
+    """
+    Registers a host class with :func:`get_host`. This is meant to be
+    used as a class decorator.
+
+    The class must have a *detect* static method that takes the
+    :class:`~pigrizia.host.linux.Facts` gathered from the host and returns
+    True if the host is of that class. If detection needs to know whether
+    some files or directories exist, list them in the *markers* class
+    attribute and they will be checked as part of the probe.
+
+    More specialized classes (deeper in the class hierarchy) are tried
+    before the classes they derive from.
+    """
+    _systems.append(cls)
+    return cls
+
+def markers():
+    """
+    Gets the marker paths needed by all registered host classes.
+
+    :rtype: list
+    """
+    paths = []
+    for cls in _systems:
+        for path in getattr(cls, 'markers', ()):
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+def detect(facts):
+    """
+    Picks the host class that matches the given facts.
+
+    :param facts: the facts gathered by
+        :meth:`~pigrizia.host.linux.Linux.probe`
+    :return: the most specialized matching class, or None
+    """
+    # sorted() is stable, so classes at the same depth are tried in the
+    # order they were registered.
+    systems = sorted(_systems, key=lambda cls: len(cls.__mro__),
+            reverse=True)
+    for cls in systems:
+        if cls.detect(facts):
+            return cls
+    return None
+
 def get_host(**kwargs):
     """
     Gets a host.
 
+    The host is examined with a single probe command (see
+    :meth:`~pigrizia.host.linux.Linux.probe`) and the class is picked from
+    the registered classes without any further commands being run. The
+    result is remembered in the fingerprint cache (see
+    :mod:`pigrizia.host.fingerprint`), so the next time the same host is
+    requested the class is known up front.
+
+    :param bool fingerprint: if False, the fingerprint cache is neither
+        used nor updated (the default is True)
+    :param float fingerprint_ttl: the number of seconds a fingerprint is
+        trusted before it is revalidated against the machine ID of the
+        host
     :return: a host object that (hopefully) represents the host at the
         specified address
     :rtype: a subclass of :class:`~pigrizia.host.Host`
     """
-    # TODO: this function has to be rewritten, because it is really clumsy.
-    # for now it get the job done, however.
-    from .linux import (Fedora, Issabel, CentOS, Ubuntu, Proxmox, 
-            Debian, Linux)
+    from .linux import Linux, Facts
+    from . import fingerprint as fp
+
+    use_cache = kwargs.pop('fingerprint', True)
+    ttl = kwargs.pop('fingerprint_ttl', fp.default_ttl)
 
     if 'addr' not in kwargs and 'label' in kwargs:
         host_config = get_host_config(kwargs['label'])
@@ -37,27 +100,48 @@ def get_host(**kwargs):
             # TODO: is this the right error?
             raise KeyError("unknown host: {}".format(kwargs['label']))
 
-    linux = Linux(**kwargs)
-    if Fedora.detect(linux):
-        logger.info("detected Fedora")
-        return Fedora(**kwargs)
-    elif Issabel.detect(linux):
-        logger.info("detected Issabel")
-        return Issabel(**kwargs)
-    elif CentOS.detect(linux):
-        logger.info("detected CentOS")
-        return CentOS(**kwargs)
-    elif Ubuntu.detect(linux):
-        logger.info("detected Ubuntu")
-        return Ubuntu(**kwargs)
-    elif Proxmox.detect(linux):
-        return Proxmox(**kwargs)
-    elif Debian.detect(linux):
-        logger.info("detected debian")
-        return Debian(**kwargs)
-    elif linux.uname == 'Linux':
-        return linux
+    key = kwargs.get('label') or kwargs.get('addr') or 'localhost'
+    cmdh = None
+    cached = fp.get_fingerprint(key) if use_cache else None
+    cls = _system_by_name(cached['class']) if cached else None
+    if cls is not None:
+        host = cls(**kwargs)
+        host.facts = Facts.from_fingerprint(cached)
+        if fp.is_fresh(cached, ttl):
+            logger.debug("using fingerprint of {}".format(key))
+            return host
+        machine_id = host.machine_id()
+        if machine_id is not None and machine_id == cached.get('machine_id'):
+            logger.debug("revalidated fingerprint of {}".format(key))
+            fp.touch_fingerprint(key)
+            return host
+        logger.info("fingerprint of {} is stale".format(key))
+        cmdh = host.cmdh
+
+    if cmdh is not None:
+        linux = Linux(cmdh=cmdh, **kwargs)
+    else:
+        linux = Linux(**kwargs)
+    facts = linux.probe(markers())
+    cls = detect(facts)
+    if cls is not None:
+        logger.info("detected {}".format(cls.__name__))
+        # Hand over the handler, so the new host doesn't connect again.
+        host = cls(cmdh=linux.cmdh, **kwargs)
+    elif facts.uname == 'Linux':
+        host = linux
     else:
         # We really don't know how the system works, so better just raise
         # an exception.
         raise UnknownSystem()
+    host.facts = facts
+    if use_cache:
+        fp.set_fingerprint(key, host, facts)
+    return host
+
+def _system_by_name(name):
+    from .linux import Linux
+    for cls in _systems + [Linux]:
+        if cls.__name__ == name:
+            return cls
+    return None
@@ -0,0 +1,185 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+Hosts for asyncio.
+
+:class:`AsyncLinux` has coroutine versions of the query methods of
+:class:`~pigrizia.host.linux.Linux`. It uses the command handlers from
+:mod:`pigrizia.command.handler.aio`, so many hosts can be queried
+concurrently from a single thread.
+
+    >>> async def check(addr):
+    ...     async with AsyncLinux(addr=addr, passwd=passwd) as host:
+    ...         return addr, await host.file_exists('/etc/issabel.conf')
+    >>> results = asyncio.run(asyncio.gather(*[check(a) for a in addrs]))
+"""
+
+from .host import CommandFailed
+from .linux import (Facts, _succeeded, _exit_code, _first_line,
+        _first_line_or_empty, _first_field)
+
+class AsyncLinux:
+    """
+    A Linux host for asyncio code. It takes the same keyword arguments as
+    :class:`~pigrizia.host.linux.Linux`.
+    """
+
+    facts = None
+
+    def __init__(self, **kwargs):
+        if 'addr' in kwargs and kwargs['addr'] is not None:
+            from pigrizia.command.handler.aio import AsyncRemoteHandler
+            self.cmdh = AsyncRemoteHandler(**kwargs)
+        else:
+            from pigrizia.command.handler.aio import AsyncLocalHandler
+            self.cmdh = AsyncLocalHandler(**kwargs)
+
+    async def directory_exists(self, path, **kwargs):
+        """
+        Checks if the specified path exists and is a directory.
+
+        :param str path: the path to check for
+        :rtype: bool
+        """
+        cmd = "test -d {}".format(path)
+        return _succeeded(*await self._call(cmd, **kwargs))
+
+    async def file_exists(self, path, **kwargs):
+        """
+        Checks if the specified path exists and is a file.
+
+        :param str path: the path to check for
+        :rtype: bool
+        """
+        cmd = "test -f {}".format(path)
+        return _succeeded(*await self._call(cmd, **kwargs))
+
+    async def permissions(self, path, **kwargs):
+        """
+        Gets the permissions for the specified path.
+        """
+        f = '%A' if 'human-readable' in kwargs else '%a'
+        cmd = "stat -c {} {}".format(f, path)
+        return _first_line(*await self._call(cmd))
+
+    async def mkdir(self, path, **kwargs):
+        """
+        Creates the specified directory.
+        """
+        cmd = "mkdir -p {}".format(path)
+        return _exit_code(*await self._call(cmd, **kwargs))
+
+    async def whoami(self, **kwargs):
+        """
+        Gets the name of the current user.
+
+        :rtype: str
+        """
+        return _first_line_or_empty(*await self._call("whoami", **kwargs))
+
+    async def user_exists(self, user, **kwargs):
+        """
+        Checks if a user exists on the host.
+
+        :param str user: the user to check for
+        :rtype: bool
+        """
+        cmd = "grep -q ^{}: /etc/passwd".format(user)
+        return _succeeded(*await self._call(cmd, **kwargs))
+
+    async def distro(self, **kwargs):
+        """
+        Reads the ID of the current distro.
+
+        :return: the value of the ID field of /etc/os-release, or None
+        :rtype: str or NoneType
+        """
+        ret, out, err = await self._call("cat /etc/os-release", **kwargs)
+        if ret != 0:
+            return None
+        for line in out:
+            if line.startswith("ID="):
+                return line.split('=')[1]
+        return None
+
+    async def read_file(self, fname, **kwargs):
+        """
+        Reads in and returns the specified file.
+
+        :param str fname: the name of the file
+        :rtype: str
+        """
+        cmd = "cat {}".format(fname)
+        ret, out, err = await self._call(cmd, **kwargs)
+        return '\n'.join(out)
+
+    async def mktemp(self, **kwargs):
+        """
+        Create a temporary file. See :meth:`Linux.mktemp`.
+
+        :rtype: str
+        :raises CommandFailed: if the mktemp command failed
+        """
+        cmd = "mktemp"
+        if 'create_dir' in kwargs and kwargs['create_dir'] == True:
+            cmd += " -d"
+        if 'tmpdir' in kwargs:
+            cmd += " -p {}".format(kwargs['tmpdir'])
+
+        ret, out, err = await self._call(cmd, **kwargs)
+        if ret != 0:
+            raise CommandFailed('\n'.join(err))
+        return out[0]
+
+    async def checksum(self, fname, **kwargs):
+        """
+        Returns the (SHA-512) checksum of the specified file.
+
+        :rtype: str
+        :raises CommandFailed: if the command failed
+        """
+        cmd = "sha512sum {}".format(fname)
+        return _first_field(*await self._call(cmd, **kwargs))
+
+    async def has_pigrizia(self, **kwargs):
+        """
+        Checks if Pigrizia is already installed on this host.
+
+        :rtype: bool
+        """
+        cmd = "python3 -c 'import pigrizia'"
+        return _succeeded(*await self._call(cmd, **kwargs))
+
+    async def probe(self, markers=(), **kwargs):
+        """
+        Gathers the facts needed to detect what kind of system this is.
+        See :meth:`Linux.probe`.
+
+        :rtype: :class:`~pigrizia.host.linux.Facts`
+        """
+        ret, out, err = await self._call(Facts.command(markers), **kwargs)
+        self.facts = Facts.parse(out or [])
+        return self.facts
+
+    def close(self):
+        """
+        Releases the connection to the host.
+        """
+        self.cmdh.close()
+
+    async def _call(self, cmd, **kwargs):
+        if 'sudo' in kwargs and kwargs['sudo'] is True:
+            return await self.cmdh.sudo(cmd)
+        else:
+            return await self.cmdh.do(cmd)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
@@ -0,0 +1,97 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+Tar streams of directory trees.
+
+This is what :meth:`~pigrizia.host.linux.Linux.copy_tree` sends. The
+archive is written as it is read from disk, so a tree of any size is sent
+without a temporary archive. Every regular file is hashed while it is
+added, and a manifest of the checksums (in the format ``sha512sum -c``
+reads) is added as the last member, so the receiving side can check what
+it unpacked.
+"""
+
+import io
+import os
+import tarfile
+from pigrizia.command.handler import checksum
+
+# The tar options for the supported compressions.
+compressions = {
+    None: '',
+    'gz': 'z',
+    'bz2': 'j',
+    'xz': 'J',
+}
+
+class _HashingReader:
+    # Hashes a file as tarfile reads it.
+
+    def __init__(self, f, h):
+        self._f = f
+        self._h = h
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self._h.update(data)
+        return data
+
+def write_tree(src, fileobj, manifest, algorithm=None, compress=None):
+    """
+    Writes a tar archive of a directory to a file object. The members are
+    named relative to *src*.
+
+    :param str src: the directory
+    :param fileobj: where to write the archive (only *write* is used)
+    :param str manifest: the name of the manifest member
+    :param str algorithm: the checksum algorithm of the manifest
+    :param str compress: None, ``'gz'``, ``'bz2'`` or ``'xz'``
+    :return: the number of regular files in the archive
+    :rtype: int
+    """
+    algorithm = algorithm or checksum.default_algorithm
+    mode = "w|{}".format(compress or '')
+    sums = []
+    with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+        for top, dirs, files in os.walk(src):
+            dirs.sort()
+            # The top directory itself is left out, so the mode of the
+            # destination directory isn't changed. Symbolic links to
+            # directories are in dirs, but os.walk doesn't follow them.
+            for name in sorted(dirs + files):
+                path = os.path.join(top, name)
+                arcname = os.path.relpath(path, src)
+                info = tar.gettarinfo(path, arcname)
+                if info is None:
+                    # Sockets and the like can't be archived.
+                    continue
+                if not info.isreg():
+                    tar.addfile(info)
+                    continue
+                h = checksum.new(algorithm)
+                with open(path, 'rb') as f:
+                    tar.addfile(info, _HashingReader(f, h))
+                sums.append(manifest_line(h.hexdigest(), arcname))
+
+        data = ''.join(sums).encode()
+        info = tarfile.TarInfo(manifest)
+        info.size = len(data)
+        info.mode = 0o600
+        tar.addfile(info, io.BytesIO(data))
+    return len(sums)
+
+def manifest_line(digest, name):
+    """
+    Formats a line of a checksum manifest, escaping the name the same way
+    coreutils does.
+
+    :rtype: str
+    """
+    if '\\' in name or '\n' in name:
+        name = name.replace('\\', '\\\\').replace('\n', '\\n')
+        return "\\{}  {}\n".format(digest, name)
+    return "{}  {}\n".format(digest, name)
@@ -0,0 +1,136 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+Installing Pigrizia on hosts without network access.
+
+:func:`build_wheel` packs the Pigrizia that is running here into a wheel,
+which :meth:`~pigrizia.host.linux.Linux.install_pigrizia` pushes to a host
+and installs with ``pip install --no-index --no-deps``. Nothing is
+downloaded or built on the host, so this works on hosts that can't reach
+the internet. The dependencies are not installed, they must already be
+there.
+
+The data files of ``setup.py`` (such as the configuration of the ping
+monitor) are put in the wheel too. They are taken from the source tree
+if Pigrizia runs from there, otherwise from where they were installed.
+
+    >>> fleet = Fleet(passwd=passwd)
+    >>> for result in fleet.install_pigrizia():
+    ...     print(result.label, result.value)
+
+The wheel is built the same way every time, so the same code always gives
+the same wheel.
+"""
+
+import os
+import sys
+import base64
+import hashlib
+import zipfile
+import pigrizia
+
+# The dependencies. They end up in the metadata of the wheel, but they
+# are not installed.
+requires = pigrizia.__requires__
+
+# The data files, as in setup.py: the files of the source tree, by the
+# directory (under sys.prefix) they are installed in.
+data_files = {
+    'pigrizia/conf/monitor': ['conf/monitor/ping.conf'],
+}
+
+# The timestamp of every member, so that the wheel only depends on the
+# content of the files.
+_date_time = (1980, 1, 1, 0, 0, 0)
+
+def wheel_name(version=None):
+    """
+    Gets the file name of the wheel of a version of Pigrizia.
+
+    :param str version: the version (the default is the running one)
+    :rtype: str
+    """
+    return "pigrizia-{}-py3-none-any.whl".format(
+            version or pigrizia.__version__)
+
+def build_wheel(dest_dir):
+    """
+    Builds a wheel of the running Pigrizia.
+
+    :param str dest_dir: the directory to put the wheel in
+    :return: the path of the wheel
+    :rtype: str
+    """
+    version = pigrizia.__version__
+    top = os.path.dirname(os.path.abspath(pigrizia.__file__))
+    base = os.path.dirname(top)
+    dist_info = "pigrizia-{}.dist-info".format(version)
+    path = os.path.join(dest_dir, wheel_name(version))
+
+    record = []
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as whl:
+        def add(arcname, data):
+            info = zipfile.ZipInfo(arcname, _date_time)
+            info.external_attr = 0o644 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            whl.writestr(info, data)
+            digest = base64.urlsafe_b64encode(
+                    hashlib.sha256(data).digest()).rstrip(b'=').decode()
+            record.append("{},sha256={},{}".format(arcname, digest,
+                len(data)))
+
+        for root, dirs, files in os.walk(top):
+            dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+            for name in sorted(files):
+                if name.endswith(('.pyc', '.pyo')):
+                    continue
+                fname = os.path.join(root, name)
+                with open(fname, 'rb') as f:
+                    add(os.path.relpath(fname, base), f.read())
+
+        for target, sources in sorted(data_files.items()):
+            for source in sources:
+                name = os.path.basename(source)
+                with open(_data_file(base, source, target), 'rb') as f:
+                    add("pigrizia-{}.data/data/{}/{}".format(version,
+                        target, name), f.read())
+
+        add("{}/METADATA".format(dist_info), _metadata(version))
+        add("{}/WHEEL".format(dist_info), _wheel_info())
+        add("{}/top_level.txt".format(dist_info), b'pigrizia\n')
+        arcname = "{}/RECORD".format(dist_info)
+        record.append("{},,".format(arcname))
+        info = zipfile.ZipInfo(arcname, _date_time)
+        info.external_attr = 0o644 << 16
+        info.compress_type = zipfile.ZIP_DEFLATED
+        whl.writestr(info, ''.join(r + '\n' for r in record))
+    return path
+
+def _data_file(base, source, target):
+    # The data file in the source tree, else the installed one.
+    fname = os.path.join(base, source)
+    if os.path.exists(fname):
+        return fname
+    fname = os.path.join(sys.prefix, target, os.path.basename(source))
+    if os.path.exists(fname):
+        return fname
+    raise FileNotFoundError(source)
+
+def _metadata(version):
+    lines = [
+        "Metadata-Version: 2.1",
+        "Name: pigrizia",
+        "Version: {}".format(version),
+        "Summary: {}".format(pigrizia.__doc__.strip()),
+        "Requires-Python: >=3.7",
+    ]
+    lines += ["Requires-Dist: {}".format(r) for r in requires]
+    return ''.join(line + '\n' for line in lines).encode()
+
+def _wheel_info():
+    return b"Wheel-Version: 1.0\nGenerator: pigrizia\n" \
+            b"Root-Is-Purelib: true\nTag: py3-none-any\n"
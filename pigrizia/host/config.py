@@ -4,18 +4,29 @@
 # license that can be found in the LICENSE file or at
 # https://opensource.org/licenses/MIT.
 
-import os
-import toml
+"""
+The host inventory.
+
+The hosts are kept in ``hosts.conf`` in the configuration directory, or,
+if it exists, in the SQLite database ``hosts.db`` (see
+:mod:`pigrizia.host.hostdb`). Use :func:`import_hosts` to create the
+database from ``hosts.conf``.
+"""
 
+import os
 from pigrizia.config import config_dir
+from .inventory import get_inventory
 hosts_config = '/'.join((config_dir, 'hosts.conf'))
+hosts_db = '/'.join((config_dir, 'hosts.db'))
 
 class HostConfig:
     _label = None
     _config = {}
 
     def __init__(self, addr=None):
-        self.label = get_label_by_addr(addr)
+        # Don't go through the setter here, it would rename the host
+        # entry in the inventory.
+        self._label = get_label_by_addr(addr)
         self._config = get_host_config(self.label)
         if not 'addr' in self._config:
             self.addr = addr
@@ -27,13 +38,11 @@ class HostConfig:
     @label.setter
     def label(self, value):
         if value != self.label:
-            hosts = _read_hosts_file()
             if value is not None:
-                hosts[value] = hosts.pop(self.label, self._config)
+                _inventory().rename(self.label, value, self._config)
             else:
-                hosts.pop(self.label)
+                _inventory().remove(self.label)
             self._label = value
-            _write_hosts_file(hosts)
 
     @property
     def addr(self):
@@ -44,34 +53,82 @@ class HostConfig:
         self._config['addr'] = value
         self._update()
 
+    def get(self, key, default=None):
+        """
+        Gets a setting of the host.
+
+        :param str key: the name of the setting
+        :param default: returned if the setting is not there
+        """
+        return self._config.get(key, default)
+
     def _update(self):
-        hosts = _read_hosts_file()
         if self.label is not None:
-            hosts[self.label] = self._config
-            _write_hosts_file(hosts)
+            _inventory().set(self.label, self._config)
 
 def get_host_config(label):
-    hosts = _read_hosts_file()
-    if label in hosts:
-        return hosts[label]
-    else:
-        return {}
+    return _inventory().get(label, {})
+
+def get_labels():
+    """
+    Gets the labels of all the hosts in the inventory.
+
+    :rtype: list
+    """
+    return _inventory().keys()
 
 def get_label_by_addr(addr):
     if addr is None:
         return None
-    hosts = _read_hosts_file()
-    for label, config in hosts.items():
-        if 'addr' in config and config['addr'] == addr:
-            return label
-    return None
-
-def _read_hosts_file():
-    try:
-        return toml.load(hosts_config)
-    except FileNotFoundError:
-        return {}
+    return _inventory().lookup('addr', addr)
+
+def select_hosts(tags=None, groups=None, **fields):
+    """
+    Finds the hosts that have all the given tags, are in all the given
+    groups and have the given settings.
+
+        >>> select_hosts(tags='pbx', os='centos')
+        ['pbx1', 'pbx2']
+
+    :param tags: a tag or a list of tags
+    :param groups: a group or a list of groups
+    :return: the labels of the hosts
+    :rtype: list
+    """
+    return _inventory().select(tags, groups, **fields)
+
+def import_hosts(fname=None):
+    """
+    Creates the host database from a file in the format of
+    ``hosts.conf``, replacing the hosts that are already in it. From then
+    on the database is used instead of ``hosts.conf``.
+
+    :param str fname: the file (the default is ``hosts.conf``)
+    """
+    from .hostdb import get_database
+    get_database(hosts_db).import_toml(fname or hosts_config)
+
+def export_hosts(fname=None):
+    """
+    Writes the hosts in the database to a file in the format of
+    ``hosts.conf``.
+
+    :param str fname: the file (the default is ``hosts.conf``)
+    :raises FileNotFoundError: if there is no host database
+    """
+    # get_database would create an empty database, which would then
+    # replace the file and become the inventory.
+    if not os.path.exists(hosts_db):
+        raise FileNotFoundError(hosts_db)
+    from .hostdb import get_database
+    get_database(hosts_db).export_toml(fname or hosts_config)
+
+def _inventory():
+    # Looked up every time, as the files can be changed.
+    if os.path.exists(hosts_db):
+        from .hostdb import get_database
+        return get_database(hosts_db)
+    return get_inventory(hosts_config, indexes=('addr',))
 
 def _write_hosts_file(hosts):
-    with open(hosts_config, 'w') as f:
-        toml.dump(hosts, f)
+    _inventory().replace(hosts)
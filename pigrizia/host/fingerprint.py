@@ -0,0 +1,102 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+A cache of host fingerprints.
+
+Once :func:`~pigrizia.host.get_host` has worked out what kind of system a
+host is, it stores a fingerprint of the host in ``fingerprints.conf`` in
+the configuration directory. The fingerprint records the class that was
+picked, the ID from ``/etc/os-release`` and the machine ID of the host.
+
+.. code-block :: toml
+
+    [pbx1]
+    class = 'Issabel'
+    uname = 'Linux'
+    os_id = 'centos'
+    machine_id = '4a1b0e7c0d2f4c8e9d5b1e1f2a3b4c5d'
+    checked = 1575000000.0
+
+While a fingerprint is younger than the TTL, the host class is used
+straight away without running any command on the host. Older
+fingerprints are revalidated by reading the machine ID of the host,
+which is a single cheap command. Only if that does not match is the
+full detection run again.
+"""
+
+import time
+
+from pigrizia.config import config_dir
+from .inventory import get_inventory
+fingerprints_file = '/'.join((config_dir, 'fingerprints.conf'))
+
+# The default number of seconds a fingerprint is trusted without asking
+# the host.
+default_ttl = 24 * 60 * 60
+
+def get_fingerprint(key):
+    """
+    Gets the fingerprint stored for a host.
+
+    :param str key: the label or address of the host
+    :return: the fingerprint, or None if there isn't one
+    :rtype: dict or NoneType
+    """
+    return _inventory().get(key)
+
+def set_fingerprint(key, host, facts):
+    """
+    Stores the fingerprint of a host.
+
+    :param str key: the label or address of the host
+    :param host: the detected host object
+    :param facts: the :class:`~pigrizia.host.linux.Facts` of the host
+    """
+    fingerprint = {
+        'class': type(host).__name__,
+        'checked': time.time(),
+    }
+    if facts.uname is not None:
+        fingerprint['uname'] = facts.uname
+    if facts.distro is not None:
+        fingerprint['os_id'] = facts.distro
+    if facts.machine_id is not None:
+        fingerprint['machine_id'] = facts.machine_id
+    with _inventory().transaction() as fingerprints:
+        fingerprints[key] = fingerprint
+
+def touch_fingerprint(key):
+    """
+    Marks the fingerprint of a host as just validated.
+
+    :param str key: the label or address of the host
+    """
+    with _inventory().transaction() as fingerprints:
+        if key in fingerprints:
+            fingerprints[key]['checked'] = time.time()
+
+def forget_fingerprint(key):
+    """
+    Removes the fingerprint of a host, forcing detection the next time.
+
+    :param str key: the label or address of the host
+    """
+    with _inventory().transaction() as fingerprints:
+        fingerprints.pop(key, None)
+
+def is_fresh(fingerprint, ttl=default_ttl):
+    """
+    Checks if a fingerprint is young enough to be trusted as is.
+
+    :param dict fingerprint: the fingerprint
+    :param float ttl: the maximum age in seconds
+    :rtype: bool
+    """
+    return time.time() - fingerprint.get('checked', 0) < ttl
+
+def _inventory():
+    return get_inventory(fingerprints_file)
@@ -0,0 +1,299 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+Running things on many hosts at once.
+
+A :class:`Fleet` is a group of hosts from the host inventory
+(``hosts.conf``). It runs host methods or raw commands on all of them
+using a pool of worker threads and hands back the results as soon as
+they come in.
+
+    >>> fleet = Fleet(passwd=passwd)
+    >>> for result in fleet.run('checksum', '/etc/hosts'):
+    ...     if result.ok:
+    ...         print(result.label, result.value, result.duration)
+    ...     else:
+    ...         print(result.label, 'failed:', result.error)
+
+A host that cannot be reached, or a method that raises an exception,
+only affects the result for that host.
+"""
+
+import os
+import mmap
+import time
+import queue
+import shlex
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pigrizia.command.handler import NoSuchCommand, checksum
+from . import get_host
+from .config import get_labels
+from .host import CommandFailed
+
+import logging
+logger = logging.getLogger(__name__)
+
+class FleetResult:
+    """
+    The outcome of running something on one host of a fleet.
+
+    :ivar str label: the label of the host
+    :ivar value: what the method returned, or None if it failed
+    :ivar Exception error: the exception that was raised, or None
+    :ivar float started: when the job started (as returned by
+        :func:`time.time`)
+    :ivar float duration: how many seconds the job took, including
+        connecting to the host
+    """
+
+    __slots__ = ('label', 'value', 'error', 'started', 'duration')
+
+    def __init__(self, label, value=None, error=None, started=None,
+            duration=None):
+        self.label = label
+        self.value = value
+        self.error = error
+        self.started = started
+        self.duration = duration
+
+    @property
+    def ok(self):
+        """
+        True if the job finished without an exception.
+        """
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return "FleetResult({!r}, value={!r}, duration={:.3f})".format(
+                    self.label, self.value, self.duration)
+        return "FleetResult({!r}, error={!r}, duration={:.3f})".format(
+                self.label, self.error, self.duration)
+
+class Fleet:
+    """
+    A group of hosts that jobs can be run on in parallel.
+
+    :param list labels: the labels of the hosts (the default is every host
+        in the inventory)
+    :param int workers: the maximum number of hosts worked on at the same
+        time
+
+    Any other keyword arguments (such as *user* and *passwd*) are passed
+    on to :func:`~pigrizia.host.get_host`.
+    """
+
+    def __init__(self, labels=None, workers=10, **kwargs):
+        self.labels = list(labels) if labels is not None else get_labels()
+        self.workers = workers
+        self._kwargs = kwargs
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def host(self, label):
+        """
+        Gets the host object for a label. Hosts are only detected once
+        per fleet.
+
+        :param str label: the label of the host
+        :rtype: a subclass of :class:`~pigrizia.host.Host`
+        """
+        with self._lock:
+            host = self._hosts.get(label)
+        if host is None:
+            host = get_host(label=label, **self._kwargs)
+            with self._lock:
+                host = self._hosts.setdefault(label, host)
+        return host
+
+    def run(self, method, *args, **kwargs):
+        """
+        Calls a host method on every host in the fleet.
+
+        :param str method: the name of the method, e.g. ``'checksum'``
+        :return: yields a :class:`FleetResult` for each host, in the order
+            the hosts finish
+        """
+        def job(host):
+            return getattr(host, method)(*args, **kwargs)
+        return self.map(job)
+
+    def command(self, cmd, **kwargs):
+        """
+        Runs a command on every host in the fleet. The value of each
+        result is a tuple of exit code, stdout and stderr.
+
+        :param str cmd: the command to run, including arguments
+        :param bool sudo: if True the command will be run using sudo
+        :return: yields a :class:`FleetResult` for each host, in the order
+            the hosts finish
+        """
+        def job(host):
+            return host.command(cmd, **kwargs)
+        return self.map(job)
+
+    def copy(self, src, dest, relay=False, **kwargs):
+        """
+        Copies a local file to every host in the fleet.
+
+        The file is mapped into memory and hashed once for every checksum
+        algorithm the hosts use, and every upload is sent from the same
+        mapping. Each host checks the checksum of what it received before
+        the file is put in place, so the value of a successful result is
+        the checksum, and a failed check shows up as a
+        :class:`~pigrizia.command.handler.remote.CopyFailed` error.
+
+        With *relay*, hosts that already have the file pass it on to the
+        hosts that don't, with ``scp``, instead of everything being sent
+        from here. This needs key-based SSH between the hosts; if a relay
+        doesn't work, the file is sent from here instead.
+
+        :param str src: the local file
+        :param str dest: where to put the file on the hosts
+        :param bool relay: if True, hosts pass the file on to each other
+        :param str hash: the checksum algorithm (see
+            :mod:`~pigrizia.command.handler.checksum`). The default is the
+            setting of each host.
+        :param bool sudo: if True the file is put in place using sudo
+        :return: yields a :class:`FleetResult` for each host, in the order
+            the hosts finish
+        """
+        with open(src, 'rb') as f:
+            if os.fstat(f.fileno()).st_size > 0:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = b''
+        try:
+            yield from self._copy(data, dest, relay, **kwargs)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+    def _copy(self, data, dest, relay, **kwargs):
+        # The checksums of data, by algorithm.
+        digests = {}
+        lock = threading.Lock()
+
+        # Hosts that have the file and aren't busy passing it on.
+        seeds = queue.Queue()
+
+        def job(host):
+            options = dict(kwargs, hash=host._hash_algorithm(kwargs))
+            with lock:
+                if options['hash'] not in digests:
+                    h = checksum.new(options['hash'])
+                    h.update(data)
+                    digests[options['hash']] = h.hexdigest()
+                options['digest'] = digests[options['hash']]
+
+            seed = None
+            if relay:
+                try:
+                    seed = seeds.get_nowait()
+                except queue.Empty:
+                    pass
+            try:
+                if seed is None or not self._relay(seed, host, dest,
+                        **options):
+                    host.write_file(dest, data, **options)
+            finally:
+                if seed is not None:
+                    seeds.put(seed)
+            seeds.put(host)
+            return options['digest']
+        return self.map(job)
+
+    def install_pigrizia(self, **kwargs):
+        """
+        Installs the running Pigrizia on every host in the fleet, without
+        network access. A wheel is built once and pushed to the hosts
+        (see :mod:`~pigrizia.host.bootstrap`). Hosts that already have
+        the same version are skipped.
+
+        :param bool force: if True, install even on hosts that already
+            have the same version
+        :return: yields a :class:`FleetResult` for each host, in the order
+            the hosts finish. The value is True if Pigrizia was installed
+            and False if the host was skipped.
+        """
+        from .bootstrap import build_wheel
+        # The wheel is read once, so the hosts don't need the file.
+        with tempfile.TemporaryDirectory() as tmpdir:
+            wheel = build_wheel(tmpdir)
+            with open(wheel, 'rb') as f:
+                kwargs['wheel_data'] = f.read()
+        kwargs['wheel'] = os.path.basename(wheel)
+        yield from self.map(lambda host: host.install_pigrizia(**kwargs))
+
+    def map(self, func):
+        """
+        Calls a function with each host of the fleet. If the caller stops
+        iterating early, the jobs that haven't started are cancelled and
+        the ones that are running are waited for.
+
+        :param callable func: a function that takes a host
+        :return: yields a :class:`FleetResult` for each host, in the order
+            the hosts finish
+        """
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        futures = [executor.submit(self._job, label, func)
+                for label in self.labels]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # If the caller stops early, don't start any more jobs, and
+            # wait for the running ones, so that what they use can be
+            # cleaned up afterwards.
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def _relay(self, seed, host, dest, **kwargs):
+        # Has seed send its copy of dest to host. Returns False if that
+        # can't be done.
+        from pigrizia.command.handler.remote import RemoteHandler
+        src, target = seed.cmdh, host.cmdh
+        if not isinstance(src, RemoteHandler) or \
+                not isinstance(target, RemoteHandler):
+            return False
+
+        sudo = 'sudo' in kwargs and kwargs['sudo'] is True
+        upload = target._upload_name(dest, sudo)
+        remote = "{}@{}:{}".format(target.user, target.addr, upload)
+        cmd = "scp -q -o BatchMode=yes {} {}".format(shlex.quote(dest),
+                shlex.quote(remote))
+        try:
+            ret, out, err = src.do(cmd)
+        except NoSuchCommand:
+            return False
+        if ret != 0:
+            logger.debug("relay {} -> {} failed: {}".format(src.addr,
+                target.addr, ' '.join(err)))
+            target.do("rm -f {}".format(shlex.quote(upload)))
+            return False
+
+        ret, out, err = target._install_upload(upload, dest, **kwargs)
+        if ret != 0:
+            raise CommandFailed('\n'.join(err))
+        return True
+
+    def _job(self, label, func):
+        result = FleetResult(label, started=time.time())
+        start = time.monotonic()
+        try:
+            result.value = func(self.host(label))
+        except Exception as e:
+            logger.info("{} failed: {}".format(label, e))
+            result.error = e
+        result.duration = time.monotonic() - start
+        return result
+
+    def __len__(self):
+        return len(self.labels)
@@ -28,6 +28,7 @@ class Host:
     """
 
     _config = None
+    facts = None
 
     def __init__(self, **kwargs):
         if 'addr' in kwargs:
@@ -35,7 +36,10 @@ class Host:
         else:
             self._config = HostConfig()
 
-        if 'addr' in kwargs and kwargs['addr'] is not None:
+        if 'cmdh' in kwargs:
+            # Reuse an existing command handler (get_host does this).
+            self.cmdh = kwargs['cmdh']
+        elif 'addr' in kwargs and kwargs['addr'] is not None:
             from pigrizia.command.handler.remote import RemoteHandler
             self.cmdh = RemoteHandler(**kwargs)
         else:
@@ -0,0 +1,293 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+A host inventory in SQLite.
+
+``hosts.conf`` is fine for a few hundred hosts, but every process has to
+read all of it, and hosts can only be found by label or address. For
+large inventories the hosts can be kept in ``hosts.db`` in the
+configuration directory instead. Once that file exists it is used in
+place of ``hosts.conf`` by :mod:`pigrizia.host.config`, so
+:func:`~pigrizia.host.get_host` and :class:`~pigrizia.host.fleet.Fleet`
+work the same with either.
+
+The entries are the same as in ``hosts.conf``. Two settings are special:
+``tags`` and ``groups`` are lists of names, which are indexed so hosts
+can be selected by them. All the other settings that are single values
+(such as ``os``) are indexed as well.
+
+.. code-block :: toml
+
+    [pbx1]
+    addr = '10.0.0.5'
+    os = 'centos'
+    tags = ['pbx', 'voip']
+    groups = ['milan']
+
+::
+
+    >>> db = get_database(hosts_db)
+    >>> db.import_toml(hosts_config)
+    >>> db.select(tags='pbx', os='centos')
+    ['pbx1']
+
+:class:`HostDatabase` has the same methods as
+:class:`~pigrizia.host.inventory.Inventory`, except for *transaction*.
+"""
+
+import sqlite3
+import threading
+import contextlib
+import toml
+from .inventory import Inventory, as_list
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS hosts (
+    id INTEGER PRIMARY KEY,
+    label TEXT NOT NULL UNIQUE,
+    addr TEXT,
+    config TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hosts_addr ON hosts (addr);
+CREATE TABLE IF NOT EXISTS tags (
+    tag TEXT NOT NULL,
+    host INTEGER NOT NULL REFERENCES hosts (id) ON DELETE CASCADE,
+    PRIMARY KEY (tag, host)
+);
+CREATE INDEX IF NOT EXISTS tags_host ON tags (host);
+CREATE TABLE IF NOT EXISTS groups (
+    name TEXT NOT NULL,
+    host INTEGER NOT NULL REFERENCES hosts (id) ON DELETE CASCADE,
+    PRIMARY KEY (name, host)
+);
+CREATE INDEX IF NOT EXISTS groups_host ON groups (host);
+CREATE TABLE IF NOT EXISTS attributes (
+    key TEXT NOT NULL,
+    value,
+    host INTEGER NOT NULL REFERENCES hosts (id) ON DELETE CASCADE,
+    PRIMARY KEY (key, value, host)
+);
+CREATE INDEX IF NOT EXISTS attributes_host ON attributes (host);
+'''
+
+class HostDatabase:
+    """
+    A host inventory in an SQLite database. Use :func:`get_database` to
+    get one, so that there is only one connection per file.
+
+    :ivar str path: the database file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # The connection is shared by the threads of a fleet, always
+        # under the lock.
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                isolation_level=None)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA foreign_keys = ON")
+        self._db.execute("PRAGMA busy_timeout = 10000")
+        self._db.executescript(_schema)
+
+    def get(self, key, default=None):
+        """
+        Gets an entry.
+
+        :param str key: the label of the host
+        :param default: returned if there is no such host
+        """
+        with self._lock:
+            row = self._db.execute("SELECT config FROM hosts WHERE label = ?",
+                    (key,)).fetchone()
+        return toml.loads(row[0]) if row is not None else default
+
+    def keys(self):
+        """
+        Gets the labels of all the hosts, in the order they were added.
+
+        :rtype: list
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT label FROM hosts ORDER BY id")
+            return [row[0] for row in rows]
+
+    def lookup(self, field, value):
+        """
+        Finds the host with a value in a setting. If several hosts have
+        the value, the one that was added first is found.
+
+        :param str field: the name of the setting, such as ``'addr'``
+        :param value: the value to look for
+        :return: the label of the host, or None
+        """
+        with self._lock:
+            if field == 'addr':
+                row = self._db.execute("SELECT label FROM hosts "
+                        "WHERE addr = ? ORDER BY id LIMIT 1",
+                        (value,)).fetchone()
+            else:
+                row = self._db.execute("SELECT label FROM hosts "
+                        "JOIN attributes ON host = id "
+                        "WHERE key = ? AND value = ? ORDER BY id LIMIT 1",
+                        (field, value)).fetchone()
+        return row[0] if row is not None else None
+
+    def select(self, tags=None, groups=None, **fields):
+        """
+        Finds the hosts that have all the given tags, are in all the given
+        groups and have the given values.
+
+        :param tags: a tag or a list of tags
+        :param groups: a group or a list of groups
+        :return: the labels of the hosts, in the order they were added
+        :rtype: list
+        """
+        sql = ["SELECT label FROM hosts WHERE 1"]
+        args = []
+        for tag in as_list(tags):
+            sql.append("AND id IN (SELECT host FROM tags WHERE tag = ?)")
+            args.append(tag)
+        for group in as_list(groups):
+            sql.append("AND id IN (SELECT host FROM groups WHERE name = ?)")
+            args.append(group)
+        for key, value in fields.items():
+            sql.append("AND id IN (SELECT host FROM attributes "
+                    "WHERE key = ? AND value = ?)")
+            args.extend((key, value))
+        sql.append("ORDER BY id")
+        with self._lock:
+            rows = self._db.execute(' '.join(sql), args)
+            return [row[0] for row in rows]
+
+    def set(self, key, entry):
+        """
+        Adds or replaces a host.
+
+        :param str key: the label of the host
+        :param dict entry: the settings of the host
+        """
+        with self._transaction():
+            self._set(key, entry)
+
+    def remove(self, key):
+        """
+        Removes a host, if it is there.
+
+        :param str key: the label of the host
+        """
+        with self._transaction():
+            self._db.execute("DELETE FROM hosts WHERE label = ?", (key,))
+
+    def rename(self, old, new, entry=None):
+        """
+        Changes the label of a host. If there is no host *old*, *entry* is
+        added as *new* instead.
+
+        :param str old: the current label
+        :param str new: the new label
+        :param dict entry: the settings to add if *old* isn't there
+        """
+        with self._transaction():
+            row = self._db.execute("SELECT id FROM hosts WHERE label = ?",
+                    (old,)).fetchone()
+            if row is not None:
+                self._db.execute("DELETE FROM hosts WHERE label = ?", (new,))
+                self._db.execute("UPDATE hosts SET label = ? WHERE id = ?",
+                        (new, row[0]))
+            elif entry is not None:
+                self._set(new, entry)
+
+    def replace(self, entries):
+        """
+        Replaces all the hosts, in a single transaction.
+
+        :param dict entries: the settings of the hosts by label
+        """
+        with self._transaction():
+            self._db.execute("DELETE FROM hosts")
+            for key, entry in entries.items():
+                self._set(key, entry)
+
+    def import_toml(self, path):
+        """
+        Replaces all the hosts with the ones in a file in the format of
+        ``hosts.conf``.
+
+        :param str path: the file
+        """
+        self.replace(toml.load(path))
+
+    def export_toml(self, path):
+        """
+        Writes all the hosts to a file in the format of ``hosts.conf``.
+        The file is replaced atomically.
+
+        :param str path: the file
+        """
+        with self._lock:
+            rows = self._db.execute(
+                    "SELECT label, config FROM hosts ORDER BY id").fetchall()
+        Inventory(path).replace({label: toml.loads(config)
+            for label, config in rows})
+
+    def close(self):
+        """
+        Closes the database.
+        """
+        with self._lock:
+            self._db.close()
+
+    def _set(self, key, entry):
+        # An upsert rather than a delete and insert, so the host keeps its
+        # place in the order.
+        self._db.execute("INSERT INTO hosts (label, addr, config) "
+                "VALUES (?, ?, ?) ON CONFLICT (label) DO UPDATE "
+                "SET addr = excluded.addr, config = excluded.config",
+                (key, entry.get('addr'), toml.dumps(entry)))
+        host, = self._db.execute("SELECT id FROM hosts WHERE label = ?",
+                (key,)).fetchone()
+        for table in ('tags', 'groups', 'attributes'):
+            self._db.execute("DELETE FROM {} WHERE host = ?".format(table),
+                    (host,))
+        self._db.executemany("INSERT OR IGNORE INTO tags VALUES (?, ?)",
+                [(tag, host) for tag in as_list(entry.get('tags'))])
+        self._db.executemany("INSERT OR IGNORE INTO groups VALUES (?, ?)",
+                [(group, host) for group in as_list(entry.get('groups'))])
+        self._db.executemany("INSERT OR IGNORE INTO attributes "
+                "VALUES (?, ?, ?)", [(k, v, host)
+                    for k, v in entry.items()
+                    if isinstance(v, (str, int, float))])
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock of the database at once, so
+        # other processes wait instead of failing half way.
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+def get_database(path):
+    """
+    Gets the host database in a file, creating it if needed. The same
+    object is returned every time for the same file.
+
+    :param str path: the database file
+    :rtype: :class:`HostDatabase`
+    """
+    with _databases_lock:
+        if path not in _databases:
+            _databases[path] = HostDatabase(path)
+        return _databases[path]
@@ -0,0 +1,272 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+TOML files of host entries, such as ``hosts.conf``.
+
+An :class:`Inventory` reads its file once and keeps it in memory, along
+with indexes for looking entries up by a field (such as the address of a
+host). Before every lookup the file is checked with ``stat``, and it is
+only read again if its modification time, size or inode changed, so
+that changes made by other processes are still seen.
+
+Changes are made in a transaction, which holds a lock on the directory
+of the file, so processes don't overwrite each other's changes. All the
+changes of a transaction are written at once, to a temporary file which
+then replaces the old one. A reader never sees a half written file.
+
+    >>> inventory = get_inventory(hosts_config, indexes=('addr',))
+    >>> with inventory.transaction() as hosts:
+    ...     hosts['www'] = {'addr': '10.0.0.5'}
+    ...     hosts.pop('old', None)
+"""
+
+import os
+import copy
+import fcntl
+import tempfile
+import threading
+import contextlib
+import toml
+
+class Inventory:
+    """
+    A TOML file with one table for every entry. Use :func:`get_inventory`
+    to get one, so that there is only one per file.
+
+    :ivar str path: the file
+    """
+
+    def __init__(self, path, indexes=()):
+        self.path = path
+        self._fields = tuple(indexes)
+        self._lock = threading.RLock()
+        self._stat = None
+        self._entries = {}
+        self._indexes = {}
+        self._pending = None
+
+    def get(self, key, default=None):
+        """
+        Gets an entry. The entry is a copy, changing it doesn't change
+        the inventory.
+
+        :param str key: the key (label) of the entry
+        :param default: returned if there is no such entry
+        """
+        with self._lock:
+            self._refresh()
+            if key not in self._entries:
+                return default
+            return copy.deepcopy(self._entries[key])
+
+    def keys(self):
+        """
+        Gets the keys of all the entries, in the order of the file.
+
+        :rtype: list
+        """
+        with self._lock:
+            self._refresh()
+            return list(self._entries)
+
+    def lookup(self, field, value):
+        """
+        Finds the entry with a value in an indexed field. If several
+        entries have the value, the first one in the file is found.
+
+        :param str field: the field, one of the indexes of the inventory
+        :param value: the value to look for
+        :return: the key of the entry, or None
+        """
+        with self._lock:
+            self._refresh()
+            return self._indexes[field].get(value)
+
+    def select(self, tags=None, groups=None, **fields):
+        """
+        Finds the entries that have all the given tags, are in all the
+        given groups and have the given values.
+
+            >>> inventory.select(tags='pbx', os='centos')
+            ['pbx1', 'pbx2']
+
+        :param tags: a tag or a list of tags
+        :param groups: a group or a list of groups
+        :return: the keys of the entries, in the order of the file
+        :rtype: list
+        """
+        tags, groups = as_list(tags), as_list(groups)
+        with self._lock:
+            self._refresh()
+            # A single tag or group may be given as a string, as in
+            # HostDatabase.
+            return [key for key, entry in self._entries.items()
+                    if isinstance(entry, dict)
+                    and set(tags) <= set(as_list(entry.get('tags')))
+                    and set(groups) <= set(as_list(entry.get('groups')))
+                    and all(k in entry and entry[k] == v
+                        for k, v in fields.items())]
+
+    def set(self, key, entry):
+        """
+        Adds or replaces an entry.
+
+        :param str key: the key of the entry
+        :param dict entry: the entry
+        """
+        with self.transaction() as entries:
+            entries[key] = entry
+
+    def remove(self, key):
+        """
+        Removes an entry, if it is there.
+
+        :param str key: the key of the entry
+        """
+        with self.transaction() as entries:
+            entries.pop(key, None)
+
+    def rename(self, old, new, entry=None):
+        """
+        Changes the key of an entry. If there is no entry *old*, *entry*
+        is added as *new* instead.
+
+        :param str old: the current key
+        :param str new: the new key
+        :param dict entry: the entry to add if *old* isn't there
+        """
+        with self.transaction() as entries:
+            if old in entries:
+                entries[new] = entries.pop(old)
+            elif entry is not None:
+                entries[new] = entry
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Changes the inventory. The entries are given as a dict that can
+        be changed freely. When the block ends, the file is written if
+        anything changed. If the block raises an exception nothing is
+        written.
+
+        Transactions can be nested; the outermost one writes.
+        """
+        with self._lock:
+            if self._pending is not None:
+                yield self._pending
+                return
+            with self._file_lock():
+                self._refresh()
+                self._pending = copy.deepcopy(self._entries)
+                try:
+                    yield self._pending
+                    if self._pending != self._entries:
+                        self._write(self._pending)
+                finally:
+                    self._pending = None
+
+    def replace(self, entries):
+        """
+        Replaces all the entries.
+
+        :param dict entries: the new entries
+        """
+        with self.transaction() as current:
+            current.clear()
+            current.update(copy.deepcopy(entries))
+
+    def _refresh(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            st = None
+        key = (st.st_ino, st.st_size, st.st_mtime_ns) if st else None
+        if key == self._stat and key is not None:
+            return
+        entries = {}
+        if st is not None:
+            try:
+                entries = toml.load(self.path)
+            except FileNotFoundError:
+                pass
+        self._load(entries, key)
+
+    def _load(self, entries, key):
+        self._entries = entries
+        self._stat = key
+        self._indexes = {f: {} for f in self._fields}
+        for name, entry in entries.items():
+            if not isinstance(entry, dict):
+                continue
+            for field, index in self._indexes.items():
+                value = entry.get(field)
+                if value is not None:
+                    index.setdefault(value, name)
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        # The file itself is replaced on every write, so the lock is taken
+        # on the directory instead.
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)),
+                os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _write(self, entries):
+        dirname, basename = os.path.split(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=dirname,
+                prefix=".{}.".format(basename))
+        try:
+            try:
+                os.fchmod(fd, os.stat(self.path).st_mode & 0o7777)
+            except FileNotFoundError:
+                pass
+            with os.fdopen(fd, 'w') as f:
+                toml.dump(entries, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        st = os.stat(self.path)
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        # A copy, as the caller may still hold parts of entries.
+        self._load(copy.deepcopy(entries), key)
+
+def as_list(value):
+    """
+    Turns None or a single string into a list, for arguments that can be
+    either.
+
+    :rtype: list
+    """
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [value]
+    return list(value)
+
+_inventories = {}
+_inventories_lock = threading.Lock()
+
+def get_inventory(path, indexes=()):
+    """
+    Gets the inventory of a file. The same object is returned every time
+    for the same file.
+
+    :param str path: the file
+    :param indexes: the fields to index, used the first time only
+    :rtype: :class:`Inventory`
+    """
+    with _inventories_lock:
+        if path not in _inventories:
+            _inventories[path] = Inventory(path, indexes)
+        return _inventories[path]
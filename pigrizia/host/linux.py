@@ -4,16 +4,177 @@
 # license that can be found in the LICENSE file or at
 # https://opensource.org/licenses/MIT.
 
+import os
+import pwd
+import stat
+import re
 import logging
 import string
 import secrets
-import crypt
-import tempfile
+import shlex
+from collections import namedtuple
+from . import register
 from .host import Host, CommandFailed
+from pigrizia.command.handler.batch import Batch
+from pigrizia.command.handler.stream import STDOUT, stream_options
+from pigrizia.command.handler import checksum
+from pigrizia.service import password
 from pigrizia.service.user import UserExists, NoSuchUser
 
 logger = logging.getLogger(__name__)
 
+# Separates the sections of the probe output.
+_probe_sep = '--pigrizia-probe--'
+
+class PermissionChanges:
+    """
+    What :meth:`Linux.set_permissions` changed (or, in a dry run, would
+    have changed) in a tree.
+
+    :ivar bool ok: True if find and every chmod and chown succeeded
+    :ivar int changed: the number of entries that were changed
+    :ivar list entries: a tuple for every change: what was changed
+        (``'mode'`` or ``'owner'``), the old value, the new value and the
+        path
+    """
+
+    def __init__(self, ok, entries):
+        self.ok = ok
+        self.entries = entries
+        self.changed = len(set(e[3] for e in entries))
+
+    @classmethod
+    def parse(cls, ret, out):
+        """
+        Reads the output of the converge command.
+        """
+        entries = []
+        for line in out:
+            fields = line.split(' ', 3)
+            if len(fields) == 4 and fields[0] in ('mode', 'owner'):
+                entries.append(tuple(fields))
+        return cls(ret == 0, entries)
+
+    def __bool__(self):
+        return self.ok
+
+    def __repr__(self):
+        return "PermissionChanges(ok={!r}, changed={!r})".format(self.ok,
+                self.changed)
+
+StatResult = namedtuple('StatResult',
+        ('path', 'type', 'mode', 'uid', 'gid', 'size', 'mtime', 'inode'))
+StatResult.__doc__ = """
+The metadata of a path, as returned by :meth:`Linux.stat_many`. *type*
+is one of ``'file'``, ``'directory'``, ``'symlink'``, ``'fifo'``,
+``'socket'``, ``'char'`` and ``'block'``. *mode* is the permission bits
+only and *mtime* is in whole seconds.
+"""
+
+# The types of StatResult, by the file type bits of the mode.
+_file_types = {
+    stat.S_IFREG: 'file',
+    stat.S_IFDIR: 'directory',
+    stat.S_IFLNK: 'symlink',
+    stat.S_IFIFO: 'fifo',
+    stat.S_IFSOCK: 'socket',
+    stat.S_IFCHR: 'char',
+    stat.S_IFBLK: 'block',
+}
+
+# The most bytes of paths given to a single stat command.
+_stat_chunk = 64 * 1024
+
+class Facts:
+    """
+    Facts about a host, as gathered by :meth:`Linux.probe`. These are
+    what the *detect* methods of the host classes look at.
+
+    :ivar str uname: the kernel name (``uname -s``)
+    :ivar dict os_release: the fields of ``/etc/os-release``, with any
+        quotes removed from the values
+    :ivar set markers: the marker paths that exist on the host
+    :ivar str machine_id: the content of ``/etc/machine-id``, or None
+    """
+
+    def __init__(self, uname=None, os_release=None, markers=None,
+            machine_id=None):
+        self.uname = uname
+        self.os_release = os_release if os_release is not None else {}
+        self.markers = set(markers) if markers is not None else set()
+        self.machine_id = machine_id
+
+    @property
+    def distro(self):
+        """
+        Gets the ID field of ``/etc/os-release``, or None.
+        """
+        return self.os_release.get('ID')
+
+    def has(self, path):
+        """
+        Checks if a marker path exists on the host.
+        """
+        return path in self.markers
+
+    @staticmethod
+    def command(markers=()):
+        """
+        Builds the probe command.
+
+        :param list markers: paths to check for existence
+        :rtype: str
+        """
+        script = "uname -s; echo {sep}; cat /etc/os-release 2>/dev/null; "
+        script += "echo {sep}; for p in {paths}; do "
+        script += "test -e \"$p\" && echo \"$p\"; done; echo {sep}; "
+        script += "cat /etc/machine-id 2>/dev/null; true"
+        script = script.format(sep=_probe_sep,
+                paths=' '.join(shlex.quote(m) for m in markers) or "''")
+        return "sh -c {}".format(shlex.quote(script))
+
+    @classmethod
+    def parse(cls, out):
+        """
+        Builds the facts from the output of the probe script.
+
+        :param list out: the lines written to stdout by the probe
+        """
+        sections = [[]]
+        for line in out:
+            if line == _probe_sep:
+                sections.append([])
+            else:
+                sections[-1].append(line)
+        sections += [[]] * (4 - len(sections))
+
+        uname = sections[0][0] if sections[0] else None
+        os_release = {}
+        for line in sections[1]:
+            if '=' in line and not line.startswith('#'):
+                key, value = line.split('=', 1)
+                os_release[key.strip()] = value.strip().strip('"\'')
+        machine_id = sections[3][0].strip() if sections[3] else None
+        return cls(uname, os_release, sections[2], machine_id or None)
+
+    @classmethod
+    def from_fingerprint(cls, fingerprint):
+        """
+        Rebuilds (part of) the facts from a stored fingerprint. Only the
+        ID field of ``/etc/os-release`` is known, and no markers.
+
+        :param dict fingerprint: see :mod:`pigrizia.host.fingerprint`
+        """
+        os_release = {}
+        if 'os_id' in fingerprint:
+            os_release['ID'] = fingerprint['os_id']
+        return cls(fingerprint.get('uname'), os_release,
+                machine_id=fingerprint.get('machine_id'))
+
+    def __repr__(self):
+        return "Facts(uname={!r}, distro={!r}, markers={!r})".format(
+                self.uname, self.distro, sorted(self.markers))
+
 class Linux(Host):
     """
     This represents a system running some form of Linux.
@@ -30,16 +191,35 @@ class Linux(Host):
         default is False.
     """
 
+    _users = None
+    _python = None
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
     @property
     def python(self, **kwargs):
         """
-        Gets this Linux host's Python service.
+        Gets this Linux host's Python service. The service is created
+        once per host, so the facts and the package list it gathers are
+        kept.
+        """
+        if self._python is None:
+            from pigrizia.service.python import Python
+            self._python = Python(self, **kwargs)
+        return self._python
+
+    @property
+    def users(self):
+        """
+        Gets the users and groups of this host. There is one
+        :class:`~pigrizia.service.user.UserDatabase` per host, so a
+        snapshot taken through it is seen by all the methods of the host.
         """
-        from pigrizia.service.python import Python
-        return Python(self, **kwargs)
+        if self._users is None:
+            from pigrizia.service.user import UserDatabase
+            self._users = UserDatabase(self)
+        return self._users
 
     def directory_exists(self, path, **kwargs):
         """ 
@@ -49,6 +229,8 @@ class Linux(Host):
         :returns: True if path is a directory or False if it isn't
         :rtype: bool
         """
+        if self._is_local(**kwargs):
+            return os.path.isdir(path)
         cmd = "test -d {}".format(path)
         ret, out, err = self._call(cmd, **kwargs)
         return ret == 0
@@ -61,6 +243,8 @@ class Linux(Host):
         :returns: True if the path is a file or False if it isn't
         :rtype: bool
         """
+        if self._is_local(**kwargs):
+            return os.path.isfile(path)
         cmd = "test -f {}".format(path)
         ret, out, err = self._call(cmd, **kwargs)
         return ret == 0
@@ -70,6 +254,17 @@ class Linux(Host):
         Gets the permissions for the specified path.
         """
 
+        if self._is_local():
+            try:
+                mode = os.lstat(path).st_mode
+            except OSError:
+                # Let stat report the error, as usual.
+                pass
+            else:
+                if 'human-readable' in kwargs:
+                    return stat.filemode(mode)
+                return format(stat.S_IMODE(mode), 'o')
+
         f = '%A' if 'human-readable' in kwargs else '%a'
         cmd = "stat -c {} {}".format(f, path)
         ret, out, err = self._call(cmd)
@@ -78,28 +273,108 @@ class Linux(Host):
     def set_permissions(self, path, **kwargs):
         """
         Set permission on a path.
+
+        Modes can be given as ints, which are real modes (``0o644``,
+        not ``644``), or as strings that chmod understands.
+
+        With *recursive*, the tree under *path* is walked once, with a
+        single ``find`` command, and only the entries that don't already
+        have the wanted mode (or owner) are changed. With *dry_run*
+        nothing is changed, and the result tells what would be. The modes
+        must then be ints or octal strings, since an entry can only be
+        compared with an exact mode. If only *owner* or only *group* is
+        given, the other is left as it is.
+
+        :param permission: the mode, if not *recursive*
+        :param bool recursive: if True, converge the whole tree
+        :param dirs: the mode of directories
+        :param files: the mode of regular files
+        :param str owner: the owner of every entry
+        :param str group: the group of every entry
+        :param bool dry_run: if True, only report what would be changed
+        :return: if *recursive*, the changes, else True if chmod succeeded
+        :rtype: :class:`PermissionChanges` or bool
         """
         if 'recursive' in kwargs:
-            if 'dirs' in kwargs:
-                cmd = 'find {} -type d -exec chmod {} {{}} +'.format(
-                        path, kwargs['dirs'])
-                retd, outd, errd = self._call(cmd, **kwargs)
-            if 'files' in kwargs:
-                cmd = 'find {} -type f -exec chmod {} {{}} +'.format(
-                        path, kwargs['files'])
-                retf, outf, errf = self._call(cmd, **kwargs)
-            return retd == 0 and retf == 0
+            cmd = _converge_command(path, kwargs)
+            ret, out, err = self._call(cmd, **kwargs)
+            return PermissionChanges.parse(ret, out or [])
         else:
             if 'permission' in kwargs:
-                cmd = 'chmod {} {}'.format(path, kwargs['permission'])
+                cmd = 'chmod {} {}'.format(_mode(kwargs['permission']),
+                        shlex.quote(path))
+                ret, out, err = self._call(cmd, **kwargs)
+                return ret == 0
             else:
                 # TODO: exception here?
                 return 1
 
+    def stat_many(self, paths, **kwargs):
+        """
+        Gets the metadata of many paths at once. Symbolic links are not
+        followed. On the local host this uses :func:`os.lstat`, on other
+        hosts a single ``stat`` command is run for every few thousand
+        paths, all of them in one batch. With *sudo* the ``stat`` commands
+        are run using sudo, unless this is the local host and we are
+        already root.
+
+        :param list paths: the paths
+        :param bool sudo: if True, paths that only root can see are found
+        :return: a result for every path, in the same order, with None
+            for the paths that don't exist (or can't be read)
+        :rtype: list of :class:`StatResult`
+        """
+        paths = list(paths)
+        if self._is_local(**kwargs):
+            results = []
+            for path in paths:
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    results.append(None)
+                    continue
+                results.append(StatResult(path,
+                    _file_types.get(stat.S_IFMT(st.st_mode)),
+                    stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid,
+                    st.st_size, int(st.st_mtime), st.st_ino))
+            return results
+
+        chunks, chunk, size = [], [], 0
+        for path in paths:
+            arg = shlex.quote(path)
+            if chunk and size + len(arg) > _stat_chunk:
+                chunks.append(chunk)
+                chunk, size = [], 0
+            chunk.append(arg)
+            size += len(arg) + 1
+        if chunk:
+            chunks.append(chunk)
+        # The entries end with a NUL rather than a newline, since a path
+        # can have a newline in it. The handler still splits the output
+        # into lines, so they are joined again first.
+        cmd = "stat --printf '%i %f %u %g %s %Y %n\\0' -- {}"
+        with self.batch(**kwargs) as b:
+            deferreds = [b.call(cmd.format(' '.join(c))) for c in chunks]
+
+        found = {}
+        for d in deferreds:
+            for entry in '\n'.join(d.out).split('\0'):
+                fields = entry.split(' ', 6)
+                if len(fields) == 7:
+                    found[fields[6]] = _parse_stat(fields)
+        return [found.get(path) for path in paths]
+
     def mkdir(self, path, **kwargs):
         """
         Creates the specified directory.
         """
+        if self._is_local(**kwargs):
+            try:
+                os.makedirs(path, exist_ok=True)
+                return 0
+            except OSError:
+                # Let mkdir report the error, as usual.
+                pass
         cmd = "mkdir -p {}".format(path)
         ret, out, err = self._call(cmd, **kwargs)
         return ret
@@ -115,6 +390,17 @@ class Linux(Host):
         ret, out, err = self._call(cmd, **kwargs)
         return ret
 
+    def command(self, cmd, **kwargs):
+        """
+        Runs a command on the host.
+
+        :param str cmd: the command to run, including arguments
+        :param bool sudo: if True the command will be run using sudo
+        :returns: exit code, stdout and stderr of the command
+        :rtype: tuple
+        """
+        return self._call(cmd, **kwargs)
+
     def whoami(self, **kwargs):
         """
         Gets the name of the current user.
@@ -122,6 +408,11 @@ class Linux(Host):
         :returns: the name of the current user
         :rtype: str
         """
+        if self._is_local(**kwargs):
+            try:
+                return pwd.getpwuid(os.geteuid()).pw_name
+            except KeyError:
+                pass
         ret, out, err = self._call("whoami", **kwargs)
         return out[0] if len(out) > 0 else ''
 
@@ -137,29 +428,85 @@ class Linux(Host):
         if self.user_exists(user):
             raise UserExists(user)
 
-        cmd = "useradd"
-
-        if 'create_home' in kwargs and kwargs['create_home'] == False:
-            pass
-        else:
-            cmd += " -m"
-
         if 'passwd' in kwargs:
             passwd = kwargs['passwd']
         else:
             passwd = self._gen_password()
-        passwd = self._crypt(passwd)
 
         # TODO: if the password above was generated, then the only 
         # reference to it is this one local variable. We better do
         # something with that password or it will get lost forever.
 
-        cmd += ' -p {}'.format(passwd)
-        cmd += ' {}'.format(user)
+        crypted = password.hash_password(passwd,
+                *self._crypt_options(kwargs))
+        cmd = self._useradd_command(user, crypted, **kwargs)
         kwargs['sudo'] = True
         ret, out, err = self._call(cmd, **kwargs)
+        self.users.invalidate()
         return ret == 0
 
+    def useradd_many(self, users, **kwargs):
+        """
+        Adds many users at once. The users that already exist are found
+        with a single look at the user database, and all the others are
+        added with a single sudo command.
+
+            >>> for r in host.useradd_many(['ann', {'user': 'bob'}]):
+            ...     print(r.user, r.ok, r.passwd)
+
+        The passwords are hashed in parallel, see
+        :func:`~pigrizia.service.password.hash_passwords`.
+
+        :param list users: the users to add. Each is either a name or a
+            dict with the key *user* and, optionally, *passwd* and
+            *create_home*, which mean the same as for :meth:`useradd`.
+        :param str crypt_method: the hashing method (the default is the
+            ``crypt_method`` setting of the host, else SHA-512)
+        :param int crypt_rounds: the number of hashing rounds (the
+            default is the ``crypt_rounds`` setting of the host)
+        :param int workers: the number of processes that hash passwords
+        :return: the outcome for each user, in the same order. Users
+            without a *passwd* get a generated password, which is only
+            found in the outcome.
+        :rtype: list of :class:`~pigrizia.service.user.UserResult`
+
+        Any other keyword arguments (such as *passwd*, for sudo) are
+        passed on to the commands.
+        """
+        from pigrizia.service.user import UserResult
+        options = {k: v for k, v in kwargs.items() if k not in
+                ('crypt_method', 'crypt_rounds', 'workers', 'sudo')}
+        specs = [{'user': u} if isinstance(u, str) else dict(u)
+                for u in users]
+        self.users.snapshot(**options)
+        seen = set()
+        new = []
+        for spec in specs:
+            user = spec['user']
+            if user in seen or self.users.user_exists(user):
+                spec['error'] = UserExists(user)
+                continue
+            seen.add(user)
+            if 'passwd' not in spec:
+                spec['passwd'] = spec['generated'] = self._gen_password()
+            new.append(spec)
+
+        workers = kwargs['workers'] if 'workers' in kwargs else None
+        hashes = password.hash_passwords([s['passwd'] for s in new],
+                *self._crypt_options(kwargs), workers=workers)
+        try:
+            with self.batch(sudo=True, **options) as b:
+                for spec, crypted in zip(new, hashes):
+                    cmd = self._useradd_command(spec['user'], crypted,
+                            create_home=spec.get('create_home', True))
+                    spec['result'] = b.call(cmd)
+        finally:
+            # Some of the users may have been added even if it failed.
+            self.users.invalidate()
+        return [_user_result(UserResult, s['user'],
+            s['error'] if 'error' in s else s['result'], s.get('generated'))
+            for s in specs]
+
     def userdel(self, user, **kwargs):
         """
         Removes a user from the current system
@@ -174,8 +521,40 @@ class Linux(Host):
         cmd = 'userdel -r {}'.format(user)
         kwargs['sudo'] = True
         ret, out, err = self._call(cmd, **kwargs)
+        self.users.invalidate()
         return ret == 0
 
+    def userdel_many(self, users, **kwargs):
+        """
+        Removes many users at once, with a single sudo command.
+
+        :param list users: the names of the users to remove
+        :return: the outcome for each user, in the same order
+        :rtype: list of :class:`~pigrizia.service.user.UserResult`
+
+        Any other keyword arguments (such as *passwd*, for sudo) are
+        passed on to the commands.
+        """
+        from pigrizia.service.user import UserResult
+        options = {k: v for k, v in kwargs.items() if k != 'sudo'}
+        self.users.snapshot(**options)
+        seen = set()
+        queued = []
+        try:
+            with self.batch(sudo=True, **options) as b:
+                for user in users:
+                    if user in seen or not self.users.user_exists(user):
+                        queued.append((user, NoSuchUser(user)))
+                        continue
+                    seen.add(user)
+                    cmd = "userdel -r {}".format(shlex.quote(user))
+                    queued.append((user, b.call(cmd)))
+        finally:
+            # Some of the users may have been removed even if it failed.
+            self.users.invalidate()
+        return [_user_result(UserResult, user, result)
+                for user, result in queued]
+
     def user_exists(self, user, **kwargs):
         """
         Checks if a user exists on the current system.
@@ -184,12 +563,7 @@ class Linux(Host):
         :return: True if the user exists or False if they don't
         :rtype: bool
         """
-        cmd = "cat /etc/passwd"
-        ret, out, err = self._call(cmd, **kwargs)
-        for line in out:
-            if line.startswith("{}:".format(user)):
-                return True
-        return False
+        return self.users.user_exists(user, **kwargs)
 
     def uname(self, **kwargs):
         """
@@ -198,8 +572,8 @@ class Linux(Host):
         :return: the kernel name
         :rtype: str
         """
-        ret, out, err = self_call("uname")
-        return ret[0]
+        ret, out, err = self._call("uname", **kwargs)
+        return out[0]
 
     def distro(self, **kwargs):
         """
@@ -209,41 +583,197 @@ class Linux(Host):
             if the file does not exist
         :rtype: str or NoneType
         """
-        if not self.file_exists('/etc/os-release'):
+        if self._is_local(**kwargs):
+            out = _read_lines('/etc/os-release')
+            ret = 0 if out is not None else 1
+        else:
+            cmd = "cat /etc/os-release"
+            ret, out, err = self._call(cmd, **kwargs)
+        if ret != 0:
             return None
-
-        cmd = "cat /etc/os-release"
-        ret, out, err = self._call(cmd, **kwargs)
         for line in out:
             if line.startswith("ID="):
                 return line.split('=')[1] 
         # Hopefully we don't get here, but ...
         return None
 
-    def read_file(self, fname, **kwargs):
+    def machine_id(self, **kwargs):
+        """
+        Reads the machine ID of this host. This is a unique ID that stays
+        the same for as long as the system is installed.
+
+        :return: the content of /etc/machine-id, or None if there is no
+            machine ID
+        :rtype: str or NoneType
+        """
+        ret, out, err = self._call("cat /etc/machine-id", **kwargs)
+        if ret != 0 or len(out) == 0:
+            return None
+        return out[0].strip()
+
+    def read_file(self, fname, binary=False, **kwargs):
         """
         Reads in and returns the specified file.
 
+        The file is read directly (over SFTP for remote hosts), unless
+        *sudo* is True, in which case it is streamed through ``cat``.
+
         :param str fname: the name of the file
+        :param bool binary: if True the content is returned as bytes
         :returns: the content of the file
-        :rtype: str
+        :rtype: str or bytes
+        :raises FileNotFoundError: if the file does not exist
+        """
+        sudo = 'sudo' in kwargs and kwargs['sudo'] is True
+        if sudo and not self._is_local(**kwargs):
+            data = b''.join(self.iter_chunks(fname, **kwargs))
+        else:
+            data = self.cmdh.read(fname)
+        return data if binary else data.decode()
+
+    def iter_chunks(self, fname, chunk_size=65536, **kwargs):
+        """
+        Iterates over the content of the specified file in chunks of
+        bytes, without reading the whole file into memory.
+
+        :param str fname: the name of the file
+        :param int chunk_size: the largest chunk to return at a time
+        :returns: yields the chunks of the file
+        :raises FileNotFoundError: if the file does not exist
+        """
+        if 'sudo' in kwargs and kwargs['sudo'] is True:
+            cmd = "cat {}".format(fname)
+            with self._stream(cmd, binary=True, chunk_size=chunk_size,
+                    **kwargs) as stream:
+                err = []
+                for fd, chunk in stream:
+                    if fd == STDOUT:
+                        yield chunk
+                    else:
+                        err.append(chunk)
+                if stream.ret != 0:
+                    raise _read_error(fname, b''.join(err).decode())
+        else:
+            yield from self.cmdh.read_chunks(fname, chunk_size)
+
+    def read_into(self, fname, buffer, **kwargs):
+        """
+        Reads the specified file into a preallocated buffer. Reading stops
+        at the end of the file or when the buffer is full.
+
+            >>> buf = bytearray(65536)
+            >>> n = host.read_into('/etc/hosts', buf)
+            >>> buf[:n]
+
+        :param str fname: the name of the file
+        :param buffer: a writable buffer, such as a ``bytearray`` or a
+            ``memoryview``
+        :returns: the number of bytes read
+        :rtype: int
+        :raises FileNotFoundError: if the file does not exist
+        """
+        if 'sudo' in kwargs and kwargs['sudo'] is True:
+            view = memoryview(buffer).cast('B')
+            pos = 0
+            for chunk in self.iter_chunks(fname, **kwargs):
+                n = min(len(chunk), len(view) - pos)
+                view[pos:pos + n] = chunk[:n]
+                pos += n
+                if pos == len(view):
+                    break
+            return pos
+        return self.cmdh.read_into(fname, buffer)
+
+    def iter_lines(self, fname, **kwargs):
+        """
+        Iterates over the lines of the specified file, without reading
+        the whole file into memory.
+
+        :param str fname: the name of the file
+        :returns: yields the lines, without line endings
         """
         cmd = "cat {}".format(fname)
-        ret, out, err = self._call(cmd, **kwargs)
-        return '\n'.join(out)
+        with self._stream(cmd, **kwargs) as stream:
+            yield from stream.lines()
 
     def write_file(self, fname, content, **kwargs):
         """
         Write a file.
 
+        The content is sent straight from memory and renamed into place
+        once it has been verified (see the *write* method of the command
+        handlers).
+
         :param str fname: the name of the file to write
-        :param str content: the content of the file
+        :param content: the content of the file
+        :type content: str or bytes
+        :param bool sudo: if True the file is written using sudo
+        :raises CommandFailed: if the file could not be written
+        """
+        if isinstance(content, str):
+            content = content.encode()
+        ret, out, err = self.cmdh.write(fname, content, **kwargs)
+        if ret != 0:
+            raise CommandFailed('\n'.join(str(e) for e in err))
+
+    def copy_tree(self, src, dest, **kwargs):
+        """
+        Copies a local directory tree to this host. The tree is sent as a
+        single tar stream and unpacked by one command, and the unpacked
+        files are then checked against a manifest of checksums.
+
+        Modes are kept. Ownership is kept when sudo is used, otherwise
+        the files belong to the user.
+
+        :param str src: the local directory
+        :param str dest: the directory to unpack to (created if needed)
+        :param str compress: None (the default), ``'gz'``, ``'bz2'`` or
+            ``'xz'``
+        :param str hash: the checksum algorithm of the manifest, see
+            :meth:`checksum`
+        :param bool sudo: if True the tree is unpacked using sudo
+        :return: the number of files copied
+        :rtype: int
+        :raises CopyFailed: if the manifest doesn't match what was
+            unpacked
+        :raises CommandFailed: if the tree could not be unpacked
+        :raises ValueError: if the compression isn't supported
         """
-        with tempfile.NamedTemporaryFile() as f:
-            f.write(content.encode())
-            f.flush()
-            ret, out, err = self.cmdh.copy(f.name, fname)
-        # TODO: we should probably check ret and act on it...
+        from pigrizia.command.handler.remote import CopyFailed
+        from . import archive
+
+        compress = kwargs['compress'] if 'compress' in kwargs else None
+        if compress not in archive.compressions:
+            raise ValueError("unsupported compression: {}".format(compress))
+        algorithm = self._hash_algorithm(kwargs)
+        sudo = 'sudo' in kwargs and kwargs['sudo'] is True
+        manifest = ".pigrizia-manifest-{}".format(secrets.token_hex(8))
+        tar = "tar -x -p {} -f - -C \"$dest\"".format(
+                '--same-owner' if sudo else '--no-same-owner')
+        if archive.compressions[compress]:
+            tar += " -{}".format(archive.compressions[compress])
+        script = '\n'.join([
+            "dest={}".format(shlex.quote(dest)),
+            "mkdir -p \"$dest\" && {} && cd \"$dest\" || exit 2".format(
+                tar),
+            "{} -c --quiet {}".format(checksum.command(algorithm),
+                manifest),
+            "ret=$?",
+            "rm -f {}".format(manifest),
+            "[ $ret -eq 0 ] || exit 3",
+        ])
+
+        count = []
+        def produce(f):
+            count.append(archive.write_tree(src, f, manifest, algorithm,
+                compress))
+        cmd = "sh -c {}".format(shlex.quote(script))
+        ret, out, err = self.cmdh.pipe(cmd, produce, **kwargs)
+        if ret == 3:
+            raise CopyFailed('\n'.join(out + err))
+        elif ret != 0:
+            raise CommandFailed('\n'.join(err))
+        return count[0]
 
     def mktemp(self, **kwargs):
         """
@@ -258,6 +788,13 @@ class Linux(Host):
         :rtype: str
         :raises CommandFailed: if the mktemp command failed
         """
+        if self._is_local(**kwargs):
+            try:
+                return _mktemp(**kwargs)
+            except OSError:
+                # Let mktemp report the error, as usual.
+                pass
+
         cmd = "mktemp"
         if 'create_dir' in kwargs and kwargs['create_dir'] == True:
             cmd += " -d"
@@ -271,46 +808,175 @@ class Linux(Host):
 
     def checksum(self, fname, **kwargs):
         """
-        Returns the (SHA-512) checksum of the specified file.
+        Returns the checksum of the specified file. On the local host, the
+        file is hashed in-process unless sudo is used.
 
         :param str fname: the file to get the checksum for
-        :returns: the SHA-512 checksum
+        :param str hash: the algorithm (see
+            :mod:`~pigrizia.command.handler.checksum`), by default the
+            one configured for the host, or SHA-512
+        :returns: the checksum
         :rtype: str
         :raises CommandFailed: if the command failed
         """
-        cmd = "sha512sum {}".format(fname)
+        algorithm = self._hash_algorithm(kwargs)
+        if self._is_local(**kwargs):
+            try:
+                return checksum.file_checksum(fname, algorithm)
+            except OSError as e:
+                raise CommandFailed(str(e))
+
+        cmd = "{} {}".format(checksum.command(algorithm), fname)
         ret, out, err = self._call(cmd, **kwargs)
         if ret == 0:
             return out[0].split()[0]
         else:
             raise CommandFailed(err)
 
-    def has_pigrizia(self, **kwargs):
+    def checksum_many(self, fnames, **kwargs):
+        """
+        Returns the checksums of several files. On a remote host, all the
+        checksums are computed in a single round-trip.
+
+        :param list fnames: the files to get the checksums for
+        :param str hash: the algorithm, see :meth:`checksum`
+        :returns: a dictionary of file names to checksums
+        :rtype: dict
+        :raises CommandFailed: if the checksum of any file could not be
+            computed
+        """
+        kwargs['hash'] = self._hash_algorithm(kwargs)
+        if self._is_local(**kwargs):
+            return {f: self.checksum(f, **kwargs) for f in fnames}
+
+        with self.batch(**kwargs) as b:
+            results = {f: b.checksum(f, **kwargs) for f in fnames}
+        return {f: d.value for f, d in results.items()}
+
+    def has_pigrizia(self, version=None, **kwargs):
         """
         Checks if Pigrizia is already installed on this host.
 
+        :param str version: if given, Pigrizia must be at this version
         :returns: True if Pigrizia is installed, otherwise False
         :rtype: bool
         """
-        cmd = "python3 -c 'import pigrizia'"
+        installed = self.pigrizia_version(**kwargs)
+        if installed is None:
+            return False
+        return version is None or installed == version
+
+    def pigrizia_version(self, **kwargs):
+        """
+        Gets the version of Pigrizia installed on this host.
+
+        :return: the version, an empty string if the installed Pigrizia
+            is too old to tell, or None if it isn't installed
+        :rtype: str or NoneType
+        """
+        script = "import pigrizia; print(getattr(pigrizia, '__version__', " \
+                "''))"
+        cmd = "python3 -c {}".format(shlex.quote(script))
         ret, out, err = self._call(cmd, **kwargs)
-        return ret == 0
+        if ret != 0:
+            return None
+        return out[0] if out else ''
 
     def install_pigrizia(self, **kwargs):
         """
         Installs Pigrizia on this host.
+
+        With *wheel*, the wheel (see
+        :func:`~pigrizia.host.bootstrap.build_wheel`) is copied to the host
+        and installed from there, without network access. Pigrizia isn't
+        installed again if the host already has the version of the wheel.
+
+        :param str wheel: the local path of a wheel of Pigrizia
+        :param bytes wheel_data: the content of the wheel, if it has
+            already been read. *wheel* then only gives its file name.
+        :param bool force: if True, install even if the host already has
+            the same version
+        :return: True if Pigrizia was installed, False if the host already
+            had it
+        :rtype: bool
+        :raises CommandFailed: if pip failed
+
+        Any other keyword arguments (such as *passwd*) are passed on to
+        the commands.
         """
-        # TODO: determine the Python version
-        pydir = '/usr/local/lib/python3.7'
-        if self.permissions(pydir) != '750':
+        force = 'force' in kwargs and kwargs['force'] is True
+        wheel = kwargs['wheel'] if 'wheel' in kwargs else None
+        data = kwargs['wheel_data'] if 'wheel_data' in kwargs else None
+        # What is left is for the commands, which pick sudo themselves.
+        kwargs = {k: v for k, v in kwargs.items()
+                if k not in ('wheel', 'wheel_data', 'force', 'sudo')}
+        if wheel is not None and not force:
+            # The version is in the file name of a wheel.
+            version = os.path.basename(wheel).split('-')[1]
+            if self.has_pigrizia(version=version, **kwargs):
+                logger.info("{} already has pigrizia {}".format(self,
+                    version))
+                return False
+
+        pydir = '/usr/local/lib/python{}'.format(self.python.version())
+        if self.permissions(pydir, **kwargs) != '750':
             logger.warn("Permissions on {} are wrong, fixing".format(
                 pydir))
-            self.set_permissions(pydir, recursive=True, dirs=755,
-                    files=644, sudo=True)
+            self.set_permissions(pydir, recursive=True, dirs=0o755,
+                    files=0o644, sudo=True, **kwargs)
+
+        options = ['--force-reinstall'] if force else []
+        if wheel is None:
+            # TODO: url should eventually be changed.
+            url = "git+https://github.com/lcabrini/pigrizia"
+            ok = self.python.install(*options, url, sudo=True, **kwargs)
+        else:
+            if data is None:
+                with open(wheel, 'rb') as f:
+                    data = f.read()
+            tmpdir = self.mktemp(create_dir=True, **kwargs)
+            try:
+                # pip wants the file name of the wheel as it is.
+                dest = '/'.join((tmpdir, os.path.basename(wheel)))
+                self.write_file(dest, data, **kwargs)
+                ok = self.python.install('--no-index', '--no-deps',
+                        *options, dest, sudo=True, **kwargs)
+            finally:
+                self.rmdir(shlex.quote(tmpdir), recursive=True, **kwargs)
+        if not ok:
+            raise CommandFailed("could not install pigrizia")
+        return True
+
+    def batch(self, **kwargs):
+        """
+        Starts a batch of commands on this host. The methods of the batch
+        mirror the query methods of this class, but instead of running a
+        command they queue it and return a
+        :class:`~pigrizia.command.handler.batch.Deferred`. All queued
+        commands are sent in one go at the end of the ``with`` block.
+
+            >>> with host.batch() as b:
+            ...     checks = [b.file_exists(p) for p in paths]
+            >>> [c.value for c in checks]
+            [True, False, ...]
+
+        :param bool sudo: if True, all commands are run using sudo
+        :rtype: :class:`LinuxBatch`
+        """
+        return LinuxBatch(self, **kwargs)
 
-        # TODO: url should eventually be changed.
-        cmd = "pip3 install git+https://github.com/lcabrini/pigrizia"
-        ret, out, err = self._call(cmd, sudo=True, **kwargs)
+    def probe(self, markers=(), **kwargs):
+        """
+        Gathers the facts needed to detect what kind of system this is,
+        as well as the machine ID. Everything is collected with a single
+        command.
+
+        :param list markers: paths to check for existence
+        :returns: the facts about this host
+        :rtype: :class:`Facts`
+        """
+        ret, out, err = self._call(Facts.command(markers), **kwargs)
+        return Facts.parse(out or [])
 
     def _call(self, cmd, **kwargs):
         if 'sudo' in kwargs and kwargs['sudo'] is True:
@@ -318,16 +984,229 @@ class Linux(Host):
         else:
             return self.cmdh.do(cmd)
 
+    def _is_local(self, **kwargs):
+        # True if this is the local host and the call can be served
+        # in-process. sudo is only needed if it changes who we are.
+        from pigrizia.command.handler.local import LocalHandler
+        if not isinstance(self.cmdh, LocalHandler):
+            return False
+        if 'sudo' in kwargs and kwargs['sudo'] is True:
+            return os.geteuid() == 0 and 'user' not in kwargs
+        return True
+
+    def _hash_algorithm(self, kwargs):
+        # The hash keyword argument, else the setting for this host.
+        if 'hash' not in kwargs or kwargs['hash'] is None:
+            kwargs = {'hash': self.config.get('hash')}
+        return checksum.select_algorithm(kwargs)
+
+    def _stream(self, cmd, **kwargs):
+        if 'sudo' in kwargs and kwargs['sudo'] is True:
+            return self.cmdh.sudo_stream(cmd, **stream_options(kwargs))
+        else:
+            return self.cmdh.do_stream(cmd, **stream_options(kwargs))
+
+    def _useradd_command(self, user, crypted, **kwargs):
+        cmd = "useradd"
+        if 'create_home' in kwargs and kwargs['create_home'] == False:
+            pass
+        else:
+            cmd += " -m"
+        # The hash has $ signs in it, so it must be quoted.
+        cmd += ' -p {}'.format(shlex.quote(crypted))
+        cmd += ' {}'.format(shlex.quote(user))
+        return cmd
+
     def _gen_password(self):
         alpha = string.ascii_letters + string.digits
         return ''.join(secrets.choice(alpha) for i in range(12))
 
-    def _crypt(self, passwd):
-        return crypt.crypt(passwd, crypt.mksalt())
+    def _crypt_options(self, kwargs):
+        # The hashing method and rounds from the keyword arguments, else
+        # from the settings of this host.
+        options = []
+        for key in ('crypt_method', 'crypt_rounds'):
+            if key in kwargs and kwargs[key] is not None:
+                options.append(kwargs[key])
+            else:
+                options.append(self.config.get(key))
+        return options
 
     def __str__(self):
         return "Linux"
 
+class LinuxBatch(Batch):
+    """
+    A batch of commands on a :class:`Linux` host. Use
+    :meth:`Linux.batch` to get one.
+
+    Each method returns a :class:`~pigrizia.command.handler.batch.Deferred`
+    whose *value* is what the :class:`Linux` method of the same name
+    would have returned.
+    """
+
+    def __init__(self, host, **kwargs):
+        super().__init__(host.cmdh, **kwargs)
+        self.host = host
+
+    def directory_exists(self, path, **kwargs):
+        cmd = "test -d {}".format(path)
+        return self.call(cmd, parse=_succeeded, **kwargs)
+
+    def file_exists(self, path, **kwargs):
+        cmd = "test -f {}".format(path)
+        return self.call(cmd, parse=_succeeded, **kwargs)
+
+    def permissions(self, path, **kwargs):
+        f = '%A' if 'human-readable' in kwargs else '%a'
+        cmd = "stat -c {} {}".format(f, path)
+        return self.call(cmd, parse=_first_line, **kwargs)
+
+    def mkdir(self, path, **kwargs):
+        cmd = "mkdir -p {}".format(path)
+        return self.call(cmd, parse=_exit_code, **kwargs)
+
+    def whoami(self, **kwargs):
+        return self.call("whoami", parse=_first_line_or_empty, **kwargs)
+
+    def user_exists(self, user, **kwargs):
+        cmd = "grep -q ^{}: /etc/passwd".format(user)
+        return self.call(cmd, parse=_succeeded, **kwargs)
+
+    def checksum(self, fname, **kwargs):
+        algorithm = checksum.select_algorithm(kwargs)
+        cmd = "{} {}".format(checksum.command(algorithm), fname)
+        return self.call(cmd, parse=_first_field, **kwargs)
+
+def _parse_stat(fields):
+    # The fields printed by the stat command of stat_many.
+    inode, mode, uid, gid, size, mtime, path = fields
+    mode = int(mode, 16)
+    return StatResult(path, _file_types.get(stat.S_IFMT(mode)),
+            stat.S_IMODE(mode), int(uid), int(gid), int(size), int(mtime),
+            int(inode))
+
+def _mode(mode):
+    # Ints are modes, anything else is passed to chmod as it is.
+    if isinstance(mode, int):
+        return format(mode, 'o')
+    return str(mode)
+
+def _converge_command(path, kwargs):
+    # A single find that tests every entry against each wanted setting
+    # and fixes only those that differ. The comma operator makes find go
+    # on to the next test whatever the outcome of the previous one.
+    dry_run = 'dry_run' in kwargs and kwargs['dry_run'] is True
+    tests = []
+    for kind, key in (('d', 'dirs'), ('f', 'files')):
+        if key in kwargs and kwargs[key] is not None:
+            mode = _mode(kwargs[key])
+            if not re.fullmatch('[0-7]{1,4}', mode):
+                # find -perm would only match the exact bits, so every
+                # entry would look different on every run.
+                raise ValueError("not an octal mode: {}".format(mode))
+            test = "-type {} ! -perm {} -printf {}".format(kind,
+                    shlex.quote(mode), _printf('mode %m', mode))
+            if not dry_run:
+                test += " -exec chmod {} {{}} +".format(shlex.quote(mode))
+            tests.append(test)
+    owner = kwargs['owner'] if 'owner' in kwargs else None
+    group = kwargs['group'] if 'group' in kwargs else None
+    if owner is not None or group is not None:
+        # chown sets the login group of the owner too with "owner:", so
+        # only the parts that are given are in the spec.
+        differs, spec, old = [], [], []
+        if owner is not None:
+            differs.append("! -user {}".format(shlex.quote(owner)))
+            spec.append(owner)
+            old.append('%u')
+        if group is not None:
+            differs.append("! -group {}".format(shlex.quote(group)))
+            spec.append(':' + group)
+            old.append(':%g')
+        spec, old = ''.join(spec), ''.join(old)
+        test = "\\( {} \\) -printf {}".format(' -o '.join(differs),
+                _printf('owner ' + old, spec))
+        if not dry_run:
+            test += " -exec chown -h {} {{}} +".format(shlex.quote(spec))
+        tests.append(test)
+    if not tests:
+        raise ValueError("nothing to set")
+    return "find {} {}".format(shlex.quote(path),
+            ' , '.join("\\( {} \\)".format(t) for t in tests))
+
+def _printf(what, new):
+    # A -printf format for a line of PermissionChanges.parse.
+    new = new.replace('\\', '\\\\').replace('%', '%%')
+    return shlex.quote("{} {} %p\\n".format(what, new))
+
+def _user_result(cls, user, result, passwd=None):
+    # result is the Deferred of the command, or the exception if the
+    # user was never queued.
+    if isinstance(result, Exception):
+        return cls(user, False, None, result)
+    if result.ret != 0:
+        err = '\n'.join(result.err) or "exit code {}".format(result.ret)
+        return cls(user, False, None, CommandFailed(err))
+    return cls(user, True, passwd, None)
+
+def _read_lines(fname):
+    # Reads a local file the way cat and LocalHandler.do would. Returns
+    # None if it can't be read.
+    try:
+        with open(fname) as f:
+            return f.read().splitlines()
+    except OSError:
+        return None
+
+def _mktemp(**kwargs):
+    # Does what mktemp does, with the same defaults.
+    if 'tmpdir' in kwargs:
+        tmpdir = kwargs['tmpdir']
+    else:
+        tmpdir = os.environ.get('TMPDIR') or '/tmp'
+    chars = string.ascii_letters + string.digits
+    while True:
+        name = "tmp.{}".format(''.join(secrets.choice(chars)
+                for i in range(10)))
+        path = os.path.join(tmpdir, name)
+        try:
+            if 'create_dir' in kwargs and kwargs['create_dir'] == True:
+                os.mkdir(path, 0o700)
+            else:
+                os.close(os.open(path, os.O_WRONLY | os.O_CREAT |
+                        os.O_EXCL, 0o600))
+            return path
+        except FileExistsError:
+            continue
+
+def _read_error(fname, err):
+    if 'No such file' in err:
+        return FileNotFoundError(fname)
+    elif 'Permission denied' in err:
+        return PermissionError(fname)
+    return CommandFailed(err)
+
+# Parsers for the values of deferred commands.
+
+def _succeeded(ret, out, err):
+    return ret == 0
+
+def _exit_code(ret, out, err):
+    return ret
+
+def _first_line(ret, out, err):
+    return out[0]
+
+def _first_line_or_empty(ret, out, err):
+    return out[0] if len(out) > 0 else ''
+
+def _first_field(ret, out, err):
+    if ret != 0:
+        raise CommandFailed(err)
+    return out[0].split()[0]
+
+@register
 class Fedora(Linux):
     """
     This represents Fedora Linux.
@@ -338,9 +1217,10 @@ class Fedora(Linux):
         self.package_sets = {}
 
     @staticmethod
-    def detect(host):
-        return host.distro() == 'fedora'
+    def detect(facts):
+        return facts.distro == 'fedora'
 
+@register
 class CentOS(Linux):
     """
     Representation of CentOS.
@@ -351,14 +1231,17 @@ class CentOS(Linux):
         self.package_sets = {}
 
     @staticmethod
-    def detect(host):
-        return host.distro() == 'centos'
+    def detect(facts):
+        return facts.distro == 'centos'
 
+@register
 class Issabel(CentOS):
     """
     Represents Issabel.
     """
 
+    markers = ('/etc/issabel.conf',)
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
@@ -369,10 +1252,11 @@ class Issabel(CentOS):
         pass
 
     @staticmethod
-    def detect(host):
+    def detect(facts):
         # ID in /etc/os-release is centos, not issabel.
-        return host.file_exists('/etc/issabel.conf')
+        return facts.has('/etc/issabel.conf')
 
+@register
 class Debian(Linux):
     """
     Representation of Debian GNU/Linux.
@@ -383,9 +1267,10 @@ class Debian(Linux):
         self.package_sets = {}
 
     @staticmethod
-    def detect(host):
-        return host.distro() == 'debian'
+    def detect(facts):
+        return facts.distro == 'debian'
 
+@register
 class Ubuntu(Debian):
     """
     Represents Ubuntu.
@@ -395,17 +1280,20 @@ class Ubuntu(Debian):
         super().__init__(**kwargs)
 
     @staticmethod
-    def detect(host):
-        return host.distro() == 'ubuntu'
+    def detect(facts):
+        return facts.distro == 'ubuntu'
 
+@register
 class Proxmox(Debian):
     """
     Representation of Proxmox.
     """
 
+    markers = ('/etc/pve',)
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
     @staticmethod
-    def detect(host):
-        return host.distro() and host.directory_exists('/etc/pve')
+    def detect(facts):
+        return facts.distro is not None and facts.has('/etc/pve')
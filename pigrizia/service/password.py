@@ -0,0 +1,117 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+Hashing passwords for ``useradd -p``.
+
+Hashing a password with SHA-512 crypt takes thousands of rounds on
+purpose, so hashing thousands of them is slow. :func:`hash_passwords`
+spreads the work over a pool of processes, one per CPU. The pool is only
+used for the one call and is shut down afterwards, so the passwords
+don't stay around in idle worker processes.
+
+The method and the number of rounds can be given to the functions, or
+set per host in ``hosts.conf`` as ``crypt_method`` and ``crypt_rounds``.
+
+The hashing is done by the :mod:`crypt` module of the standard library,
+which is deprecated since Python 3.11 and was removed in Python 3.13. On
+those versions the functions raise :class:`CryptUnavailable`.
+"""
+
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+# The supported methods, by name, and the method of the crypt module that
+# each one stands for.
+methods = {
+    'sha512': 'METHOD_SHA512',
+    'sha256': 'METHOD_SHA256',
+    'blowfish': 'METHOD_BLOWFISH',
+}
+
+default_method = 'sha512'
+
+# Fewer passwords than this are hashed in the calling process, since
+# starting the pool would take longer.
+min_pool = 32
+
+class UnknownMethod(Exception):
+    """
+    Raised when a hashing method isn't supported.
+    """
+    pass
+
+class CryptUnavailable(Exception):
+    """
+    Raised when passwords can't be hashed because Python has no
+    :mod:`crypt` module.
+    """
+    pass
+
+def hash_password(passwd, method=None, rounds=None):
+    """
+    Hashes a password.
+
+    :param str passwd: the password
+    :param str method: one of the keys of :data:`methods`
+    :param int rounds: the number of rounds, or None for the default of
+        the method
+    :return: the hash, in the format of ``/etc/shadow``
+    :rtype: str
+    """
+    return _crypt().crypt(passwd, _salt(method, rounds))
+
+def hash_passwords(passwds, method=None, rounds=None, workers=None):
+    """
+    Hashes many passwords, in parallel.
+
+    :param list passwds: the passwords
+    :param str method: one of the keys of :data:`methods`
+    :param int rounds: the number of rounds, or None for the default of
+        the method
+    :param int workers: the number of processes (the default is the
+        number of CPUs)
+    :return: the hashes, in the same order as the passwords
+    :rtype: list
+    """
+    passwds = list(passwds)
+    # Check the arguments here rather than in every worker.
+    _salt(method, rounds)
+    workers = workers or os.cpu_count() or 1
+    if len(passwds) < min_pool or workers < 2:
+        return [hash_password(p, method, rounds) for p in passwds]
+
+    # A few chunks per worker, so that the work evens out without sending
+    # every password on its own.
+    size = max(1, len(passwds) // (workers * 4))
+    chunks = [passwds[i:i + size] for i in range(0, len(passwds), size)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(_hash_chunk, chunks, [method] * len(chunks),
+                [rounds] * len(chunks))
+        return [h for hashes in results for h in hashes]
+
+def _hash_chunk(passwds, method, rounds):
+    return [hash_password(p, method, rounds) for p in passwds]
+
+def _salt(method, rounds):
+    method = method or default_method
+    if method not in methods:
+        raise UnknownMethod(method)
+    crypt = _crypt()
+    return crypt.mksalt(getattr(crypt, methods[method]), rounds=rounds)
+
+def _crypt():
+    # The only place the crypt module is imported. Its deprecation warning
+    # is silenced, since its absence is handled here.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        try:
+            import crypt
+        except ImportError:
+            raise CryptUnavailable("the crypt module is not available "
+                    "(it was removed in Python 3.13)")
+    return crypt
@@ -4,18 +4,60 @@
 # license that can be found in the LICENSE file or at
 # https://opensource.org/licenses/MIT.
 
+import re
+import json
+import shlex
+from collections import namedtuple
 from .service import Service, NotInstalled
 from pigrizia.command.handler import NoSuchCommand
 
+PythonFacts = namedtuple('PythonFacts', ('version', 'executable', 'prefix',
+    'site_packages', 'user_site', 'pip_version'))
+PythonFacts.__doc__ = """
+Facts about the Python interpreter of a host. *version* is a tuple of
+ints (major, minor, micro), *site_packages* is a list of directories and
+*pip_version* is None if pip isn't installed.
+"""
+
+# Prints the facts as JSON, with a single python3 process.
+_facts_script = '''
+import json, site, sys
+try:
+    from importlib.metadata import version
+    pip = version('pip')
+except Exception:
+    try:
+        import pip
+        pip = pip.__version__
+    except ImportError:
+        pip = None
+try:
+    site_packages = site.getsitepackages()
+except AttributeError:
+    site_packages = []
+print(json.dumps([list(sys.version_info[:3]), sys.executable, sys.prefix,
+    site_packages, site.getusersitepackages(), pip]))
+'''
+
 class Python(Service):
     """
     This service represents Python and related tools (such as pip).
+
+    The facts about the interpreter are gathered once, when the service
+    is created. Use the *python* property of the host, which keeps the
+    service, rather than creating it directly.
+
+    :ivar facts: the facts about the interpreter
+    :vartype facts: :class:`PythonFacts`
     """
 
     def __init__(self, host, **kwargs):
         super().__init__(host, **kwargs)
+        # The installed packages, by whether sudo was used and as whom,
+        # since that can change what pip sees.
+        self._packages = {}
         try:
-            self.version()
+            self.facts = self._gather_facts()
         except NoSuchCommand:
             raise NotInstalled()
 
@@ -23,14 +65,87 @@ class Python(Service):
         """
         Gets the python version.
         """
-        return "{}.{}".format(self._major_version(), self._minor_version())
+        return "{}.{}".format(*self.facts.version[:2])
 
-    def _major_version(self, **kwargs):
-        cmd = "python3 -c 'import sys; print(sys.version_info.major)'"
-        ret, out, err = self._call(cmd, **kwargs)
-        return out[0]
+    def packages(self, **kwargs):
+        """
+        Gets the installed packages. The list is read with ``pip list``
+        the first time and then kept until something is installed through
+        this service, or :meth:`invalidate` is called. A list is kept for
+        every combination of *sudo* and *user*.
 
-    def _minor_version(self, **kwargs):
-        cmd = "python3 -c 'import sys; print(sys.version_info.minor)'"
+        :return: the version of every package, by name
+        :rtype: dict
+        """
+        key = ('sudo' in kwargs and kwargs['sudo'] is True,
+                kwargs['user'] if 'user' in kwargs else None)
+        if key not in self._packages:
+            cmd = "python3 -m pip list --format=json " \
+                    "--disable-pip-version-check"
+            ret, out, err = self._call(cmd, **kwargs)
+            if ret != 0:
+                from pigrizia.host.host import CommandFailed
+                raise CommandFailed('\n'.join(err or []))
+            self._packages[key] = {_normalize(p['name']): p['version']
+                    for p in json.loads(''.join(out))}
+        return self._packages[key]
+
+    def has_package(self, name, **kwargs):
+        """
+        Checks if a package is installed.
+
+        :param str name: the name of the package
+        :rtype: bool
+        """
+        return _normalize(name) in self.packages(**kwargs)
+
+    def package_version(self, name, **kwargs):
+        """
+        Gets the version of an installed package.
+
+        :param str name: the name of the package
+        :return: the version, or None if the package isn't installed
+        :rtype: str or NoneType
+        """
+        return self.packages(**kwargs).get(_normalize(name))
+
+    def install(self, *args, **kwargs):
+        """
+        Installs packages with pip.
+
+        :param args: the arguments of ``pip install``, such as package
+            names
+        :return: True if pip succeeded
+        :rtype: bool
+        """
+        cmd = "python3 -m pip install {}".format(
+                ' '.join(shlex.quote(a) for a in args))
+        try:
+            ret, out, err = self._call(cmd, **kwargs)
+        finally:
+            self.invalidate()
+        return ret == 0
+
+    def invalidate(self):
+        """
+        Forgets the installed packages, so they are read again the next
+        time they are needed.
+        """
+        self._packages = {}
+
+    def _gather_facts(self, **kwargs):
+        cmd = "python3 -c {}".format(shlex.quote(_facts_script))
         ret, out, err = self._call(cmd, **kwargs)
-        return out[0]
+        if ret == 127:
+            raise NoSuchCommand('python3')
+        if ret != 0 or not out:
+            from pigrizia.host.host import CommandFailed
+            raise CommandFailed('\n'.join(err or []))
+        version, executable, prefix, site_packages, user_site, pip = \
+                json.loads(out[-1])
+        return PythonFacts(tuple(version), executable, prefix,
+                site_packages, user_site, pip)
+
+def _normalize(name):
+    # Package names are compared the way pip does (PEP 503).
+    return re.sub(r'[-_.]+', '-', name).lower()
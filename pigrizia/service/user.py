@@ -4,6 +4,12 @@
 # license that can be found in the LICENSE file or at
 # https://opensource.org/licenses/MIT.
 
+import pwd
+import grp
+import shlex
+from collections import namedtuple
+from .service import Service
+
 class UserError(Exception):
     """
     Base class for user management errors
@@ -22,3 +28,174 @@ class NoSuchUser(UserError):
     """
     pass
 
+PasswdEntry = namedtuple('PasswdEntry',
+        ('name', 'passwd', 'uid', 'gid', 'gecos', 'home', 'shell'))
+PasswdEntry.__doc__ = """
+A user, as in ``/etc/passwd``. *uid* and *gid* are ints.
+"""
+
+GroupEntry = namedtuple('GroupEntry', ('name', 'passwd', 'gid', 'members'))
+GroupEntry.__doc__ = """
+A group, as in ``/etc/group``. *gid* is an int and *members* is a list of
+user names.
+"""
+
+UserResult = namedtuple('UserResult', ('user', 'ok', 'passwd', 'error'))
+UserResult.__doc__ = """
+The outcome for one user of :meth:`~pigrizia.host.linux.Linux.useradd_many`
+or :meth:`~pigrizia.host.linux.Linux.userdel_many`. *passwd* is the
+password that was generated for the user, if any, and *error* is the
+exception that describes why *ok* is False.
+"""
+
+# Separates the users from the groups in the output of the snapshot
+# command.
+_group_sep = '--pigrizia-groups--'
+
+class UserDatabase(Service):
+    """
+    Looks up users and groups on a host. Use the *users* property of the
+    host to get one.
+
+    Single lookups run ``getent`` (or use :mod:`pwd` and :mod:`grp` on
+    the local host), so the whole user database isn't read to check one
+    user. For checking many users, :meth:`snapshot` reads all users and
+    groups with one command and keeps them; lookups are then answered
+    from the snapshot until it is invalidated. The host invalidates it
+    whenever it adds or removes a user.
+
+    The methods take the same keyword arguments as the commands of the
+    host (such as *passwd*), which are used for the commands they run.
+    """
+
+    def __init__(self, host, **kwargs):
+        super().__init__(host, **kwargs)
+        self._users = None
+        self._groups = None
+
+    def user(self, name, **kwargs):
+        """
+        Looks up a user.
+
+        :param str name: the name of the user
+        :return: the user, or None if there is no such user
+        :rtype: :class:`PasswdEntry`
+        """
+        if self._users is not None:
+            return self._users.get(name)
+        if self.host._is_local(**kwargs):
+            try:
+                return _passwd_entry(pwd.getpwnam(name))
+            except KeyError:
+                return None
+        entries = self._getent('passwd', name, **kwargs)
+        return _parse_passwd(entries[0]) if entries else None
+
+    def group(self, name, **kwargs):
+        """
+        Looks up a group.
+
+        :param str name: the name of the group
+        :return: the group, or None if there is no such group
+        :rtype: :class:`GroupEntry`
+        """
+        if self._groups is not None:
+            return self._groups.get(name)
+        if self.host._is_local(**kwargs):
+            try:
+                return _group_entry(grp.getgrnam(name))
+            except KeyError:
+                return None
+        entries = self._getent('group', name, **kwargs)
+        return _parse_group(entries[0]) if entries else None
+
+    def user_exists(self, name, **kwargs):
+        """
+        Checks if a user exists.
+
+        :rtype: bool
+        """
+        return self.user(name, **kwargs) is not None
+
+    def group_exists(self, name, **kwargs):
+        """
+        Checks if a group exists.
+
+        :rtype: bool
+        """
+        return self.group(name, **kwargs) is not None
+
+    def users(self, **kwargs):
+        """
+        Gets all the users, taking a snapshot if there isn't one.
+
+        :rtype: list of :class:`PasswdEntry`
+        """
+        self.snapshot(refresh=False, **kwargs)
+        return list(self._users.values())
+
+    def groups(self, **kwargs):
+        """
+        Gets all the groups, taking a snapshot if there isn't one.
+
+        :rtype: list of :class:`GroupEntry`
+        """
+        self.snapshot(refresh=False, **kwargs)
+        return list(self._groups.values())
+
+    def snapshot(self, refresh=True, **kwargs):
+        """
+        Reads all users and groups, with a single command, and answers
+        lookups from them until :meth:`invalidate` is called.
+
+        :param bool refresh: if False, an existing snapshot is kept
+        """
+        if self._users is not None and not refresh:
+            return
+        if self.host._is_local(**kwargs):
+            users = [_passwd_entry(p) for p in pwd.getpwall()]
+            groups = [_group_entry(g) for g in grp.getgrall()]
+        else:
+            cmd = "getent passwd || cat /etc/passwd; echo {}; " \
+                    "getent group || cat /etc/group".format(_group_sep)
+            ret, out, err = self._call(cmd, **kwargs)
+            if _group_sep not in out:
+                from pigrizia.host.host import CommandFailed
+                raise CommandFailed("could not read the user database")
+            i = out.index(_group_sep)
+            users = [_parse_passwd(line) for line in out[:i] if line]
+            groups = [_parse_group(line) for line in out[i + 1:] if line]
+        # The first entry wins, like it does for getent.
+        self._users, self._groups = {}, {}
+        for u in users:
+            self._users.setdefault(u.name, u)
+        for g in groups:
+            self._groups.setdefault(g.name, g)
+
+    def invalidate(self):
+        """
+        Drops the snapshot, so that lookups ask the host again.
+        """
+        self._users = None
+        self._groups = None
+
+    def _getent(self, database, name, **kwargs):
+        cmd = "getent {} {}".format(database, shlex.quote(name))
+        ret, out, err = self._call(cmd, **kwargs)
+        return out if ret == 0 else []
+
+def _passwd_entry(p):
+    return PasswdEntry(p.pw_name, p.pw_passwd, p.pw_uid, p.pw_gid,
+            p.pw_gecos, p.pw_dir, p.pw_shell)
+
+def _group_entry(g):
+    return GroupEntry(g.gr_name, g.gr_passwd, g.gr_gid, list(g.gr_mem))
+
+def _parse_passwd(line):
+    name, passwd, uid, gid, gecos, home, shell = line.split(':', 6)
+    return PasswdEntry(name, passwd, int(uid), int(gid), gecos, home, shell)
+
+def _parse_group(line):
+    name, passwd, gid, members = line.split(':', 3)
+    members = members.split(',') if members else []
+    return GroupEntry(name, passwd, int(gid), members)
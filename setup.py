@@ -4,15 +4,25 @@
 # license that can be found in the LICENSE file or at
 # https://opensource.org/licenses/MIT.
 
+import re
+import ast
 import setuptools
 
+# The version is kept in the package, so that it can be checked on hosts,
+# and so are the dependencies, so that wheels can be built from there.
+with open('pigrizia/__init__.py') as f:
+    source = f.read()
+version = re.search(r"^__version__ = '(.*)'", source, re.M).group(1)
+requires = ast.literal_eval(re.search(r"^__requires__ = (\[.*?\])",
+    source, re.M | re.S).group(1))
+
 longdesc = """\
 Pigrizia is a library for automation, monitoring and reporting.
 """
 
 setuptools.setup(
         name='pigrizia',
-        version='0.0.1',
+        version=version,
         author='Lorenzo Cabrini',
         author_email='lorenzo.cabrini@gmail.com',
         description='Pigrizia is a library for automation',
@@ -22,11 +32,7 @@ setuptools.setup(
         data_files=[
             ('pigrizia/conf/monitor/', 
                 ['conf/monitor/ping.conf'])],
-        install_requires=[
-            'paramiko',
-            'toml',
-            'humanfriendly',
-            ],
+        install_requires=requires,
         classifiers=[
             "Programming Language :: Python :: 3",
             "License :: OSI Approved :: MIT License",
@@ -0,0 +1,83 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import asyncio
+import unittest
+from unittest import mock
+from getpass import getuser, getpass
+from pigrizia.command.handler import NoSuchCommand
+from pigrizia.command.handler.aio import AsyncRemoteHandler
+from pigrizia.host.aio import AsyncLinux
+
+class BaseTestCases:
+    class AsyncTestBase(unittest.IsolatedAsyncioTestCase):
+        user = getuser()
+        passwd = getpass()
+        addr = '127.0.0.1'
+
+class TestAsyncRemoteHandler(BaseTestCases.AsyncTestBase):
+    async def asyncSetUp(self):
+        self.handler = AsyncRemoteHandler(addr=self.addr, user=self.user,
+                passwd=self.passwd)
+
+    async def asyncTearDown(self):
+        self.handler.close()
+
+    async def test_do(self):
+        ret, out, err = await self.handler.do("whoami")
+        self.assertEqual(ret, 0)
+        self.assertEqual(out, [self.user])
+        self.assertEqual(err, [])
+
+    async def test_sudo(self):
+        ret, out, err = await self.handler.sudo("whoami")
+        self.assertEqual(ret, 0)
+        self.assertEqual(out, ['root'])
+        self.assertEqual(err, [])
+
+    async def test_invalid_command(self):
+        with self.assertRaises(NoSuchCommand):
+            await self.handler.do("foo")
+
+    async def test_interact(self):
+        with self.assertRaises(TypeError):
+            self.handler.interact()
+
+    async def test_concurrent(self):
+        pool = self.handler._pool
+        with mock.patch.object(pool, 'acquire', wraps=pool.acquire) as acq:
+            results = await asyncio.gather(*[self.handler.do(
+                "echo {}".format(i)) for i in range(20)])
+        self.assertEqual([out for ret, out, err in results],
+                [[str(i)] for i in range(20)])
+        # All the commands share one connection.
+        self.assertEqual(acq.call_count, 1)
+
+class TestAsyncLinux(BaseTestCases.AsyncTestBase):
+    async def asyncSetUp(self):
+        self.host = AsyncLinux(addr=self.addr, user=self.user,
+                passwd=self.passwd)
+
+    async def asyncTearDown(self):
+        self.host.close()
+
+    async def test_file_exists(self):
+        self.assertTrue(await self.host.file_exists('/etc/hosts'))
+        self.assertFalse(await self.host.file_exists('/etc/foo'))
+
+    async def test_directory_exists(self):
+        self.assertTrue(await self.host.directory_exists('/etc'))
+        self.assertFalse(await self.host.directory_exists('/foo'))
+
+    async def test_whoami(self):
+        self.assertEqual(await self.host.whoami(), self.user)
+
+    async def test_probe(self):
+        facts = await self.host.probe()
+        self.assertEqual(facts.uname, 'Linux')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import os
+import base64
+import hashlib
+import shutil
+import tempfile
+import unittest
+import zipfile
+import pigrizia
+from pigrizia.host import bootstrap
+
+class TestBootstrap(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_build_wheel(self):
+        path = bootstrap.build_wheel(self.dir)
+        self.assertEqual(os.path.basename(path),
+                "pigrizia-{}-py3-none-any.whl".format(pigrizia.__version__))
+        dist_info = "pigrizia-{}.dist-info".format(pigrizia.__version__)
+        with zipfile.ZipFile(path) as whl:
+            names = whl.namelist()
+            self.assertIn('pigrizia/host/bootstrap.py', names)
+            self.assertFalse([n for n in names if '__pycache__' in n])
+            data = "pigrizia-{}.data/data/pigrizia/conf/monitor/ping.conf" \
+                    .format(pigrizia.__version__)
+            with open(os.path.join(os.path.dirname(__file__), '..', 'conf',
+                    'monitor', 'ping.conf'), 'rb') as f:
+                self.assertEqual(whl.read(data), f.read())
+            metadata = whl.read(dist_info + '/METADATA').decode()
+            self.assertIn("Version: {}\n".format(pigrizia.__version__),
+                    metadata)
+            record = whl.read(dist_info + '/RECORD').decode().splitlines()
+            self.assertEqual(sorted(r.split(',')[0] for r in record),
+                    sorted(names))
+            for line in record:
+                name, digest, size = line.split(',')
+                if name.endswith('RECORD'):
+                    continue
+                data = whl.read(name)
+                self.assertEqual(int(size), len(data))
+                self.assertEqual(digest, 'sha256=' +
+                        base64.urlsafe_b64encode(hashlib.sha256(
+                            data).digest()).rstrip(b'=').decode())
+
+        with open(path, 'rb') as f:
+            first = f.read()
+        os.remove(path)
+        with open(bootstrap.build_wheel(self.dir), 'rb') as f:
+            self.assertEqual(f.read(), first)
+
+if __name__ == '__main__':
+    unittest.main()
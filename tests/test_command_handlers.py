@@ -4,11 +4,15 @@
 # license that can be found in the LICENSE file or at
 # https://opensource.org/licenses/MIT.
 
+import threading
+import time
 import unittest
+from unittest import mock
 from getpass import getuser, getpass
 from pigrizia.command.handler.local import LocalHandler
 from pigrizia.command.handler.remote import RemoteHandler
 from pigrizia.command.handler import NoSuchCommand
+from pigrizia.command.handler.stream import STDOUT
 
 class BaseTestCases:
     class CommandHandlersTestBase(unittest.TestCase):
@@ -32,6 +36,67 @@ class BaseTestCases:
         def test_invalid_command(self):
             self.assertRaises(NoSuchCommand, self.handler.do, "foo")
 
+        def test_do_stream(self):
+            stream = self.handler.do_stream("seq 1 10000")
+            lines = list(stream.lines())
+            self.assertEqual(len(lines), 10000)
+            self.assertEqual(lines[-1], '10000')
+            self.assertEqual(stream.ret, 0)
+
+        def test_sudo_stream(self):
+            stream = self.handler.sudo_stream("whoami", passwd=self.passwd)
+            self.assertEqual(list(stream), [(STDOUT, 'root')])
+            self.assertEqual(stream.ret, 0)
+
+        def test_batch(self):
+            with self.handler.batch(passwd=self.passwd) as b:
+                who = b.do("whoami")
+                fail = b.do("echo foo >&2; false")
+                missing = b.do("foo")
+                root = b.sudo("whoami")
+            self.assertEqual(who.value, (0, [self.user], []))
+            self.assertEqual(fail.ret, 1)
+            self.assertEqual(fail.err[-1], 'foo')
+            self.assertRaises(NoSuchCommand, lambda: missing.value)
+            self.assertEqual(root.out, ['root'])
+
+        def test_batch_kwargs(self):
+            with self.handler.batch() as b:
+                root = b.sudo("whoami", passwd=self.passwd)
+                who = b.do("whoami")
+            self.assertEqual(root.out, ['root'])
+            self.assertEqual(who.out, [self.user])
+
+        def test_session(self):
+            session = self.handler.interact("cd /etc; FOO=bar")
+            self.assertIs(self.handler.interact(), session)
+            self.assertEqual(session.run("pwd; echo $FOO"),
+                    (0, ['/etc', 'bar'], []))
+            self.assertEqual(session.run("echo foo >&2; exit 3"),
+                    (3, [], ['foo']))
+            self.assertEqual(session.run("printf foo"), (0, ['foo'], []))
+            self.handler.close()
+            self.assertTrue(session.closed)
+
+        def test_session_threads(self):
+            new_session = self.handler._new_session
+            def slow_session(*args):
+                time.sleep(0.2)
+                return new_session(*args)
+            sessions = []
+            def worker():
+                sessions.append(self.handler.interact())
+            with mock.patch.object(self.handler, '_new_session',
+                    side_effect=slow_session) as m:
+                threads = [threading.Thread(target=worker) for i in range(4)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+            self.assertEqual(m.call_count, 1)
+            self.assertTrue(all(s is sessions[0] for s in sessions))
+            self.handler.close()
+
 class TestLocalCommandHandler(BaseTestCases.CommandHandlersTestBase):
     def setUp(self):
         self.handler = LocalHandler()
@@ -43,3 +108,18 @@ class TestRemoteCommandHandler(BaseTestCases.CommandHandlersTestBase):
         self.handler = RemoteHandler(addr=self.addr, user=self.user,
                 passwd=self.passwd)
 
+    def test_shared_connection(self):
+        other = RemoteHandler(addr=self.addr, user=self.user,
+                passwd=self.passwd)
+        self.assertIs(other.ssh.get_transport(), 
+                self.handler.ssh.get_transport())
+        other.close()
+        ret, out, err = self.handler.do("whoami")
+        self.assertEqual(ret, 0)
+
+    def test_private_connection(self):
+        other = RemoteHandler(addr=self.addr, user=self.user,
+                passwd=self.passwd, pool=False)
+        self.assertIsNot(other.ssh.get_transport(), 
+                self.handler.ssh.get_transport())
+        other.close()
@@ -0,0 +1,59 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import unittest
+import os
+import io
+import tempfile
+import subprocess
+from pigrizia.command.handler import delta
+
+class TestDelta(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.old = os.path.join(self.dir, 'old')
+        self.new = os.path.join(self.dir, 'new')
+        self.delta = os.path.join(self.dir, 'delta')
+
+    def tearDown(self):
+        for f in os.listdir(self.dir):
+            os.remove(os.path.join(self.dir, f))
+        os.rmdir(self.dir)
+
+    def transfer(self, old, new):
+        with open(self.old, 'wb') as f:
+            f.write(old)
+        size = delta.block_size(len(new))
+        p = subprocess.run(['python3', '-c', delta.signature_script,
+                self.old, str(size)], stdout=subprocess.PIPE, check=True)
+        signatures = delta.Signatures(p.stdout.decode().splitlines(), size)
+        buf = io.BytesIO()
+        literal = delta.write_delta(new, signatures, buf.write)
+        with open(self.delta, 'wb') as f:
+            f.write(buf.getvalue())
+        subprocess.run(['python3', '-c', delta.patch_script, self.old,
+                self.delta, self.new, str(size)], check=True)
+        with open(self.new, 'rb') as f:
+            self.assertEqual(f.read(), new)
+        return literal
+
+    def test_unchanged(self):
+        data = os.urandom(100000)
+        self.assertEqual(self.transfer(data, data), 0)
+
+    def test_insert_and_change(self):
+        old = os.urandom(100000)
+        new = old[:500] + b'inserted' + old[500:70000] + b'x' * 10 + \
+                old[70010:]
+        self.assertLess(self.transfer(old, new), 3000)
+
+    def test_unrelated(self):
+        old, new = os.urandom(5000), os.urandom(7000)
+        self.assertEqual(self.transfer(old, new), len(new))
+        self.assertEqual(self.transfer(b'', new), len(new))
+
+if __name__ == '__main__':
+    unittest.main()
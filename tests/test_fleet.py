@@ -0,0 +1,123 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import os
+import hashlib
+import tempfile
+import unittest
+from unittest import mock
+from getpass import getuser, getpass
+from pigrizia.command.handler import checksum
+from pigrizia.host import config
+from pigrizia.host import fingerprint
+from pigrizia.host.fleet import Fleet
+from pigrizia.host.bootstrap import wheel_name
+
+class TestFleet(unittest.TestCase):
+    user = getuser()
+    passwd = getpass()
+    addr = '127.0.0.1'
+
+    def setUp(self):
+        fd, self.hosts_config = tempfile.mkstemp()
+        os.close(fd)
+        patcher = mock.patch.object(config, 'hosts_config',
+                self.hosts_config)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(config, 'hosts_db',
+                self.hosts_config + '.db')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Keep the fingerprints of the tests out of the real cache.
+        patcher = mock.patch.object(fingerprint, 'fingerprints_file',
+                self.hosts_config + '.fingerprints')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self._remove, self.hosts_config + '.fingerprints')
+        self.addCleanup(os.remove, self.hosts_config)
+        config._write_hosts_file({
+            'one': {'addr': self.addr},
+            'two': {'addr': self.addr},
+            })
+
+    def _remove(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    def test_run(self):
+        fleet = Fleet(user=self.user, passwd=self.passwd)
+        results = list(fleet.run('whoami'))
+        self.assertEqual(sorted(r.label for r in results), ['one', 'two'])
+        for result in results:
+            self.assertTrue(result.ok)
+            self.assertEqual(result.value, self.user)
+            self.assertGreater(result.duration, 0)
+
+    def test_command(self):
+        fleet = Fleet(['one'], user=self.user, passwd=self.passwd)
+        result, = fleet.command("echo foo")
+        self.assertEqual(result.value, (0, ['foo'], []))
+
+    def test_copy(self):
+        fd, src = tempfile.mkstemp()
+        os.write(fd, os.urandom(100000))
+        os.close(fd)
+        dest = src + '.copy'
+        self.addCleanup(os.remove, src)
+        self.addCleanup(os.remove, dest)
+        fleet = Fleet(user=self.user, passwd=self.passwd)
+        results = list(fleet.copy(src, dest, relay=True, hash='sha256'))
+        self.assertEqual(len(results), 2)
+        with open(src, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        for result in results:
+            self.assertTrue(result.ok)
+            self.assertEqual(result.value, digest)
+        with open(dest, 'rb') as f:
+            self.assertEqual(hashlib.sha256(f.read()).hexdigest(), digest)
+
+    def test_copy_host_hash(self):
+        config._write_hosts_file({
+            'one': {'addr': self.addr, 'hash': 'sha256'},
+            # The settings are found by address, so this one needs
+            # another address.
+            'two': {'addr': 'localhost'},
+            })
+        fd, src = tempfile.mkstemp()
+        os.write(fd, os.urandom(1000))
+        os.close(fd)
+        dest = src + '.copy'
+        self.addCleanup(os.remove, src)
+        self.addCleanup(os.remove, dest)
+        fleet = Fleet(user=self.user, passwd=self.passwd)
+        results = {r.label: r for r in fleet.copy(src, dest)}
+        with open(src, 'rb') as f:
+            data = f.read()
+        self.assertEqual(results['one'].value,
+                hashlib.sha256(data).hexdigest())
+        self.assertEqual(results['two'].value,
+                hashlib.new(checksum.default_algorithm, data).hexdigest())
+
+    def test_install_pigrizia(self):
+        fleet = Fleet(user=self.user, passwd=self.passwd)
+        with mock.patch('pigrizia.host.linux.Linux.install_pigrizia',
+                return_value=True) as install:
+            results = list(fleet.install_pigrizia())
+        self.assertTrue(all(r.ok and r.value for r in results))
+        for call in install.call_args_list:
+            self.assertEqual(call[1]['wheel'], wheel_name())
+            self.assertTrue(call[1]['wheel_data'].startswith(b'PK'))
+
+    def test_errors_are_isolated(self):
+        fleet = Fleet(['one', 'bogus'], user=self.user, passwd=self.passwd)
+        results = {r.label: r for r in fleet.run('whoami')}
+        self.assertTrue(results['one'].ok)
+        self.assertFalse(results['bogus'].ok)
+        self.assertIsInstance(results['bogus'].error, KeyError)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,15 +4,31 @@
 # license that can be found in the LICENSE file or at
 # https://opensource.org/licenses/MIT.
 
+import os
+import shutil
+import tempfile
 import unittest
+from unittest import mock
 from getpass import getuser, getpass
-from pigrizia.host import get_host
+from pigrizia.host import get_host, detect
+from pigrizia.host import fingerprint as fp
+from pigrizia.host.fingerprint import get_fingerprint, forget_fingerprint
+from pigrizia.host.linux import Linux, Facts, CentOS, Issabel, Proxmox
 
 class BaseTestCases:
     class HostTestBase(unittest.TestCase):
         user = getuser()
         passwd = getpass()
 
+        def setUp(self):
+            # Keep the fingerprints of the tests out of the real cache.
+            tmpdir = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, tmpdir)
+            patcher = mock.patch.object(fp, 'fingerprints_file',
+                    os.path.join(tmpdir, 'fingerprints.conf'))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
 class TestLocalHost(BaseTestCases.HostTestBase):
     def test_get_host(self):
         # Works for me, change as needed for your tests.
@@ -20,6 +36,32 @@ class TestLocalHost(BaseTestCases.HostTestBase):
         host = get_host(passwd=self.passwd)
         self.assertEqual(host.distro(), os)
 
+    def test_probe(self):
+        host = Linux(passwd=self.passwd)
+        facts = host.probe(['/etc', '/foo'])
+        self.assertEqual(facts.uname, 'Linux')
+        self.assertEqual(facts.distro, host.distro().strip('"'))
+        self.assertEqual(facts.markers, {'/etc'})
+
+    def test_fingerprint(self):
+        forget_fingerprint('localhost')
+        host = get_host(passwd=self.passwd)
+        fingerprint = get_fingerprint('localhost')
+        self.assertEqual(fingerprint['class'], type(host).__name__)
+        self.assertEqual(fingerprint['machine_id'], host.machine_id())
+        cached = get_host(passwd=self.passwd)
+        self.assertIs(type(cached), type(host))
+        self.assertEqual(cached.facts.distro, host.facts.distro)
+
+    def test_detect(self):
+        facts = Facts('Linux', {'ID': 'centos'}, ['/etc/issabel.conf'])
+        self.assertIs(detect(facts), Issabel)
+        facts = Facts('Linux', {'ID': 'centos'})
+        self.assertIs(detect(facts), CentOS)
+        facts = Facts('Linux', {'ID': 'debian'}, ['/etc/pve'])
+        self.assertIs(detect(facts), Proxmox)
+        self.assertIsNone(detect(Facts('Linux')))
+
 class TestRemoteHost(BaseTestCases.HostTestBase):
     addr = '127.0.0.1'
 
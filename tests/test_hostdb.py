@@ -0,0 +1,87 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from pigrizia.host import config
+from pigrizia.host.hostdb import HostDatabase
+
+hosts = {
+    'pbx1': {'addr': '10.0.0.1', 'os': 'centos', 'tags': ['pbx', 'voip'],
+        'groups': ['milan']},
+    'pbx2': {'addr': '10.0.0.2', 'os': 'debian', 'tags': ['pbx']},
+    'www': {'addr': '10.0.0.3', 'os': 'centos', 'groups': ['milan']},
+}
+
+class TestHostDatabase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.db = HostDatabase(os.path.join(self.dir, 'hosts.db'))
+        self.addCleanup(self.db.close)
+        self.db.replace(hosts)
+
+    def test_select(self):
+        self.assertEqual(self.db.select(tags='pbx'), ['pbx1', 'pbx2'])
+        self.assertEqual(self.db.select(tags='pbx', os='centos'), ['pbx1'])
+        self.assertEqual(self.db.select(groups='milan', os='centos'),
+                ['pbx1', 'www'])
+        self.assertEqual(self.db.select(tags=['pbx', 'voip']), ['pbx1'])
+        self.assertEqual(self.db.select(os='windows'), [])
+        self.assertEqual(self.db.select(), ['pbx1', 'pbx2', 'www'])
+
+    def test_update(self):
+        self.assertEqual(self.db.get('pbx2'), hosts['pbx2'])
+        self.assertEqual(self.db.lookup('addr', '10.0.0.3'), 'www')
+        self.db.set('pbx2', {'addr': '10.0.0.4', 'tags': ['voip']})
+        self.assertEqual(self.db.keys(), ['pbx1', 'pbx2', 'www'])
+        self.assertIsNone(self.db.lookup('addr', '10.0.0.2'))
+        self.assertEqual(self.db.select(tags='voip'), ['pbx1', 'pbx2'])
+        self.db.rename('www', 'web')
+        self.assertEqual(self.db.lookup('addr', '10.0.0.3'), 'web')
+        self.assertEqual(self.db.select(groups='milan'), ['pbx1', 'web'])
+        self.db.remove('web')
+        self.assertEqual(self.db.select(groups='milan'), ['pbx1'])
+        self.assertIsNone(self.db.get('web'))
+
+    def test_backends(self):
+        toml_file = os.path.join(self.dir, 'hosts.conf')
+        self.db.export_toml(toml_file)
+        for db in (os.path.join(self.dir, 'none.db'), self.db.path):
+            with mock.patch.object(config, 'hosts_config', toml_file), \
+                    mock.patch.object(config, 'hosts_db', db):
+                self.assertEqual(config.get_labels(), list(hosts))
+                self.assertEqual(config.get_host_config('www'),
+                        hosts['www'])
+                self.assertEqual(config.get_label_by_addr('10.0.0.2'),
+                        'pbx2')
+                self.assertEqual(config.select_hosts(tags='pbx',
+                        os='centos'), ['pbx1'])
+                host = config.HostConfig('10.0.0.9')
+                host.label = 'new'
+                self.assertEqual(config.get_label_by_addr('10.0.0.9'),
+                        'new')
+                host.label = None
+                self.assertEqual(config.get_labels(), list(hosts))
+
+    def test_export_without_database(self):
+        toml_file = os.path.join(self.dir, 'hosts.conf')
+        db = os.path.join(self.dir, 'none.db')
+        with open(toml_file, 'w') as f:
+            f.write('[one]\naddr = "10.0.0.1"\n')
+        with mock.patch.object(config, 'hosts_config', toml_file), \
+                mock.patch.object(config, 'hosts_db', db):
+            self.assertRaises(FileNotFoundError, config.export_hosts)
+            self.assertFalse(os.path.exists(db))
+            self.assertEqual(config.get_labels(), ['one'])
+        with open(toml_file) as f:
+            self.assertEqual(f.read(), '[one]\naddr = "10.0.0.1"\n')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from pigrizia.host.inventory import Inventory
+
+class TestInventory(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'hosts.conf')
+        self.inventory = Inventory(self.path, indexes=('addr',))
+
+    def test_lookup(self):
+        self.assertEqual(self.inventory.keys(), [])
+        self.inventory.replace({
+            'one': {'addr': '10.0.0.1'},
+            'two': {'addr': '10.0.0.2'},
+            'also-one': {'addr': '10.0.0.1'},
+            })
+        self.assertEqual(self.inventory.lookup('addr', '10.0.0.1'), 'one')
+        self.assertEqual(self.inventory.lookup('addr', '10.0.0.2'), 'two')
+        self.assertIsNone(self.inventory.lookup('addr', '10.0.0.3'))
+        self.inventory.get('one')['addr'] = 'changed'
+        self.assertEqual(self.inventory.get('one'), {'addr': '10.0.0.1'})
+        self.assertEqual(self.inventory.get('three', {}), {})
+
+    def test_select(self):
+        self.inventory.replace({
+            'pbx1': {'os': 'centos', 'tags': ['pbx', 'voip']},
+            'web': {'os': 'centos', 'tags': 'webserver', 'groups': 'milan'},
+            })
+        self.assertEqual(self.inventory.select(tags='pbx'), ['pbx1'])
+        self.assertEqual(self.inventory.select(tags='webserver'), ['web'])
+        self.assertEqual(self.inventory.select(tags='web'), [])
+        self.assertEqual(self.inventory.select(groups='milan',
+            os='centos'), ['web'])
+        self.assertEqual(self.inventory.select(os='centos'),
+                ['pbx1', 'web'])
+
+    def test_reload(self):
+        self.inventory.replace({'one': {'addr': '10.0.0.1'}})
+        other = Inventory(self.path, indexes=('addr',))
+        self.assertEqual(other.keys(), ['one'])
+        with mock.patch('toml.load') as load:
+            other.keys()
+            load.assert_not_called()
+        with self.inventory.transaction() as hosts:
+            hosts['two'] = {'addr': '10.0.0.2'}
+        self.assertEqual(other.lookup('addr', '10.0.0.2'), 'two')
+
+    def test_transaction(self):
+        with mock.patch.object(self.inventory, '_write',
+                wraps=self.inventory._write) as write:
+            with self.inventory.transaction() as hosts:
+                hosts['one'] = {'addr': '10.0.0.1'}
+                with self.inventory.transaction() as inner:
+                    inner['two'] = {'addr': '10.0.0.2'}
+                self.assertEqual(write.call_count, 0)
+            self.assertEqual(write.call_count, 1)
+            with self.inventory.transaction() as hosts:
+                pass
+            self.assertEqual(write.call_count, 1)
+
+        with self.assertRaises(RuntimeError):
+            with self.inventory.transaction() as hosts:
+                hosts.clear()
+                raise RuntimeError()
+        self.assertEqual(self.inventory.keys(), ['one', 'two'])
+        self.assertEqual(os.listdir(self.dir), ['hosts.conf'])
+
+if __name__ == '__main__':
+    unittest.main()
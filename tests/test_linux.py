@@ -6,7 +6,12 @@
 
 import unittest
 import os
+import pwd
+import grp
 import tempfile
+import shutil
+import hashlib
+from unittest import mock
 from getpass import getuser, getpass
 from pigrizia.host.linux import Linux
 from pigrizia.service.user import UserExists, NoSuchUser
@@ -26,6 +31,17 @@ class BaseTestCases:
             self.assertTrue(self.host.directory_exists('/etc'))
             self.assertFalse(self.host.directory_exists('/foo'))
 
+        def test_batch(self):
+            with self.host.batch() as b:
+                hosts = b.file_exists('/etc/hosts')
+                foo = b.file_exists('/etc/foo')
+                etc = b.directory_exists('/etc')
+                who = b.whoami()
+            self.assertTrue(hosts.value)
+            self.assertFalse(foo.value)
+            self.assertTrue(etc.value)
+            self.assertEqual(who.value, self.user)
+
         def test_mkdir_and_rmdir(self):
             self.assertFalse(self.host.directory_exists('/tmp/foo'))
             self.assertEqual(self.host.mkdir('/tmp/foo'), 0)
@@ -37,9 +53,37 @@ class BaseTestCases:
             self.assertEqual(self.host.whoami(), self.user)
             self.assertEqual(self.host.whoami(sudo=True), 'root')
 
+        def test_command(self):
+            ret, out, err = self.host.command("echo foo")
+            self.assertEqual((ret, out), (0, ['foo']))
+            ret, out, err = self.host.command("whoami", sudo=True)
+            self.assertEqual((ret, out), (0, ['root']))
+
         def test_user_exists(self):
             self.assertTrue(self.host.user_exists('root'))
             self.assertFalse(self.host.user_exists('foobar'))
+            users = self.host.users
+            with mock.patch.object(users, '_call',
+                    wraps=users._call) as call:
+                self.assertTrue(self.host.user_exists('root', sudo=True,
+                    passwd=self.passwd))
+            for args, kwargs in call.call_args_list:
+                self.assertEqual(kwargs, {'sudo': True,
+                    'passwd': self.passwd})
+
+        def test_user_database(self):
+            users = self.host.users
+            root = users.user('root')
+            self.assertEqual((root.uid, root.gid, root.home), (0, 0, '/root'))
+            self.assertEqual(users.group('root').gid, 0)
+            self.assertIsNone(users.user('foobar'))
+            self.assertIsNone(users.group('foobar'))
+            users.snapshot()
+            self.assertEqual(users.user('root'), root)
+            self.assertIn(root, users.users())
+            self.assertIsNone(users.user('foobar'))
+            users.invalidate()
+            self.assertEqual(users.user('root'), root)
 
         def test_user_add_and_delete(self):
             user="foobar"
@@ -50,6 +94,38 @@ class BaseTestCases:
             self.assertTrue(self.host.userdel(user=user))
             self.assertFalse(self.host.user_exists(user))
 
+        def test_user_add_and_delete_many(self):
+            users = ['foobar1', {'user': 'foobar2', 'passwd': 'barfoo'},
+                    'root', 'foobar1']
+            results = self.host.useradd_many(users, passwd=self.passwd)
+            self.assertEqual([r.user for r in results],
+                    ['foobar1', 'foobar2', 'root', 'foobar1'])
+            self.assertEqual([r.ok for r in results],
+                    [True, True, False, False])
+            self.assertEqual(len(results[0].passwd), 12)
+            self.assertIsNone(results[1].passwd)
+            self.assertIsInstance(results[2].error, UserExists)
+            self.assertTrue(self.host.user_exists('foobar2'))
+            results = self.host.userdel_many(['foobar1', 'foobar2',
+                'bimbaz'], passwd=self.passwd)
+            self.assertEqual([r.ok for r in results], [True, True, False])
+            self.assertIsInstance(results[2].error, NoSuchUser)
+            self.assertFalse(self.host.user_exists('foobar1'))
+
+        def test_user_add_many_failure(self):
+            users = self.host.users
+            with mock.patch.object(self.host, 'batch',
+                    side_effect=RuntimeError) as batch:
+                self.assertRaises(RuntimeError, self.host.useradd_many,
+                        ['foobar1'], passwd=self.passwd, workers=1)
+                batch.assert_called_with(sudo=True, passwd=self.passwd)
+                self.assertIsNone(users._users)
+                users.snapshot()
+                self.assertRaises(RuntimeError, self.host.userdel_many,
+                        ['root'], passwd=self.passwd)
+                batch.assert_called_with(sudo=True, passwd=self.passwd)
+                self.assertIsNone(users._users)
+
         def test_adding_existing_user(self):
             self.assertRaises(UserExists, self.host.useradd, "root")
 
@@ -58,12 +134,138 @@ class BaseTestCases:
 
         def test_set_permissions(self):
             fp, fname = tempfile.mkstemp()
-            self.host.set_permissions(fname, permission=0o666)
+            self.assertTrue(self.host.set_permissions(fname,
+                permission=0o666))
             stat = os.stat(fname)
-            perm = oct(stat.st_mode) and 0o666
-            fp.close()
+            perm = stat.st_mode & 0o777
+            os.close(fp)
+            os.remove(fname)
             self.assertEqual(perm, 0o666)
 
+        def test_converge_permissions(self):
+            top = tempfile.mkdtemp()
+            os.makedirs(os.path.join(top, 'a', 'b'), 0o700)
+            for name in ('f1', 'a/f2', 'a/b/f3'):
+                with open(os.path.join(top, name), 'w'):
+                    pass
+                os.chmod(os.path.join(top, name), 0o644)
+            os.chmod(os.path.join(top, 'a/f2'), 0o600)
+            os.chmod(os.path.join(top, 'a'), 0o700)
+            os.chmod(top, 0o755)
+
+            changes = self.host.set_permissions(top, recursive=True,
+                    dirs=0o755, files=0o644, dry_run=True)
+            self.assertTrue(changes.ok)
+            self.assertEqual(sorted(changes.entries), [
+                ('mode', '600', '644', os.path.join(top, 'a/f2')),
+                ('mode', '700', '755', os.path.join(top, 'a')),
+                ('mode', '700', '755', os.path.join(top, 'a/b')),
+                ])
+            self.assertEqual(os.stat(os.path.join(top, 'a')).st_mode & 0o777,
+                    0o700)
+
+            changes = self.host.set_permissions(top, recursive=True,
+                    dirs=0o755, files=0o644)
+            self.assertEqual(changes.changed, 3)
+            self.assertEqual(os.stat(os.path.join(top, 'a/f2')).st_mode &
+                    0o777, 0o644)
+            changes = self.host.set_permissions(top, recursive=True,
+                    dirs=0o755, files=0o644, owner=self.user)
+            self.assertEqual((changes.ok, changes.changed), (True, 0))
+            shutil.rmtree(top)
+
+        def test_converge_owner(self):
+            # A group that isn't the login group of the user.
+            nobody = pwd.getpwnam('nobody')
+            group = grp.getgrgid(nobody.pw_gid).gr_name
+            top = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, top)
+            fname = os.path.join(top, 'f')
+            with open(fname, 'w'):
+                pass
+            changes = self.host.set_permissions(top, recursive=True,
+                    owner='nobody', group=group, sudo=True)
+            self.assertEqual(changes.changed, 2)
+
+            changes = self.host.set_permissions(top, recursive=True,
+                    owner=self.user, dry_run=True)
+            self.assertIn(('owner', 'nobody', self.user, fname),
+                    changes.entries)
+            changes = self.host.set_permissions(top, recursive=True,
+                    owner=self.user, sudo=True)
+            self.assertEqual(changes.changed, 2)
+            st = os.stat(fname)
+            self.assertEqual(st.st_uid, pwd.getpwnam(self.user).pw_uid)
+            self.assertEqual(st.st_gid, nobody.pw_gid)
+            self.assertRaises(ValueError, self.host.set_permissions, top,
+                    recursive=True, files='u+rwX')
+
+        def test_stat_many(self):
+            top = tempfile.mkdtemp()
+            fname = os.path.join(top, 'a file')
+            with open(fname, 'wb') as f:
+                f.write(b'x' * 100)
+            os.chmod(fname, 0o640)
+            os.symlink(fname, os.path.join(top, 'link'))
+            newline = os.path.join(top, 'new\nline')
+            os.mkdir(newline)
+            paths = [top, fname, os.path.join(top, 'link'),
+                    os.path.join(top, 'missing'), newline]
+            results = self.host.stat_many(paths)
+            self.assertEqual([r.type for r in results[:3]],
+                    ['directory', 'file', 'symlink'])
+            self.assertIsNone(results[3])
+            self.assertEqual(results[4].path, newline)
+            self.assertEqual(self.host.stat_many(paths, sudo=True), results)
+            st = os.lstat(fname)
+            self.assertEqual(results[1], (fname, 'file', 0o640, st.st_uid,
+                st.st_gid, 100, int(st.st_mtime), st.st_ino))
+            shutil.rmtree(top)
+
+        def test_python(self):
+            python = self.host.python
+            self.assertIs(self.host.python, python)
+            major, minor = python.facts.version[:2]
+            self.assertEqual(python.version(), "{}.{}".format(major, minor))
+            self.assertIsNotNone(python.facts.pip_version)
+            self.assertEqual(python.package_version('PIP'),
+                    python.facts.pip_version)
+            self.assertTrue(python.has_package('pip'))
+            self.assertFalse(python.has_package('no-such-package'))
+            packages = python.packages()
+            self.assertIs(python.packages(), packages)
+            self.assertIsNot(python.packages(sudo=True), packages)
+
+        def test_install_pigrizia_kwargs(self):
+            python = self.host.python
+            with mock.patch.object(python, 'install',
+                    return_value=True) as install, \
+                    mock.patch.object(self.host, 'permissions',
+                    return_value='750'):
+                self.assertTrue(self.host.install_pigrizia(force=True,
+                    passwd=self.passwd))
+            self.assertEqual(install.call_args[1],
+                    {'sudo': True, 'passwd': self.passwd})
+
+        def test_install_pigrizia_wheel(self):
+            wheel = 'pigrizia-0.0.0-py3-none-any.whl'
+            data = b'not really a wheel'
+            python = self.host.python
+            with mock.patch.object(python, 'install',
+                    return_value=True) as install, \
+                    mock.patch.object(self.host, 'write_file',
+                    wraps=self.host.write_file) as write_file, \
+                    mock.patch.object(self.host, 'permissions',
+                    return_value='750'):
+                self.assertTrue(self.host.install_pigrizia(wheel=wheel,
+                    wheel_data=data, passwd=self.passwd))
+            dest, content = write_file.call_args[0]
+            self.assertEqual(os.path.basename(dest), wheel)
+            self.assertEqual(content, data)
+            self.assertEqual(install.call_args[0][-1], dest)
+            self.assertEqual(install.call_args[1],
+                    {'sudo': True, 'passwd': self.passwd})
+
         def test_mktemp(self):
             tmpfile = self.host.mktemp()
             # TODO: maybe this is dumb, since $TMPDIR might be set to
@@ -72,26 +274,128 @@ class BaseTestCases:
             # TODO: we should probably remove tmpfile after we are done.
 
         def test_read_write_file(self):
-            f = "foo.txt"
+            f = self._tempfile()
             t = "Foo\nBar\nBim\nBaz\n"
             self.host.write_file(f, t)
             t2 = self.host.read_file(f)
             self.assertEqual(t, t2)
-            # TODO: add this when we have rm command
-            # self.host.rm(f)
+
+        def test_read_binary(self):
+            data = bytes(range(256)) * 100
+            fd, fname = tempfile.mkstemp()
+            os.write(fd, data)
+            os.close(fd)
+            self.assertEqual(self.host.read_file(fname, binary=True), data)
+            chunks = list(self.host.iter_chunks(fname, chunk_size=1000))
+            self.assertEqual(len(chunks[0]), 1000)
+            self.assertEqual(b''.join(chunks), data)
+            buf = bytearray(len(data) + 10)
+            self.assertEqual(self.host.read_into(fname, buf), len(data))
+            self.assertEqual(bytes(buf[:len(data)]), data)
+            os.remove(fname)
+
+        def test_write_binary(self):
+            data = bytes(range(256)) * 100
+            fd, fname = tempfile.mkstemp()
+            os.close(fd)
+            os.chmod(fname, 0o640)
+            self.host.write_file(fname, data)
+            with open(fname, 'rb') as f:
+                self.assertEqual(f.read(), data)
+            self.assertEqual(os.stat(fname).st_mode & 0o777, 0o640)
+            leftovers = [f for f in os.listdir(os.path.dirname(fname))
+                    if '.pigrizia-' in f]
+            self.assertEqual(leftovers, [])
+            os.remove(fname)
+
+        def test_copy_tree(self):
+            src, dest = tempfile.mkdtemp(), tempfile.mkdtemp()
+            os.makedirs(os.path.join(src, 'a', 'b'))
+            files = {'one': b'1', os.path.join('a', 'two'): b'2' * 100000,
+                    os.path.join('a', 'b', 'three'): b''}
+            for name, data in files.items():
+                with open(os.path.join(src, name), 'wb') as f:
+                    f.write(data)
+            os.chmod(os.path.join(src, 'one'), 0o751)
+            os.symlink('one', os.path.join(src, 'link'))
+
+            count = self.host.copy_tree(src, dest, compress='gz')
+            self.assertEqual(count, 3)
+            for name, data in files.items():
+                with open(os.path.join(dest, name), 'rb') as f:
+                    self.assertEqual(f.read(), data)
+            mode = os.stat(os.path.join(dest, 'one')).st_mode & 0o777
+            self.assertEqual(mode, 0o751)
+            self.assertEqual(os.readlink(os.path.join(dest, 'link')), 'one')
+            self.assertEqual(sorted(os.listdir(dest)), ['a', 'link', 'one'])
+            self.assertRaises(ValueError, self.host.copy_tree, src, dest,
+                    compress='zip')
+            shutil.rmtree(src)
+            shutil.rmtree(dest)
+
+        def test_read_missing_file(self):
+            self.assertRaises(FileNotFoundError, self.host.read_file,
+                    '/etc/foo')
 
         def test_checksum(self):
-            f = "foo.txt"
+            f = self._tempfile()
             t = "Foo\nBar\nBim\nBaz\n"
             self.host.write_file(f, t)
             cs = self.host.checksum(f)
             self.assertEqual(cs, checksum)
-            
+
+        def test_checksum_algorithms(self):
+            f = self._tempfile()
+            t = "Foo\nBar\nBim\nBaz\n"
+            self.host.write_file(f, t)
+            for algorithm in ('sha256', 'blake2b'):
+                h = hashlib.new(algorithm, t.encode()).hexdigest()
+                self.assertEqual(self.host.checksum(f, hash=algorithm), h)
+            sums = self.host.checksum_many([f, f], hash='sha512')
+            self.assertEqual(sums, {f: checksum})
+
+        def _tempfile(self):
+            fd, fname = tempfile.mkstemp()
+            os.close(fd)
+            self.addCleanup(os.remove, fname)
+            return fname
 
 class TestLocalLinux(BaseTestCases.LinuxTestBase):
     def setUp(self):
         self.host = Linux(user=self.user, passwd=self.passwd)
 
+    def test_native_matches_commands(self):
+        # The local host answers these in-process. The answers must be the
+        # same as what the commands give.
+        do = self.host.cmdh.do
+        fd, fname = tempfile.mkstemp()
+        os.close(fd)
+        os.chmod(fname, 0o4751)
+        for f in ('%a', '%A'):
+            kwargs = {'human-readable': True} if f == '%A' else {}
+            ret, out, err = do("stat -c {} {}".format(f, fname))
+            self.assertEqual(self.host.permissions(fname, **kwargs), out[0])
+        os.remove(fname)
+
+        self.assertEqual(self.host.whoami(), do("whoami")[1][0])
+        for path in ('/etc', '/etc/hosts', '/nonexistent'):
+            self.assertEqual(self.host.directory_exists(path),
+                    do("test -d {}".format(path))[0] == 0)
+            self.assertEqual(self.host.file_exists(path),
+                    do("test -f {}".format(path))[0] == 0)
+
+        tmp = self.host.mktemp(create_dir=True)
+        self.assertRegex(tmp, r'^/tmp/tmp\.[A-Za-z0-9]{10}$')
+        self.assertEqual(self.host.permissions(tmp), '700')
+        path = os.path.join(tmp, 'a', 'b')
+        self.assertEqual(self.host.mkdir(path), 0)
+        self.assertEqual(self.host.mkdir(path), 0)
+        with open(os.path.join(tmp, 'file'), 'w'):
+            pass
+        self.assertEqual(self.host.mkdir(os.path.join(tmp, 'file')),
+                do("mkdir -p {}".format(os.path.join(tmp, 'file')))[0])
+        shutil.rmtree(tmp)
+
 class TestRemoteLinux(BaseTestCases.LinuxTestBase):
     addr = '127.0.0.1'
 
@@ -0,0 +1,39 @@
+# Copyright 2019 Lorenzo Cabrini
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import unittest
+from unittest import mock
+from pigrizia.service import password
+
+class TestPassword(unittest.TestCase):
+    def test_hash_password(self):
+        h = password.hash_password('secret', rounds=5000)
+        self.assertTrue(h.startswith('$6$rounds=5000$'))
+        self.assertEqual(password._crypt().crypt('secret', h), h)
+        h = password.hash_password('secret', method='sha256')
+        self.assertTrue(h.startswith('$5$'))
+        self.assertRaises(password.UnknownMethod, password.hash_password,
+                'secret', method='md4')
+
+    def test_hash_passwords(self):
+        passwds = ['secret{}'.format(i) for i in range(50)]
+        with mock.patch.object(password, 'ProcessPoolExecutor',
+                wraps=password.ProcessPoolExecutor) as pool:
+            hashes = password.hash_passwords(passwds, rounds=1000,
+                    workers=2)
+            pool.assert_called_once_with(max_workers=2)
+        self.assertEqual(len(hashes), len(passwds))
+        for p, h in zip(passwds, hashes):
+            self.assertEqual(password._crypt().crypt(p, h), h)
+        self.assertEqual(password.hash_passwords([]), [])
+
+    def test_no_crypt(self):
+        with mock.patch.dict('sys.modules', {'crypt': None}):
+            self.assertRaises(password.CryptUnavailable,
+                    password.hash_password, 'secret')
+
+if __name__ == '__main__':
+    unittest.main()